@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''CaptureArchive Library
+
+Read ``show platform sudi`` and ``show platform integrity`` captures
+straight from tar (plain, gzip or bzip2 compressed), zip and gzip files, or
+from a tar stream on stdin, without extracting them, and pair the SUDI and
+integrity captures of each device as they stream past.'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import re
+import sys
+import gzip
+import tarfile
+import zipfile
+
+SUDI_COMMAND = "show platform sudi"
+INTEGRITY_COMMAND = "show platform integrity"
+NONCE_PAT = re.compile(r'\bnonce\s+(\d+)')
+PROMPT_PAT = re.compile(r'^\s*([^\s#>]+)[#>]')
+
+# larger members are not captures, and are not decompressed
+MAX_CAPTURE_BYTES = 1024 * 1024
+GZIP_MAGIC = "\x1f\x8b"
+
+
+def parse_capture(text):
+    '''Split a capture into (kind, nonce, body). kind is ``sudi``,
+    ``integrity`` or None when the first line is not a known command.'''
+    header, _, body = text.partition("\n")
+    if SUDI_COMMAND in header:
+        kind = "sudi"
+    elif INTEGRITY_COMMAND in header:
+        kind = "integrity"
+    else:
+        kind = None
+    match = NONCE_PAT.search(header)
+    return kind, match.group(1) if match else None, body
+
+
+def capture_host(text):
+    '''Hostname of the device prompt on the first line of a capture, or
+    None when the command was saved without its prompt.'''
+    match = PROMPT_PAT.match(text.partition("\n")[0])
+    return match.group(1) if match else None
+
+
+def _read_limited(member_file):
+    '''Read a member, None if it exceeds MAX_CAPTURE_BYTES.'''
+    data = member_file.read(MAX_CAPTURE_BYTES + 1)
+    return None if len(data) > MAX_CAPTURE_BYTES else data
+
+
+def iter_members(path):
+    '''Yield (name, text) for every capture sized file of a tar, zip or
+    gzip file, or of a tar stream on stdin when path is ``-``.
+
+    Tar files are read in stream mode, so members are decompressed one
+    at a time as they are reached.'''
+    if path == "-":
+        archive = tarfile.open(fileobj=sys.stdin, mode="r|*")
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith("/") or info.file_size > MAX_CAPTURE_BYTES:
+                    continue
+                with archive.open(info) as member_file:
+                    data = _read_limited(member_file)
+                if data is not None:
+                    yield info.filename, data
+        return
+    elif tarfile.is_tarfile(path):
+        archive = tarfile.open(path, mode="r|*")
+    else:
+        with open(path, 'rb') as capture_file:
+            magic = capture_file.read(2)
+        opener = gzip.open if magic == GZIP_MAGIC else open
+        name = path[:-3] if path.endswith(".gz") else path
+        with opener(path, 'rb') as capture_file:
+            data = _read_limited(capture_file)
+        if data is not None:
+            yield name, data
+        return
+
+    with archive:
+        for info in archive:
+            if not info.isfile() or info.size > MAX_CAPTURE_BYTES:
+                continue
+            member_file = archive.extractfile(info)
+            data = _read_limited(member_file)
+            if data is not None:
+                yield info.name, data
+
+
+def capture_pairs(path):
+    '''Yield (name, sudi_nonce, sudi_body, spi_nonce, spi_body, problem)
+    for every SUDI capture of an archive, spi_* being None without an
+    integrity capture and problem None unless the capture is rejected.
+
+    An integrity capture belongs to the SUDI capture in the same archive
+    directory with the same nonce. A pair is yielded as soon as both
+    members were read; SUDI captures still unpaired at the end of the
+    archive are yielded alone. A nonce is used once per directory: a
+    later capture of the same kind with the same nonce is a replay and is
+    yielded with a problem (only its name is set).'''
+    sudi = {}
+    integrity = {}
+    # (directory, nonce, kind) of captures already read
+    used = set()
+    for name, text in iter_members(path):
+        kind, nonce, body = parse_capture(text)
+        if kind is None:
+            continue
+        key = (os.path.dirname(name), nonce)
+        if key + (kind,) in used:
+            yield name, None, None, None, None, "nonce %s used by more than one capture" % nonce
+            continue
+        used.add(key + (kind,))
+        if kind == "sudi":
+            if key in integrity:
+                spi_body = integrity.pop(key)
+                yield name, nonce, body, nonce, spi_body, None
+            else:
+                sudi[key] = (name, body)
+        elif key in sudi:
+            sudi_name, sudi_body = sudi.pop(key)
+            yield sudi_name, nonce, sudi_body, nonce, body, None
+        else:
+            integrity[key] = body
+    for key, (sudi_name, sudi_body) in sorted(sudi.items()):
+        yield sudi_name, key[1], sudi_body, None, None, None
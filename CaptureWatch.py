@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''CaptureWatch Library
+
+Verify SUDI and integrity captures as collectors drop them into a
+directory. New files are picked up with inotify on Linux (by polling the
+directory elsewhere), the SUDI and integrity captures of a device are
+paired by host and nonce, and a small pool of threads in the same warm
+process verifies the pairs. Every result carries its end-to-end latency,
+from the moment the last file of the pair was seen to the result.'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import sys
+import time
+import errno
+import Queue
+import select
+import struct
+import threading
+from collections import deque
+import CaptureArchive
+import ResultStore
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+# seconds between directory scans without inotify
+POLL_INTERVAL = 1.0
+# seconds a capture waits for the other half of its pair
+PAIR_TIMEOUT = 300
+# seconds between latency summaries
+STATS_INTERVAL = 60
+# latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+WATCH_WORKERS = 4
+# captures remembered as verified
+COMPLETED_KEYS = 100000
+
+# temporary names collectors write to before renaming into place
+IGNORED_SUFFIXES = (".tmp", ".part", ".swp", "~")
+
+
+def _ignored(name):
+    return name.startswith(".") or name.endswith(IGNORED_SUFFIXES)
+
+
+class InotifyWatcher(object):
+    '''Names of files closed after writing in, or moved into, a directory.
+
+    Raises OSError where inotify is not available.'''
+
+    def __init__(self, directory):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.directory = directory
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "inotify_add_watch %s failed" % directory)
+
+    def changed(self, timeout):
+        '''Names that landed within timeout seconds, None when the kernel
+        dropped events and the directory must be rescanned.'''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if name:
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    '''Names of new or modified files of a directory, found by scanning it.
+
+    A file is reported once its size and mtime held still for one scan,
+    so files still being written are not read.'''
+
+    def __init__(self, directory, interval=POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.seen = self._scan()
+        self.settling = {}
+
+    def _scan(self):
+        found = {}
+        for name in os.listdir(self.directory):
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            found[name] = (info.st_size, info.st_mtime)
+        return found
+
+    def changed(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = self._scan()
+        names = []
+        for name, state in current.items():
+            if self.seen.get(name) == state:
+                continue
+            if self.settling.get(name) == state:
+                names.append(name)
+                self.seen[name] = state
+                del self.settling[name]
+            else:
+                self.settling[name] = state
+        for name in set(self.seen) - set(current):
+            del self.seen[name]
+        return names
+
+    def close(self):
+        pass
+
+
+def watcher(directory):
+    '''inotify watcher for directory, or a polling one without inotify.'''
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, ImportError):
+            pass
+    return PollingWatcher(directory)
+
+
+class LatencyStats(object):
+    '''Percentiles over the latest LATENCY_WINDOW latencies.'''
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def summary(self):
+        '''(count, p50, p90, p99, max) in seconds, None without samples.'''
+        with self.lock:
+            ordered = sorted(self.samples)
+            count = self.count
+        if not ordered:
+            return None
+        def percentile(fraction):
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+        return count, percentile(0.5), percentile(0.9), percentile(0.99), ordered[-1]
+
+
+class CaptureWatch(object):
+    '''Verify the captures landing in a directory until stopped.
+
+    - directory (str): directory the collectors write captures to
+    - store (ResultStore.ResultStore): result store
+    - anchors (list): DER trust anchors, empty to skip the anchor check
+    - emit (callable): called as emit(result) for every verified capture;
+        result is a dict of name, host, nonce, kind, cached, passed,
+        detail and latency (seconds)
+    - workers (int): verification threads
+    - pair_timeout (int): seconds a SUDI capture waits for its integrity
+        capture before it is verified alone
+    - revocation (RevocationIndex.RevocationIndex): revoked SUDI
+        certificates, None to skip the revocation check
+
+    A capture reusing a nonce another capture of the same host and kind
+    already used is reported as failed without being verified.'''
+
+    def __init__(self, directory, store, anchors=(), emit=None, workers=WATCH_WORKERS,
+                 pair_timeout=PAIR_TIMEOUT, revocation=None):
+        self.directory = directory
+        self.store = store
+        self.anchors = set(anchors)
+        self.revocation = revocation
+        self.trust = ResultStore.trust_version(anchors, revocation)
+        self.emit = emit
+        self.pair_timeout = pair_timeout
+        self.latency = LatencyStats()
+        self.counts = dict(total=0, cached=0, verified=0, passed=0, failed=0)
+        self.lock = threading.Lock()
+        # (host, nonce) -> {kind: (name, nonce, body, seen)}
+        self.pending = {}
+        # (key, kind) -> (name, hash of the body) of the capture already
+        # verified, so a file reported twice is not verified twice; reuse
+        # of a nonce by another capture is caught by the store's claims
+        self.completed = {}
+        self.completed_order = deque(maxlen=COMPLETED_KEYS)
+        self.work = Queue.Queue()
+        self.threads = [threading.Thread(target=self._worker) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            key, sudi, spi, seen, problem = item
+            name = " + ".join(capture[0] for capture in (sudi, spi) if capture is not None)
+            try:
+                if problem is not None:
+                    cached, passed, detail = False, False, problem
+                elif sudi is None:
+                    cached, passed, detail = False, False, "no SUDI capture for nonce"
+                else:
+                    cached, passed, detail = ResultStore.check_capture(
+                        self.store, self.trust, self.anchors, sudi[1], sudi[2],
+                        spi[1] if spi else None, spi[2] if spi else None, self.revocation)
+            except Exception as err:
+                # a store error must not take the thread down
+                cached, passed, detail = False, False, "error: %s" % err
+            latency = time.time() - seen
+            self.latency.add(latency)
+            with self.lock:
+                self.counts['total'] += 1
+                self.counts['cached' if cached else 'verified'] += 1
+                self.counts['passed' if passed else 'failed'] += 1
+                if not cached and self.counts['verified'] % 100 == 0:
+                    try:
+                        self.store.commit()
+                    except Exception as err:
+                        print >> sys.stderr, "Warning: result store commit failed: %s" % err
+                if self.emit is not None:
+                    self.emit(dict(name=name, host=key[0], nonce=key[1], cached=cached,
+                                   kind="sudi" if spi is None else "integrity",
+                                   passed=passed, detail=detail, latency=latency))
+
+    def _completed(self, key, captures):
+        for kind, capture in captures.items():
+            if len(self.completed_order) == self.completed_order.maxlen:
+                self.completed.pop(self.completed_order[0], None)
+            self.completed_order.append((key, kind))
+            self.completed[(key, kind)] = (capture[0], hash(capture[2]))
+
+    def ingest(self, name, seen=None):
+        '''Read a landed file (a capture, or a tar, zip or gzip file of
+        them) and queue every pair it completes.'''
+        seen = time.time() if seen is None else seen
+        path = os.path.join(self.directory, name)
+        try:
+            members = list(CaptureArchive.iter_members(path))
+        except (IOError, OSError, EOFError, ValueError):
+            # gone already, or an archive that is still incomplete
+            return
+        for member, text in members:
+            kind, nonce, body = CaptureArchive.parse_capture(text)
+            if kind is None:
+                continue
+            key = (CaptureArchive.capture_host(text), nonce)
+            if member.startswith(path):
+                member = os.path.basename(member)
+            else:
+                member = "%s:%s" % (name, member)
+            if self.completed.get((key, kind)) == (member, hash(body)):
+                # the same capture reported twice
+                continue
+            holder = self.store.claim(key[0], nonce, kind, member)
+            if holder != member:
+                # another capture already used this nonce: a replay
+                capture = (member, nonce, body, seen)
+                self.work.put((key, capture if kind == "sudi" else None,
+                               capture if kind != "sudi" else None, seen,
+                               "nonce %s used by more than one capture (first %s)"
+                               % (nonce, holder)))
+                continue
+            captures = self.pending.setdefault(key, {})
+            captures[kind] = (member, nonce, body, seen)
+            if "sudi" in captures and "integrity" in captures:
+                del self.pending[key]
+                self._completed(key, captures)
+                self.work.put((key, captures["sudi"], captures["integrity"],
+                               max(captures["sudi"][3], captures["integrity"][3]), None))
+
+    def expire(self, now=None):
+        '''Verify SUDI captures whose integrity capture did not arrive in
+        time alone, and report integrity captures without a SUDI one.'''
+        now = time.time() if now is None else now
+        for key, captures in self.pending.items():
+            seen = max(capture[3] for capture in captures.values())
+            if now - seen < self.pair_timeout:
+                continue
+            del self.pending[key]
+            self._completed(key, captures)
+            self.work.put((key, captures.get("sudi"), captures.get("integrity"), seen, None))
+
+    def scan(self):
+        '''Ingest every file already in the directory.'''
+        for name in sorted(os.listdir(self.directory)):
+            if not _ignored(name) and os.path.isfile(os.path.join(self.directory, name)):
+                self.ingest(name)
+
+    def run(self, stop=None, stats=None, stats_interval=STATS_INTERVAL):
+        '''Watch the directory until stop (a threading.Event) is set or
+        the process is interrupted. stats, if given, is called with
+        LatencyStats.summary() every stats_interval seconds.'''
+        files = watcher(self.directory)
+        self.scan()
+        next_stats = time.time() + stats_interval
+        try:
+            while stop is None or not stop.is_set():
+                names = files.changed(POLL_INTERVAL)
+                if names is None:
+                    self.scan()
+                else:
+                    for name in names:
+                        if not _ignored(name):
+                            self.ingest(name)
+                now = time.time()
+                self.expire(now)
+                if stats is not None and now >= next_stats:
+                    stats(self.latency.summary())
+                    next_stats = now + stats_interval
+        finally:
+            files.close()
+
+    def close(self):
+        '''Finish the queued pairs, leave unpaired captures, and commit.'''
+        for _ in self.threads:
+            self.work.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.store.commit()
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''CryptoBackend Library
+
+One interface for hashing, public key import and RSA (PKCS#1 v1.5) and
+ECDSA signature verification, implemented on top of pycrypto (ECDSA needs
+pycryptodome) and of OpenSSL (pyOpenSSL). The fastest backend that imports
+is selected on first use, confirmed by a short micro-benchmark, and shared
+by VerifySignature and device_validation.
+
+``SIGNATURES`` maps a signature version and key type to the hash
+algorithms accepted for it.
+
+Set VERIFYBIV_CRYPTO_BACKEND to ``openssl`` or ``pycrypto`` to force one.'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import time
+import hashlib
+import binascii
+import threading
+
+BACKEND_ENV = "VERIFYBIV_CRYPTO_BACKEND"
+BENCHMARK_ITERATIONS = 200
+
+# Cisco Root CA 2048, used as the public key for the selection benchmark
+BENCHMARK_CERT_PEM = '''
+MIIDQzCCAiugAwIBAgIQX/h7KCtU3I1CoxW1aMmt/zANBgkqhkiG9w0BAQUFADA1
+MRYwFAYDVQQKEw1DaXNjbyBTeXN0ZW1zMRswGQYDVQQDExJDaXNjbyBSb290IENB
+IDIwNDgwHhcNMDQwNTE0MjAxNzEyWhcNMjkwNTE0MjAyNTQyWjA1MRYwFAYDVQQK
+Ew1DaXNjbyBTeXN0ZW1zMRswGQYDVQQDExJDaXNjbyBSb290IENBIDIwNDgwggEg
+MA0GCSqGSIb3DQEBAQUAA4IBDQAwggEIAoIBAQCwmrmrp68Kd6ficba0ZmKUeIhH
+xmJVhEAyv8CrLqUccda8bnuoqrpu0hWISEWdovyD0My5jOAmaHBKeN8hF570YQXJ
+FcjPFto1YYmUQ6iEqDGYeJu5Tm8sUxJszR2tKyS7McQr/4NEb7Y9JHcJ6r8qqB9q
+VvYgDxFUl4F1pyXOWWqCZe+36ufijXWLbvLdT6ZeYpzPEApk0E5tzivMW/VgpSdH
+jWn0f84bcN5wGyDWbs2mAag8EtKpP6BrXruOIIt6keO1aO6g58QBdKhTCytKmg9l
+Eg6CTY5j/e/rmxrbU6YTYK/CfdfHbBcl1HP7R2RQgYCUTOG/rksc35LtLgXfAgED
+o1EwTzALBgNVHQ8EBAMCAYYwDwYDVR0TAQH/BAUwAwEB/zAdBgNVHQ4EFgQUJ/PI
+FR5umgIJFq0roIlgX9p7L6owEAYJKwYBBAGCNxUBBAMCAQAwDQYJKoZIhvcNAQEF
+BQADggEBAJ2dhISjQal8dwy3U8pORFBi71R803UXHOjgxkhLtv5MOhmBVrBW7hmW
+Yqpao2TB9k5UM8Z3/sUcuuVdJcr18JOagxEu5sv4dEX+5wW4q+ffy0vhN4TauYuX
+cB7w4ovXsNgOnbFp1iqRe6lJT37mjpXYgyc81WhJDtSd9i7rp77rMKSsH0T8lasz
+Bvt9YAretIpjsJyp8qS5UwGH0GikJ3+r/+n6yUA4iGe0OcaEb1fJU9u6ju7AQ7L4
+CYNu/2bPPu8Xs1gYJQk0XuPL1hS27PKSb3TkL4Eq1ZKR4OCXPDJoBYVL0fdX4lId
+kxpUnwVwwEpxYB5DC2Ae/qPOgRnhCzU=
+'''
+
+# self-signed throwaway certificates for the ECDSA benchmarks
+BENCHMARK_EC_P256_PEM = '''
+MIIBvTCCAWOgAwIBAgIUHv/FZ0mxhx5pyPOFhU+ft2z223IwCgYIKoZIzj0EAwIw
+MzESMBAGA1UECgwJVmVyaWZ5QklWMR0wGwYDVQQDDBRCZW5jaG1hcmsgcHJpbWUy
+NTZ2MTAgFw0yNjEwMTkwNDM4MTlaGA8yMTI2MDkyNTA0MzgxOVowMzESMBAGA1UE
+CgwJVmVyaWZ5QklWMR0wGwYDVQQDDBRCZW5jaG1hcmsgcHJpbWUyNTZ2MTBZMBMG
+ByqGSM49AgEGCCqGSM49AwEHA0IABNnWgZxD6bA2D1Au8ToQ3bxzDNjP7wgfxe0z
+rFnO/S1yYtaO+T0SIQfQwRBmZ2KpE8Lw5fkaiiEDzFCISnnotQqjUzBRMB0GA1Ud
+DgQWBBSYDZPdvRJXC6MqzQJLrQH53QnSuzAfBgNVHSMEGDAWgBSYDZPdvRJXC6Mq
+zQJLrQH53QnSuzAPBgNVHRMBAf8EBTADAQH/MAoGCCqGSM49BAMCA0gAMEUCIQDG
+6RydGhvPBjKhGEQzksgqW3TWdmAGIB56qUPGvasbWgIgHmn8KT4Mj72u3oY4vf2X
+yX3RSxlmE1hPxV9NQoDlHbE=
+'''
+
+BENCHMARK_EC_P384_PEM = '''
+MIIB9zCCAX6gAwIBAgIUGrzkOiLF0zZy2LkV1SH1JhDgfz0wCgYIKoZIzj0EAwIw
+MjESMBAGA1UECgwJVmVyaWZ5QklWMRwwGgYDVQQDDBNCZW5jaG1hcmsgc2VjcDM4
+NHIxMCAXDTI2MTAxOTA0MzgxOVoYDzIxMjYwOTI1MDQzODE5WjAyMRIwEAYDVQQK
+DAlWZXJpZnlCSVYxHDAaBgNVBAMME0JlbmNobWFyayBzZWNwMzg0cjEwdjAQBgcq
+hkjOPQIBBgUrgQQAIgNiAAQvbteFFCoFEJX4YldG+jV61LEBgo2Jv5/IwuWWPgK6
+L4EzEHxlL2qtotJi17pho/gPKRGuZKR+oVNG0CCxoIek57o67SrXqIdFlCWwf0yv
+IIV1+wYGa4WHTwldl2EA176jUzBRMB0GA1UdDgQWBBRSrIoSZiqbdC1M9hMmz14V
+mDK+wTAfBgNVHSMEGDAWgBRSrIoSZiqbdC1M9hMmz14VmDK+wTAPBgNVHRMBAf8E
+BTADAQH/MAoGCCqGSM49BAMCA2cAMGQCME8F0uu4XyBU4Yb6H4V7FrYK6DBZp01T
+POGWrkA/qOcuLWQo9C0W2QgMgtEcx7sMjwIwLeTe4giedpBQvdKLq6I+OPRy+itr
+/uOz8pv153USltsyansg9xs8Ux7x155gYvbe
+'''
+
+BENCHMARK_CERTS = (("RSA", BENCHMARK_CERT_PEM),
+                   ("EC-P256", BENCHMARK_EC_P256_PEM),
+                   ("EC-P384", BENCHMARK_EC_P384_PEM))
+
+# OpenSSL NID for EVP_PKEY_EC, for pyOpenSSL releases without crypto.TYPE_EC
+EVP_PKEY_EC = 408
+
+
+def _der_integer(value):
+    '''DER encode a non-negative integer given as big-endian bytes.'''
+    value = value.lstrip("\x00") or "\x00"
+    if ord(value[0]) & 0x80:
+        value = "\x00" + value
+    return "\x02" + _der_length(len(value)) + value
+
+
+def _der_length(length):
+    if length < 0x80:
+        return chr(length)
+    encoded = binascii.a2b_hex("%x" % length if len("%x" % length) % 2 == 0
+                               else "0%x" % length)
+    return chr(0x80 | len(encoded)) + encoded
+
+
+def _der_element(data, offset, tag):
+    '''(content offset, end offset) of the DER element with tag at offset,
+    or None when there is no well formed one.'''
+    if offset + 2 > len(data) or data[offset] != tag:
+        return None
+    length = ord(data[offset + 1])
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        if count == 0 or count > 4 or offset + count > len(data):
+            return None
+        length = int(binascii.b2a_hex(data[offset:offset + count]), 16)
+        offset += count
+    if offset + length > len(data):
+        return None
+    return offset, offset + length
+
+
+def is_der_ecdsa_signature(signature):
+    '''True if signature is a DER SEQUENCE of exactly two INTEGERs.'''
+    sequence = _der_element(signature, 0, "\x30")
+    if sequence is None or sequence[1] != len(signature):
+        return False
+    offset = sequence[0]
+    for _ in range(2):
+        integer = _der_element(signature, offset, "\x02")
+        if integer is None or integer[0] == integer[1]:
+            return False
+        offset = integer[1]
+    return offset == len(signature)
+
+
+def ecdsa_der_signature(signature, key_bits):
+    '''Return an ECDSA signature in DER form.
+
+    Signatures that parse as DER are returned as is, even when their
+    length happens to equal a raw pair's; otherwise a raw ``r || s`` pair
+    of the curve's size is converted.
+
+    - signature (str): binary signature
+    - key_bits (int): curve size in bits (256, 384 or 521)'''
+    coord = (key_bits + 7) // 8
+    if is_der_ecdsa_signature(signature) or len(signature) != 2 * coord:
+        return signature
+    body = _der_integer(signature[:coord]) + _der_integer(signature[coord:])
+    return "\x30" + _der_length(len(body)) + body
+
+
+def _key_type(kind, bits):
+    '''Key type name used by the signature registry.'''
+    return "RSA" if kind == "RSA" else "EC-P%d" % bits
+
+
+class Backend(object):
+    '''Interface every crypto backend implements.
+
+    Keys returned by ``load_certificate`` are opaque handles that are only
+    passed back to the same backend.'''
+
+    name = None
+
+    def digest(self, name, data):
+        '''Return the binary digest of data (name like ``sha256``).'''
+        return hashlib.new(name, data).digest()
+
+    def load_certificate(self, cert_der):
+        '''Import the public key of a DER encoded X.509 certificate.'''
+        raise NotImplementedError
+
+    def signature_size(self, key):
+        '''Size in bytes of a (raw) signature made with this key.'''
+        raise NotImplementedError
+
+    def key_type(self, key):
+        '''``RSA``, ``EC-P256``, ``EC-P384`` or ``EC-P521``.'''
+        raise NotImplementedError
+
+    def verify(self, key, signature, data, digest):
+        '''Verify an RSA PKCS#1 v1.5 or ECDSA signature over data, returns
+        True or False.
+
+        - key: handle returned by ``load_certificate``
+        - signature (str): binary signature
+        - data (str): signed data, hashed with digest by the backend
+        - digest (str): hash name, ``sha1``, ``sha256``, ``sha384`` or ``sha512``'''
+        raise NotImplementedError
+
+
+class OpenSSLBackend(Backend):
+    '''Backend on pyOpenSSL: hashing and verification run in libcrypto.'''
+
+    name = "openssl"
+
+    def __init__(self):
+        from OpenSSL import crypto
+        self.crypto = crypto
+
+    def load_certificate(self, cert_der):
+        return self.crypto.load_certificate(self.crypto.FILETYPE_ASN1, cert_der)
+
+    def signature_size(self, key):
+        pubkey = key.get_pubkey()
+        if self.key_type(key) == "RSA":
+            return (pubkey.bits() + 7) // 8
+        return 2 * ((pubkey.bits() + 7) // 8)
+
+    def key_type(self, key):
+        pubkey = key.get_pubkey()
+        if pubkey.type() == getattr(self.crypto, "TYPE_EC", EVP_PKEY_EC):
+            return _key_type("EC", pubkey.bits())
+        return "RSA"
+
+    def verify(self, key, signature, data, digest):
+        if self.key_type(key) != "RSA":
+            signature = ecdsa_der_signature(signature, key.get_pubkey().bits())
+        try:
+            self.crypto.verify(key, signature, data, digest)
+        except self.crypto.Error:
+            return False
+        return True
+
+
+class PyCryptoBackend(Backend):
+    '''Backend on pycrypto (or pycryptodome, which adds ECDSA).'''
+
+    name = "pycrypto"
+
+    def __init__(self):
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
+        from Crypto.Util.asn1 import DerSequence
+        from Crypto.Hash import SHA256, SHA384, SHA512
+        try:
+            from Crypto.Hash import SHA1
+        except ImportError:
+            from Crypto.Hash import SHA as SHA1
+        self.rsa = RSA
+        self.pkcs1 = PKCS1_v1_5
+        self.der_sequence = DerSequence
+        self.hashes = {"sha1": SHA1, "sha256": SHA256, "sha384": SHA384, "sha512": SHA512}
+        try:
+            from Crypto.PublicKey import ECC
+            from Crypto.Signature import DSS
+        except ImportError:
+            ECC = DSS = None
+        self.ecc = ECC
+        self.dss = DSS
+
+    def load_certificate(self, cert_der):
+        # walk Certificate -> TBSCertificate -> SubjectPublicKeyInfo
+        cert = self.der_sequence()
+        cert.decode(cert_der)
+        tbs_cert = self.der_sequence()
+        tbs_cert.decode(cert[0])
+        try:
+            return self.rsa.importKey(tbs_cert[6])
+        except (ValueError, IndexError, TypeError):
+            if self.ecc is None:
+                raise
+        return self.ecc.import_key(tbs_cert[6])
+
+    @staticmethod
+    def _ec_bits(key):
+        return key.pointQ.size_in_bits()
+
+    @staticmethod
+    def _rsa_bits(key):
+        # pycryptodome has size_in_bits(), pycrypto's size() is one less
+        if hasattr(key, "size_in_bits"):
+            return key.size_in_bits()
+        return key.size() + 1
+
+    def signature_size(self, key):
+        if self.key_type(key) == "RSA":
+            return (self._rsa_bits(key) + 7) // 8
+        return 2 * ((self._ec_bits(key) + 7) // 8)
+
+    def key_type(self, key):
+        if self.ecc is not None and isinstance(key, self.ecc.EccKey):
+            return _key_type("EC", self._ec_bits(key))
+        return "RSA"
+
+    def verify(self, key, signature, data, digest):
+        hash_obj = self.hashes[digest].new(data)
+        if self.key_type(key) == "RSA":
+            try:
+                return bool(self.pkcs1.new(key).verify(hash_obj, signature))
+            except ValueError:
+                return False
+        signature = ecdsa_der_signature(signature, self._ec_bits(key))
+        try:
+            self.dss.new(key, 'fips-186-3', encoding='der').verify(hash_obj, signature)
+        except ValueError:
+            return False
+        return True
+
+
+class SignatureRegistry(object):
+    '''Hash algorithms accepted per signature version and key type.
+
+    Signed CLI output names its signature version; the SUDI key type then
+    selects RSA or ECDSA and the hashes to try. PnP responses name the
+    encryption and hashing method directly.'''
+
+    # PnP deviceAuth encryption-method -> key types it may be used with
+    PNP_METHODS = {"RSA": ("RSA",), "ECDSA": ("EC-P256", "EC-P384", "EC-P521")}
+    PNP_HASHES = ("sha256", "sha384", "sha512")
+
+    def __init__(self):
+        self.schemes = {}
+
+    def register(self, version, key_type, hashes):
+        '''Accept signatures of a version made with key_type over hashes
+        (tried in order).'''
+        self.schemes[(int(version), key_type)] = tuple(hashes)
+
+    def hashes(self, version, key_type):
+        '''Hashes to try for a signature version and key type.'''
+        scheme = self.schemes.get((int(version), key_type))
+        if scheme is None:
+            raise ValueError("Unsupported signature version {0} for {1} keys".format(
+                version, key_type))
+        return scheme
+
+    def verify(self, version, key, signature, data, backend=None):
+        '''Verify a versioned signature, returns True or False.
+
+        - version (int or str): signature version reported by the device
+        - key: handle from ``backend.load_certificate``'''
+        backend = get_backend() if backend is None else backend
+        for digest in self.hashes(version, backend.key_type(key)):
+            if backend.verify(key, signature, data, digest):
+                return True
+        return False
+
+    def pnp_digest(self, key_type, enc_method, hash_method):
+        '''Check a PnP response's methods against the SUDI key and return
+        the hash name to verify with.'''
+        digest = hash_method.strip().lower()
+        assert key_type in self.PNP_METHODS.get(enc_method.strip().upper(), ()), \
+            "Encryption method {0} does not match a {1} SUDI key".format(enc_method, key_type)
+        assert digest in self.PNP_HASHES, "Unsupported hashing method {0}".format(hash_method)
+        return digest
+
+
+SIGNATURES = SignatureRegistry()
+# version 1: RSA-2048 signed with SHA256 (older images SHA1); the same data
+# layout signed by an ECDSA SUDI uses the curve's matching hash
+SIGNATURES.register(1, "RSA", ("sha256", "sha1"))
+SIGNATURES.register(1, "EC-P256", ("sha256",))
+SIGNATURES.register(1, "EC-P384", ("sha384",))
+SIGNATURES.register(1, "EC-P521", ("sha512",))
+
+
+# preference order when benchmarks are inconclusive
+BACKENDS = (OpenSSLBackend, PyCryptoBackend)
+
+_SELECTED = None
+_SELECT_LOCK = threading.Lock()
+BENCHMARK_RESULTS = {}
+
+
+def available_backends():
+    '''Instantiate every backend whose library imports.'''
+    backends = []
+    for backend_class in BACKENDS:
+        try:
+            backends.append(backend_class())
+        except ImportError:
+            continue
+    return backends
+
+
+def benchmark(backend, iterations=BENCHMARK_ITERATIONS, cert_pem=BENCHMARK_CERT_PEM):
+    '''Average seconds for one key import plus SHA256 verification.
+
+    The signature is not valid, so every iteration exercises the full
+    public key operation without needing a private key.'''
+    cert_der = binascii.a2b_base64(cert_pem)
+    data = "\x00" * 1024
+    key = backend.load_certificate(cert_der)
+    signature = "\x11" * backend.signature_size(key)
+    start = time.time()
+    for _ in range(iterations):
+        key = backend.load_certificate(cert_der)
+        backend.verify(key, signature, data, "sha256")
+    return (time.time() - start) / iterations
+
+
+def get_backend():
+    '''Return the selected backend, choosing it on first call.'''
+    global _SELECTED
+    with _SELECT_LOCK:
+        if _SELECTED is not None:
+            return _SELECTED
+
+        backends = available_backends()
+        assert backends, "No crypto backend available, install pyOpenSSL or pycrypto"
+
+        forced = os.environ.get(BACKEND_ENV)
+        if forced:
+            matches = [backend for backend in backends if backend.name == forced]
+            assert matches, "Crypto backend {0} is not available".format(forced)
+            _SELECTED = matches[0]
+        elif len(backends) == 1:
+            _SELECTED = backends[0]
+        else:
+            for backend in backends:
+                BENCHMARK_RESULTS[backend.name] = benchmark(backend)
+            _SELECTED = min(backends, key=lambda backend: BENCHMARK_RESULTS[backend.name])
+    return _SELECTED
+
+
+def benchmark_algorithms(backend, iterations=BENCHMARK_ITERATIONS):
+    '''Per key type benchmark: {key type: seconds or None if unsupported}.'''
+    results = {}
+    for key_type, cert_pem in BENCHMARK_CERTS:
+        try:
+            results[key_type] = benchmark(backend, iterations, cert_pem)
+        except Exception:
+            results[key_type] = None
+    return results
+
+
+if __name__ == "__main__":
+    for candidate in available_backends():
+        for name, seconds in sorted(benchmark_algorithms(candidate).items()):
+            if seconds is None:
+                print "%-10s %-8s unsupported" % (candidate.name, name)
+            else:
+                print "%-10s %-8s %8.1f us/verify" % (candidate.name, name, seconds * 1e6)
+    print "selected:", get_backend().name
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''NonceService Library
+
+Nonces and PnP correlators drawn in bulk from the operating system CSPRNG
+(``os.urandom``), plus a time-windowed index of issued nonces so that stale
+or replayed evidence can be rejected in constant time.'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import time
+import string
+import struct
+import threading
+from collections import deque
+
+# Largest nonce the ``show platform ... nonce`` commands accept is a 64-bit
+# value, so 19 decimal digits is the longest nonce that always fits.
+NONCE_DIGITS = 19
+NONCE_BATCH = 256
+POOL_BYTES = 4096
+TOKEN_CHARS = string.ascii_uppercase + string.digits
+DEFAULT_WINDOW = 3600
+
+NONCE_OK = "ok"
+NONCE_UNKNOWN = "unknown"
+NONCE_STALE = "stale"
+NONCE_REPLAYED = "replayed"
+
+
+class ReplayIndex(object):
+    '''Time-windowed index of issued nonces.
+
+    Every nonce is recorded when issued and may be consumed once per kind of
+    evidence (for example once for ``sudi`` and once for ``integrity``, which
+    are signed over the same nonce). Lookups and updates are O(1); entries
+    older than the window are purged in issue order.
+
+    - window (int): seconds a nonce stays valid after being issued
+    - path (str): optional journal file; existing entries are loaded and new
+        ones appended so the index survives across processes'''
+
+    def __init__(self, window=DEFAULT_WINDOW, path=None):
+        self.window = window
+        self.path = path
+        self.issued = {}
+        self.consumed = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self._load(path)
+
+    @staticmethod
+    def key(nonce):
+        '''Canonical index key: numeric nonces without leading zeros,
+        anything else (correlators, challenge phrases) as is.'''
+        nonce = str(nonce).strip()
+        return str(int(nonce)) if nonce.isdigit() else nonce
+
+    def _load(self, path):
+        '''Replay a journal file into the index.'''
+        with open(path, 'r') as journal:
+            for line in journal:
+                fields = line.split()
+                if len(fields) == 3 and fields[0] == "I":
+                    self._issue(fields[1], float(fields[2]))
+                elif len(fields) == 4 and fields[0] == "C":
+                    self.consumed.setdefault(fields[2], set()).add(fields[1])
+        self._expire(time.time())
+
+    def _journal(self, line):
+        '''Append a line to the journal file, if there is one.'''
+        if self.path is not None:
+            with open(self.path, 'a') as journal:
+                journal.write(line + "\n")
+
+    def _issue(self, key, now):
+        self.issued[key] = now
+        self.order.append((now, key))
+
+    def _expire(self, now):
+        '''Drop entries issued before the window.'''
+        cutoff = now - self.window
+        while self.order and self.order[0][0] < cutoff:
+            issued_at, key = self.order.popleft()
+            if self.issued.get(key) == issued_at:
+                del self.issued[key]
+                self.consumed.pop(key, None)
+
+    def issue(self, nonce, now=None):
+        '''Record a freshly issued nonce.'''
+        now = time.time() if now is None else now
+        key = self.key(nonce)
+        with self.lock:
+            self._expire(now)
+            self._issue(key, now)
+            self._journal("I %s %.3f" % (key, now))
+
+    def check(self, nonce, kind, now=None, consume=True):
+        '''Consume a nonce for one kind of evidence.
+
+        Pass ``consume=False`` to only check that the nonce would be
+        accepted, and consume it once the evidence signature verifies, so
+        that a forged capture carrying a valid nonce cannot burn it.
+
+        - nonce (str): nonce the evidence claims to be signed over
+        - kind (str): evidence kind, e.g. ``sudi`` or ``integrity``
+        - consume (bool): mark the nonce used for this kind
+        - returns: ``NONCE_OK`` or the reason the nonce is rejected'''
+        now = time.time() if now is None else now
+        key = self.key(nonce)
+        with self.lock:
+            issued_at = self.issued.get(key)
+            if issued_at is None:
+                return NONCE_UNKNOWN
+            if issued_at < now - self.window:
+                return NONCE_STALE
+            if kind in self.consumed.get(key, ()):
+                return NONCE_REPLAYED
+            if not consume:
+                return NONCE_OK
+            self.consumed.setdefault(key, set()).add(kind)
+            self._journal("C %s %s %.3f" % (kind, key, now))
+        return NONCE_OK
+
+
+class NonceService(object):
+    '''Hands out nonces and random tokens from precomputed CSPRNG pools.
+
+    Random bytes are read from ``os.urandom`` in bulk and nonces are unpacked
+    a batch at a time, so the per-call cost is a pop from a list. Every nonce
+    handed out is recorded in the replay index.
+
+    - index (ReplayIndex): index to record issued nonces in
+    - pool_bytes (int): size of each bulk read from ``os.urandom``'''
+
+    def __init__(self, index=None, pool_bytes=POOL_BYTES):
+        self.index = ReplayIndex() if index is None else index
+        self.pool_bytes = pool_bytes
+        self.pool = ""
+        self.pool_pos = 0
+        self.nonces = []
+        self.lock = threading.Lock()
+
+    def _take(self, count):
+        '''Take count random bytes from the pool, refilling in bulk.'''
+        if self.pool_pos + count > len(self.pool):
+            self.pool = os.urandom(max(self.pool_bytes, count))
+            self.pool_pos = 0
+        chunk = self.pool[self.pool_pos:self.pool_pos + count]
+        self.pool_pos += count
+        return chunk
+
+    def _refill_nonces(self):
+        '''Unpack a batch of uniformly distributed 19 digit nonces.'''
+        limit = 10 ** NONCE_DIGITS
+        # reject the top of the 64-bit range so "value % limit" stays uniform
+        ceiling = (2 ** 64 // limit) * limit
+        values = struct.unpack(">%dQ" % NONCE_BATCH, self._take(8 * NONCE_BATCH))
+        self.nonces = ["%0*d" % (NONCE_DIGITS, value % limit)
+                       for value in values if value < ceiling]
+
+    def nonce(self, size=NONCE_DIGITS):
+        '''Return a new decimal nonce string of up to 19 digits.'''
+        assert 0 < size <= NONCE_DIGITS, "nonce size must be 1 to %d digits" % NONCE_DIGITS
+        with self.lock:
+            if not self.nonces:
+                self._refill_nonces()
+            nonce = self.nonces.pop()[NONCE_DIGITS - size:]
+        self.index.issue(nonce)
+        return nonce
+
+    def token(self, size=32, chars=TOKEN_CHARS):
+        '''Return a random string (PnP correlator or challenge phrase).'''
+        # reject bytes above the largest multiple of len(chars) for uniformity
+        ceiling = 256 - 256 % len(chars)
+        out = []
+        with self.lock:
+            while len(out) < size:
+                for byte in bytearray(self._take(size * 2)):
+                    if byte < ceiling:
+                        out.append(chars[byte % len(chars)])
+                        if len(out) == size:
+                            break
+        token = "".join(out)
+        self.index.issue(token)
+        return token
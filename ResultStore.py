@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''ResultStore Library
+
+Content-addressed store of verification results for archived SUDI/SPI
+captures. A result is keyed by the SHA256 of the nonce and canonical capture
+text and by the trust version (the verification rules plus the trust
+bundle), so re-auditing an archive only re-verifies captures whose evidence
+or trust material changed. Captures are read from a directory or straight
+from tar, zip and gzip archives and verified by a pool of threads while the
+archive is still being decompressed.'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import time
+import Queue
+import sqlite3
+import hashlib
+import threading
+import CryptoBackend
+import CaptureArchive
+from VerifySignature import verify_show_platform_sudi
+from VerifySignature import verify_show_platform_integrity
+from VerifySignature import der_certificates
+
+# bump when verification rules change in a way that must invalidate results
+# (2: the evidence digest covers the nonces)
+RESULTS_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    evidence TEXT NOT NULL,
+    trust TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    detail TEXT,
+    verified_at REAL NOT NULL,
+    PRIMARY KEY (evidence, trust)
+);
+CREATE TABLE IF NOT EXISTS nonces (
+    host TEXT NOT NULL,
+    nonce TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (host, nonce, kind)
+);
+"""
+
+# verification threads and captures read ahead of them
+AUDIT_WORKERS = 4
+READ_AHEAD = 64
+
+
+def canonical_evidence(text):
+    '''Canonical form of a capture: unified line endings, no trailing
+    whitespace and no blank lines, so re-saved copies hash the same.'''
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines if line.strip()) + '\n'
+
+
+def evidence_digest(*captures):
+    '''SHA256 over the nonce and canonical body of one or more
+    (nonce, body) captures. The signatures cover the nonce, so the same
+    body under another nonce is different evidence.'''
+    digest = hashlib.sha256()
+    for nonce, text in captures:
+        digest.update("nonce %s\n" % nonce)
+        canonical = canonical_evidence(text)
+        digest.update("%d\n" % len(canonical))
+        digest.update(canonical)
+    return digest.hexdigest()
+
+
+def load_trust_bundle(path):
+    '''DER certificates of a PEM trust bundle file.'''
+    with open(path, 'r') as bundle:
+        return der_certificates(bundle.read())
+
+
+def trust_version(anchors=(), revocation=None):
+    '''Digest of everything a result depends on besides the evidence:
+    the results version, the registered signature schemes, the trust
+    anchors and the revocation list.'''
+    digest = hashlib.sha256("results v%d\n" % RESULTS_VERSION)
+    for (version, key_type), hashes in sorted(CryptoBackend.SIGNATURES.schemes.items()):
+        digest.update("%d %s %s\n" % (version, key_type, ",".join(hashes)))
+    for anchor in sorted(hashlib.sha256(der).hexdigest() for der in anchors):
+        digest.update(anchor + "\n")
+    if revocation is not None:
+        digest.update("revoked %s\n" % revocation.version)
+    return digest.hexdigest()
+
+
+class ResultStore(object):
+    '''SQLite file of results keyed by (evidence digest, trust version).
+    Safe to share between threads.
+
+    - path (str): database file, created if missing'''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    def get(self, evidence, trust):
+        '''Stored (passed, detail) for the key, or None.'''
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT passed, detail FROM results WHERE evidence = ? AND trust = ?",
+                (evidence, trust)).fetchone()
+        return None if row is None else (bool(row[0]), row[1])
+
+    def put(self, evidence, trust, kind, passed, detail):
+        '''Store a result.'''
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                              (evidence, trust, kind, int(bool(passed)), detail, time.time()))
+
+    def claim(self, host, nonce, kind, name):
+        '''Record that capture name used a host's nonce for one kind of
+        evidence. Returns the name of the capture holding the nonce: name
+        itself, or the capture that used it first.'''
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO nonces VALUES (?, ?, ?, ?)",
+                              (str(host), str(nonce), kind, name))
+            return self.conn.execute(
+                "SELECT name FROM nonces WHERE host = ? AND nonce = ? AND kind = ?",
+                (str(host), str(nonce), kind)).fetchone()[0]
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+def read_capture(path):
+    '''Return (kind, nonce, body) of a capture file, kind ``sudi``,
+    ``integrity`` or None when the first line is not a known command.'''
+    with open(path, 'r') as capture:
+        return CaptureArchive.parse_capture(capture.read())
+
+
+def find_captures(root):
+    '''Pair the captures under root.
+
+    An integrity capture is paired with the SUDI capture in the same
+    directory that has the same nonce. A nonce used by more than one
+    SUDI or more than one integrity capture of a directory is a replay,
+    and those SUDI captures are not paired. Returns a sorted list of
+    (sudi_path, spi_path or None, problem or None).'''
+    pairs = []
+    for dirpath, _, filenames in os.walk(root):
+        sudi = {}
+        integrity = {}
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                with open(path, 'r') as capture:
+                    header = capture.readline(4096)
+            except IOError:
+                continue
+            kind, nonce, _ = CaptureArchive.parse_capture(header)
+            if kind == "sudi":
+                sudi.setdefault(nonce, []).append(path)
+            elif kind == "integrity":
+                integrity.setdefault(nonce, []).append(path)
+        for nonce, paths in sudi.items():
+            spi_paths = integrity.get(nonce, [])
+            if len(paths) > 1 or len(spi_paths) > 1:
+                problem = "nonce %s used by %d captures" % (nonce, len(paths) + len(spi_paths))
+                pairs.extend((path, None, problem) for path in paths)
+            else:
+                pairs.append((paths[0], spi_paths[0] if spi_paths else None, None))
+    return sorted(pairs)
+
+
+def verify_capture(sudi_nonce, sudi_body, anchors=(), spi_nonce=None, spi_body=None,
+                   revocation=None):
+    '''Verify a SUDI capture and its integrity capture, if any.
+
+    Returns (passed, detail).'''
+    try:
+        if not verify_show_platform_sudi(nonce=sudi_nonce, output=sudi_body,
+                                         revocation=revocation):
+            return False, "identity signature invalid"
+    except Exception as err:
+        return False, "identity: %s" % err
+
+    if anchors:
+        certs = der_certificates(sudi_body)
+        if not certs or certs[0] not in anchors:
+            return False, "root certificate not in trust bundle"
+
+    if spi_body is not None:
+        try:
+            if not verify_show_platform_integrity(nonce=spi_nonce, output=spi_body,
+                                                  show_sudi_cert=sudi_body):
+                return False, "integrity signature invalid"
+        except Exception as err:
+            return False, "integrity: %s" % err
+    return True, None
+
+
+def check_capture(store, trust, anchors, sudi_nonce, sudi_body, spi_nonce=None, spi_body=None,
+                  revocation=None):
+    '''Stored result of a capture (pair) for the trust version, verifying
+    and storing it when there is none.
+
+    Returns (cached, passed, detail).'''
+    if spi_body is not None:
+        evidence = evidence_digest((sudi_nonce, sudi_body), (spi_nonce, spi_body))
+    else:
+        evidence = evidence_digest((sudi_nonce, sudi_body))
+
+    result = store.get(evidence, trust)
+    if result is not None:
+        return (True,) + tuple(result)
+    passed, detail = verify_capture(sudi_nonce, sudi_body, anchors, spi_nonce, spi_body,
+                                    revocation)
+    store.put(evidence, trust, "integrity" if spi_body is not None else "sudi", passed, detail)
+    return False, passed, detail
+
+
+def _directory_pairs(pairs):
+    '''Read the capture files of find_captures() pairs.'''
+    for sudi_path, spi_path, problem in pairs:
+        if problem is not None:
+            yield sudi_path, None, None, None, None, problem
+            continue
+        _, sudi_nonce, sudi_body = read_capture(sudi_path)
+        spi_nonce = spi_body = None
+        if spi_path is not None:
+            _, spi_nonce, spi_body = read_capture(spi_path)
+        yield sudi_path, sudi_nonce, sudi_body, spi_nonce, spi_body, None
+
+
+def audit(source, store, anchors=(), progress=None, workers=AUDIT_WORKERS, revocation=None):
+    '''(Re-)audit every capture of a directory or archive.
+
+    Captures whose result is stored for the same evidence and trust
+    version are not verified again, captures reusing a nonce fail without
+    being verified. One thread reads (and decompresses)
+    the captures while workers threads verify them.
+
+    - source (str): capture directory, tar, zip or gzip file, or ``-``
+        for a tar stream on stdin
+    - store (ResultStore): result store
+    - anchors (list): DER trust anchors, empty to skip the anchor check
+    - progress (callable): called as progress(done, total, name, cached,
+        passed, detail) after each capture; total is None for archives
+    - workers (int): verification threads
+    - revocation (RevocationIndex.RevocationIndex): revoked SUDI
+        certificates, None to skip the revocation check
+    - returns: dict of counts (total, cached, verified, passed, failed)'''
+    trust = trust_version(anchors, revocation)
+    anchors = set(anchors)
+    if os.path.isdir(source):
+        found = find_captures(source)
+        total = len(found)
+        pairs = _directory_pairs(found)
+    else:
+        total = None
+        pairs = CaptureArchive.capture_pairs(source)
+
+    counts = dict(total=0, cached=0, verified=0, passed=0, failed=0)
+    lock = threading.Lock()
+    work = Queue.Queue(READ_AHEAD)
+
+    def verify_worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            name, sudi_nonce, sudi_body, spi_nonce, spi_body, problem = item
+            if problem is not None:
+                cached, passed, detail = False, False, problem
+            else:
+                cached, passed, detail = check_capture(store, trust, anchors, sudi_nonce,
+                                                       sudi_body, spi_nonce, spi_body, revocation)
+            with lock:
+                counts['total'] += 1
+                counts['cached' if cached else 'verified'] += 1
+                counts['passed' if passed else 'failed'] += 1
+                if not cached and counts['verified'] % 100 == 0:
+                    store.commit()
+                if progress is not None:
+                    progress(counts['total'], total, name, cached, passed, detail)
+
+    threads = [threading.Thread(target=verify_worker) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in pairs:
+            work.put(item)
+    finally:
+        # a broken archive still leaves what was verified stored
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        store.commit()
+    return counts
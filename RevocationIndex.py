@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2016, 2017 Cisco Systems, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''RevocationIndex Library
+
+Check SUDI certificates against a local list of revoked, RMA'd or stolen
+devices. The list (one SUDI serial number or SHA256 certificate fingerprint
+per line) is compiled into an index file holding a Bloom filter and a
+sorted table of entry digests. The file is memory-mapped: a certificate
+that is not revoked costs a handful of Bloom filter probes, and only a
+filter hit is confirmed against the exact table, so checking a device is
+O(1) no matter how many millions of entries the list has.
+
+    python RevocationIndex.py build REVOKED_LIST INDEX_FILE
+    python RevocationIndex.py check INDEX_FILE (SERIAL | FINGERPRINT | CERT_FILE)'''
+
+__copyright__ = "2016, 2017 Cisco Systems, Inc."
+__license__ = "Apache License, Version 2.0"
+__author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
+
+import os
+import re
+import sys
+import math
+import mmap
+import struct
+import hashlib
+
+INDEX_MAGIC = "BIVREVX1"
+INDEX_VERSION = 1
+# magic, version, hash count, filter bits, entries, table offset, table digest
+HEADER = struct.Struct("<8sIIQQQ32s")
+DIGEST_BYTES = 20
+FALSE_POSITIVE_RATE = 1e-4
+
+FINGERPRINT_PAT = re.compile(r'^(?:fp:)?([0-9A-Fa-f]{64})$')
+# DER encoded OID 2.5.4.5 (serialNumber), the subject attribute holding
+# "PID:... SN:..." in SUDI certificates
+SERIAL_NUMBER_OID = "\x06\x03\x55\x04\x05"
+
+
+def entry_key(line):
+    '''Normalized key of a list entry: ``fp:<sha256>`` for a certificate
+    fingerprint, ``sn:<serial>`` for a SUDI serial number, None for blank
+    and comment lines.'''
+    value = line.split("#", 1)[0].strip()
+    if not value:
+        return None
+    match = FINGERPRINT_PAT.match(value.replace(":", "") if len(value) == 95 else value)
+    if match:
+        return "fp:" + match.group(1).upper()
+    if value.lower().startswith("sn:"):
+        value = value[3:]
+    return "sn:" + value.strip().upper()
+
+
+def sudi_serial(cert_der):
+    '''SUDI serial number (the SN: part of the subject serialNumber) of a
+    DER certificate, or None.'''
+    found = None
+    pos = cert_der.find(SERIAL_NUMBER_OID)
+    while pos != -1:
+        start = pos + len(SERIAL_NUMBER_OID) + 2
+        length = ord(cert_der[start - 1]) if start <= len(cert_der) else 0
+        if length & 0x80:
+            count = length & 0x7f
+            length = 0
+            for byte in cert_der[start:start + count]:
+                length = (length << 8) | ord(byte)
+            start += count
+        value = cert_der[start:start + length]
+        serial = value.split("SN:", 1)[1].split() if "SN:" in value else None
+        if serial:
+            # the subject follows the issuer, keep the last match
+            found = serial[0]
+        pos = cert_der.find(SERIAL_NUMBER_OID, pos + 1)
+    return found
+
+
+def certificate_keys(cert_der):
+    '''Keys a SUDI certificate is revoked under: its fingerprint and, if
+    it has one, its SUDI serial number.'''
+    keys = ["fp:" + hashlib.sha256(cert_der).hexdigest().upper()]
+    serial = sudi_serial(cert_der)
+    if serial:
+        keys.append("sn:" + serial.upper())
+    return keys
+
+
+def _digest(key):
+    return hashlib.sha256(key).digest()[:DIGEST_BYTES]
+
+
+def _probes(digest, hashes, bits):
+    '''Filter bit positions of a digest (double hashing).'''
+    first, second = struct.unpack_from("<QQ", hashlib.sha256(digest).digest())
+    second |= 1
+    return [(first + idx * second) % bits for idx in range(hashes)]
+
+
+def build(list_path, index_path, false_positive_rate=FALSE_POSITIVE_RATE):
+    '''Compile a revocation list into an index file.
+
+    - list_path (str): one SUDI serial (optionally ``sn:``) or SHA256
+        fingerprint (hex, optionally ``fp:``) per line, ``#`` comments
+    - index_path (str): index file to write
+    - returns: number of distinct entries'''
+    digests = set()
+    with open(list_path, 'r') as list_file:
+        for line in list_file:
+            key = entry_key(line)
+            if key is not None:
+                digests.add(_digest(key))
+    digests = sorted(digests)
+
+    count = max(1, len(digests))
+    bits = max(64, int(math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2)))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(float(bits) / count * math.log(2))))
+    bloom = bytearray(bits // 8)
+    for digest in digests:
+        for bit in _probes(digest, hashes, bits):
+            bloom[bit >> 3] |= 1 << (bit & 7)
+
+    table = "".join(digests)
+    offset = HEADER.size + len(bloom)
+    with open(index_path + ".tmp", 'wb') as index_file:
+        index_file.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, hashes, bits, len(digests),
+                                     offset, hashlib.sha256(table).digest()))
+        index_file.write(bloom)
+        index_file.write(table)
+    os.rename(index_path + ".tmp", index_path)
+    return len(digests)
+
+
+class RevocationIndex(object):
+    '''Memory-mapped revocation index written by ``build``.
+
+    - path (str): index file'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as index_file:
+            self.map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        assert len(self.map) >= HEADER.size, "Revocation index {0} is truncated".format(path)
+        (magic, version, self.hashes, self.bits, self.entries, self.offset,
+         table_digest) = HEADER.unpack_from(self.map, 0)
+        assert magic == INDEX_MAGIC and version == INDEX_VERSION, \
+                "{0} is not a revocation index".format(path)
+        assert len(self.map) == self.offset + self.entries * DIGEST_BYTES, \
+                "Revocation index {0} is truncated".format(path)
+        # identifies the list in result store trust versions
+        self.version = table_digest.encode("hex")
+
+    def _in_filter(self, digest):
+        for bit in _probes(digest, self.hashes, self.bits):
+            if not ord(self.map[HEADER.size + (bit >> 3)]) & (1 << (bit & 7)):
+                return False
+        return True
+
+    def _in_table(self, digest):
+        low, high = 0, self.entries
+        while low < high:
+            mid = (low + high) // 2
+            start = self.offset + mid * DIGEST_BYTES
+            entry = self.map[start:start + DIGEST_BYTES]
+            if entry == digest:
+                return True
+            if entry < digest:
+                low = mid + 1
+            else:
+                high = mid
+        return False
+
+    def contains(self, key):
+        '''True if the normalized key (see ``entry_key``) is listed.'''
+        digest = _digest(key)
+        return self._in_filter(digest) and self._in_table(digest)
+
+    def revoked(self, cert_der):
+        '''The key a SUDI certificate is listed under, or None.'''
+        for key in certificate_keys(cert_der):
+            if self.contains(key):
+                return key
+        return None
+
+    def close(self):
+        self.map.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "build":
+        print "%d entries written to %s" % (build(sys.argv[2], sys.argv[3]), sys.argv[3])
+    elif len(sys.argv) == 4 and sys.argv[1] == "check":
+        INDEX = RevocationIndex(sys.argv[2])
+        if os.path.isfile(sys.argv[3]):
+            import VerifySignature
+            with open(sys.argv[3], 'r') as cert_file:
+                KEYS = [INDEX.revoked(der) for der in
+                        VerifySignature.der_certificates(cert_file.read())[-1:]]
+        else:
+            KEYS = [entry_key(sys.argv[3]) if INDEX.contains(entry_key(sys.argv[3])) else None]
+        print "REVOKED (%s)" % KEYS[0] if KEYS and KEYS[0] else "not revoked"
+        sys.exit(1 if KEYS and KEYS[0] else 0)
+    else:
+        print __doc__.split("\n\n")[-1]
+        sys.exit(2)
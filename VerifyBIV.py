@@ -23,7 +23,12 @@
 Verify Boot Integrity Visibility (BIV) of a system using the Secure Unique Identifier (SUDI).
 
 Usage:
- VerifyBIV.py -s SUDI_FILE [-i SPI_FILE]
+ VerifyBIV.py -s SUDI_FILE [-i SPI_FILE] [-n NONCE_INDEX] [-x REVOCATION_INDEX]
+ VerifyBIV.py --new-nonce NONCE_INDEX
+ VerifyBIV.py --audit ARCHIVE [-r RESULT_STORE] [-t TRUST_BUNDLE] [-w WORKERS]
+              [-x REVOCATION_INDEX]
+ VerifyBIV.py --watch DIRECTORY [-r RESULT_STORE] [-t TRUST_BUNDLE] [-w WORKERS]
+              [-x REVOCATION_INDEX]
  VerifyBIV.py -h | --help
  VerifyBIV.py --version
 
@@ -38,6 +43,34 @@ Options:
                                     output of
                                     "show platform integrity sign nonce XXXXX"
                                     including the cli cmd on the first line.
+ -n NONCE_INDEX, --nonce-index NONCE_INDEX
+                                    Reject captures whose nonce was not issued
+                                    with --new-nonce, has expired or was
+                                    already verified.
+ --new-nonce NONCE_INDEX            Print a fresh nonce to use in the show
+                                    commands and record it in NONCE_INDEX.
+ --audit ARCHIVE                    Verify the SUDI and integrity captures in
+                                    ARCHIVE, a directory, a tar, zip or gzip
+                                    file or - for a tar stream on stdin,
+                                    pairing them by directory and nonce.
+ --watch DIRECTORY                  Verify captures as they are written to
+                                    DIRECTORY, pairing SUDI and integrity
+                                    captures by host and nonce, until
+                                    interrupted.
+ -r RESULT_STORE, --results RESULT_STORE
+                                    Result store for --audit and --watch;
+                                    captures already verified with the same
+                                    trust material are not verified again.
+ -t TRUST_BUNDLE, --trust-bundle TRUST_BUNDLE
+                                    PEM file of trusted root certificates
+                                    for --audit and --watch.
+ -w WORKERS, --workers WORKERS      Verification threads for --audit and
+                                    for --watch [default: 4].
+ -x REVOCATION_INDEX, --revoked REVOCATION_INDEX
+                                    Fail SUDI certificates listed in
+                                    REVOCATION_INDEX, built from a list of
+                                    revoked serials or fingerprints with
+                                    "RevocationIndex.py build".
 """
 
 __copyright__ = "2016, 2017 Cisco Systems, Inc."
@@ -45,19 +78,27 @@ __license__ = "Apache License, Version 2.0"
 __author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
 
 import sys
+import gzip
+import time
 from docopt import docopt
 from VerifySignature import verify_show_platform_sudi
 from VerifySignature import verify_show_platform_integrity
+from NonceService import NonceService, ReplayIndex
+import ResultStore
+import CaptureWatch
+from RevocationIndex import RevocationIndex
 
 
 def get_contents(filename):
     """
-    Read file and return first line as header and rest as body.
+    Read file (gzip compressed if it ends in .gz) and return first line
+    as header and rest as body.
 
     Keyword arguments:
     filename -- path to file
     """
-    with open(filename, 'r') as sig_file:
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, 'r') as sig_file:
         header = sig_file.readline()
         body = sig_file.read()
 
@@ -140,6 +181,102 @@ def print_signature(signature):
             print "\t\t", line
 
 
+def audit_archive(archive, results, trust_bundle, workers=ResultStore.AUDIT_WORKERS,
+                  revocation=None):
+    """
+    Verify every capture pair in archive, reusing stored results
+    whose evidence and trust material are unchanged.
+    Print progress per capture and a summary.
+
+    Keyword arguments:
+    archive -- directory, tar, zip or gzip file of captured SUDI and SPI
+               output, or - for a tar stream on stdin
+    results -- path of the result store, or None to keep results in memory
+    trust_bundle -- PEM file of trusted roots, or None
+    workers -- verification threads
+    revocation -- RevocationIndex of revoked SUDI certificates, or None
+    """
+
+    anchors = ResultStore.load_trust_bundle(trust_bundle) if trust_bundle else []
+    store = ResultStore.ResultStore(results or ":memory:")
+
+    def progress(done, total, path, cached, passed, detail):
+        print "\t[%d/%s] %-9s %-10s %s%s" % (done, "?" if total is None else total,
+                                            "cached" if cached else "verified",
+                                            "SUCCESSFUL" if passed else "FAILED", path,
+                                            " (%s)" % detail if detail else "")
+
+    print "\nAuditing captures in %s...\n" % archive
+    try:
+        counts = ResultStore.audit(archive, store, anchors, progress, workers, revocation)
+    finally:
+        store.close()
+
+    print "\n\t%(total)d captures: %(verified)d verified, %(cached)d from the result store" % counts
+    print "\t%(passed)d SUCCESSFUL, %(failed)d FAILED\n" % counts
+    if counts['failed']:
+        sys.exit(-1)
+
+
+def print_latency(summary):
+    """
+    Print a latency summary of watch mode.
+
+    Keyword arguments:
+    summary -- CaptureWatch.LatencyStats.summary() value
+    """
+
+    if summary is None:
+        print "\tlatency: no captures verified yet"
+    else:
+        print "\tlatency over %d captures: p50 %.3fs  p90 %.3fs  p99 %.3fs  max %.3fs" % summary
+
+
+def watch_directory(directory, results, trust_bundle, workers=CaptureWatch.WATCH_WORKERS,
+                    revocation=None):
+    """
+    Verify captures as collectors write them to directory until
+    interrupted, printing each result with its end-to-end latency and
+    a latency summary every minute.
+
+    Keyword arguments:
+    directory -- directory the SUDI and SPI captures are written to
+    results -- path of the result store, or None to keep results in memory
+    trust_bundle -- PEM file of trusted roots, or None
+    workers -- verification threads
+    revocation -- RevocationIndex of revoked SUDI certificates, or None
+    """
+
+    anchors = ResultStore.load_trust_bundle(trust_bundle) if trust_bundle else []
+    store = ResultStore.ResultStore(results or ":memory:")
+
+    def emit(result):
+        print "\t%s %-9s %-10s %-9s %s %s nonce %s%s" % (
+            time.strftime("%H:%M:%S"), "%.3fs" % result['latency'],
+            "SUCCESSFUL" if result['passed'] else "FAILED",
+            "cached" if result['cached'] else "verified", result['name'],
+            result['host'] or "-", result['nonce'],
+            " (%s)" % result['detail'] if result['detail'] else "")
+        sys.stdout.flush()
+
+    print "\nWatching %s for captures, Ctrl-C to stop...\n" % directory
+    watch = CaptureWatch.CaptureWatch(directory, store, anchors, emit, workers,
+                                      revocation=revocation)
+    try:
+        watch.run(stats=print_latency)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.close()
+        store.close()
+
+    counts = watch.counts
+    print "\n\t%(total)d captures: %(verified)d verified, %(cached)d from the result store" % counts
+    print "\t%(passed)d SUCCESSFUL, %(failed)d FAILED" % counts
+    print_latency(watch.latency.summary())
+    print
+
+
 def main(args):
     """
     Verify identity and integrity of a system using the Secure Unique Identifier (SUDI).
@@ -149,9 +286,33 @@ def main(args):
     args -- provided commandline argurments
     """
 
+    # issue a nonce for a new capture
+    if args['--new-nonce'] is not None:
+        print NonceService(index=ReplayIndex(path=args['--new-nonce'])).nonce()
+        return
+
+    revocation = None
+    if args['--revoked'] is not None:
+        revocation = RevocationIndex(args['--revoked'])
+
+    # re-audit an archive of captures
+    if args['--audit'] is not None:
+        audit_archive(args['--audit'], args['--results'], args['--trust-bundle'],
+                      int(args['--workers']), revocation)
+        return
+
+    # verify captures as they are written to a directory
+    if args['--watch'] is not None:
+        watch_directory(args['--watch'], args['--results'], args['--trust-bundle'],
+                        int(args['--workers']), revocation)
+        return
+
     # read args
     sudi_file = args['--sudi']
     spi_file = args['--integrity']
+    nonce_index = None
+    if args['--nonce-index'] is not None:
+        nonce_index = ReplayIndex(path=args['--nonce-index'])
 
     print "\nGathering identity info...\n"
     header, body = get_contents(sudi_file)
@@ -166,7 +327,8 @@ def main(args):
     # verify identity
     print "\nVerifying platform identity signature..."
     try:
-        result = verify_show_platform_sudi(nonce=nonce, output=body)
+        result = verify_show_platform_sudi(nonce=nonce, output=body, nonce_index=nonce_index,
+                                           revocation=revocation)
     except BaseException as err:
         result = False
         print "\n\tVerify identity", str(err.__class__).split("'")[1::2][0] + ":"
@@ -196,7 +358,8 @@ def main(args):
         header, sudi = get_contents(sudi_file)
 
         try:
-            result = verify_show_platform_integrity(nonce=nonce, output=body, show_sudi_cert=sudi)
+            result = verify_show_platform_integrity(nonce=nonce, output=body, show_sudi_cert=sudi,
+                                                    nonce_index=nonce_index)
         except BaseException as err:
             result = False
             print "\n\tVerify Integrity", str(err.__class__).split("'")[1::2][0] + ":"
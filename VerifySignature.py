@@ -21,16 +21,18 @@ __author__ = ["James Aston", "Nicholas Brust", "Dwaine Gonyier", "others"]
 
 import binascii
 import re
+import sys
+import time
 import inspect
 import logging
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA256
-try:
-    from Crypto.Hash import SHA1
-except ImportError:
-    from Crypto.Hash import SHA as SHA1
-from Crypto.Util.asn1 import DerSequence
+import threading
+import CryptoBackend
+from NonceService import NONCE_OK
+
+# SUDI key handles kept by verifier_from_der
+VERIFIER_CACHE_SIZE = 4096
+_VERIFIERS = {}
+_VERIFIER_LOCK = threading.Lock()
 
 def _clean_eol(string):
     r'''Clean up embedded line endings in the supplied string to avoid later
@@ -78,32 +80,97 @@ def _int_str_to_binary(int_str, bit_size):
     return binascii.a2b_hex("{0:0{1}x}".format(int(int_str), int(bit_size) / 4))
 
 def verifier_from_pem_stack(sudi_certstack_raw):
-    '''Generate a verifier object from the supplied certificate PEM stack where
+    '''Generate a verifier key from the supplied certificate PEM stack where
     the last certificate in the stack should be the SUDI public certificate.
 
     - sudi_certstack_raw (str): The PEM stack returned by the\n``show platform
         sudi certificate``\nIOS command
-    '''
+    - returns: key handle for the selected ``CryptoBackend``'''
     logging.debug(
         "Entering %s with parameters %s",
         inspect.currentframe().f_code.co_name, locals())
 
     # convert certificate from PEM format to DER format for processing by
-    # pycrypto methods
-
-    sudi_pubcert_der = _pem_to_der(extract_sudi_pubcert(sudi_certstack_raw))
-
-    # get the public RSA key from the certificate
-    cert = DerSequence()
-    cert.decode(sudi_pubcert_der)
-    tbs_cert = DerSequence()
-    tbs_cert.decode(cert[0])
-    subj_pub_key_info = tbs_cert[6]
-    sudi_rsa_pubkey = RSA.importKey(subj_pub_key_info)
-
-    # generate a signature verification object from the RSA public key
-    sig_verifier = PKCS1_v1_5.new(sudi_rsa_pubkey)
-    return sig_verifier
+    # the crypto backend
+
+    return verifier_from_der(_pem_to_der(extract_sudi_pubcert(sudi_certstack_raw)))
+
+def verifier_from_der(sudi_pubcert_der):
+    '''Key handle for a SUDI certificate in DER format. Handles are cached
+    by certificate, so the SUDI and integrity signatures of a device (and
+    every later audit of it) load the key once.
+
+    - sudi_pubcert_der (str): the SUDI public certificate in DER format
+    - returns: key handle for the selected ``CryptoBackend``'''
+    with _VERIFIER_LOCK:
+        key = _VERIFIERS.get(sudi_pubcert_der)
+    if key is None:
+        key = CryptoBackend.get_backend().load_certificate(sudi_pubcert_der)
+        with _VERIFIER_LOCK:
+            if len(_VERIFIERS) >= VERIFIER_CACHE_SIZE:
+                _VERIFIERS.clear()
+            _VERIFIERS[sudi_pubcert_der] = key
+    return key
+
+
+def _verify_versioned(sig_verifier, sigver, sig_binary, data_binary):
+    '''Verify a signature with the algorithm registered for its signature
+    version and the SUDI key type (RSA or ECDSA).
+
+    - sig_verifier: key handle from ``verifier_from_pem_stack``
+    - sigver (str): signature version from the command output
+    - sig_binary (str): binary signature
+    - data_binary (str): signed data
+    - returns: True if the signature verifies'''
+    try:
+        return CryptoBackend.SIGNATURES.verify(int(sigver), sig_verifier, sig_binary, data_binary)
+    except ValueError as err:
+        raise AssertionError(str(err))
+
+PEM_BEGIN = "-----BEGIN CERTIFICATE-----"
+PEM_END = "-----END CERTIFICATE-----"
+_PEM_WHITESPACE = " \t\n\r\f\v"
+_PEM_BODY_CHARS = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789/+="
+                   + _PEM_WHITESPACE)
+
+def _scan_pem(raw_pem_stack):
+    '''Yield the base64 body of every certificate of a PEM stack in a single
+    pass over the input.
+
+    A certificate starts with a BEGIN line at the start of a line and
+    ends at the next END marker; bodies holding anything but base64 and
+    whitespace are skipped. Each END marker is searched for once and each
+    body is checked once, so the scan stays linear on truncated or
+    malformed input (missing END lines, long whitespace runs, repeated
+    BEGIN lines).'''
+    if isinstance(raw_pem_stack, unicode):
+        raw_pem_stack = raw_pem_stack.encode("ascii", "replace")
+    pos = 0
+    end = -1
+    while True:
+        begin = raw_pem_stack.find(PEM_BEGIN, pos)
+        if begin == -1:
+            return
+        pos = begin + len(PEM_BEGIN)
+        if begin > 0 and raw_pem_stack[begin - 1] not in "\r\n":
+            continue
+        if end < pos:
+            end = raw_pem_stack.find(PEM_END, pos)
+            if end == -1:
+                return
+        # a later BEGIN before the END marker puts '-' in this body
+        if raw_pem_stack.find(PEM_BEGIN, pos, end) != -1:
+            continue
+        body = raw_pem_stack[pos:end]
+        if (body[:1] not in _PEM_WHITESPACE or body[-1:] not in _PEM_WHITESPACE or
+                body.translate(None, _PEM_BODY_CHARS)):
+            continue
+        # as the regex did: leading whitespace dropped, all but the last
+        # whitespace character before the END marker kept
+        body = _clean_eol(body).lstrip(_PEM_WHITESPACE)[:-1]
+        pos = end + len(PEM_END)
+        if body.strip(_PEM_WHITESPACE):
+            yield body
 
 def extract_pem_cert_bodies(raw_pem_stack):
     '''Extract certificate bodies from input string containing PEM stack.
@@ -114,12 +181,18 @@ def extract_pem_cert_bodies(raw_pem_stack):
         "Entering %s with parameters %s",
         inspect.currentframe().f_code.co_name, locals())
 
-    pat = (
-        r'^-{5}BEGIN CERTIFICATE-{5}\s+'
-        r'([a-zA-Z0-9/+=\s]+)\s+'
-        r'-{5}END CERTIFICATE-{5}')
+    return list(_scan_pem(raw_pem_stack))
 
-    return list(re.findall(pat, _clean_eol(raw_pem_stack), re.M))
+def der_certificates(raw_pem_stack):
+    '''Certificates of a PEM stack in DER format, in stack order, decoded as
+    the stack is scanned.'''
+    ders = []
+    for body in _scan_pem(raw_pem_stack):
+        try:
+            ders.append(binascii.a2b_base64(body.translate(None, _PEM_WHITESPACE)))
+        except binascii.Error as err:
+            raise AssertionError("Malformed PEM certificate: {0}".format(err))
+    return ders
 
 def extract_sudi_pubcert(raw_pem_stack):
     '''Extract sudi public certificate body from input string containing PEM
@@ -136,14 +209,122 @@ def extract_sudi_pubcert(raw_pem_stack):
 
     return cert_pem_list[-1]
 
+def _check_nonce(nonce_index, nonce, kind, consume=False):
+    '''Check the nonce against the replay index, if one was supplied, and
+    fail on nonces that were never issued, have expired or were already used
+    for this kind of evidence. The nonce is only consumed with ``consume``,
+    once the evidence signature has verified.
+
+    - nonce_index (NonceService.ReplayIndex): index of issued nonces or None
+    - nonce (str): nonce integer as string or ``None``
+    - kind (str): ``sudi`` or ``integrity``
+    - consume (bool): mark the nonce used for this kind of evidence'''
+    if nonce_index is None:
+        return
+
+    assert nonce is not None, "Nonce required when checking for replayed evidence"
+    status = nonce_index.check(nonce, kind, consume=consume)
+    assert status == NONCE_OK, "Nonce {0} rejected: {1}".format(nonce, status)
+
+
+def _signed_prefix(nonce, sigver):
+    '''Nonce (64 bits, omitted when ``None``) and signature version (32
+    bits) that start the data signed by the device.'''
+    prefix = _int_str_to_binary(str(sigver), 32)
+    if nonce is not None:
+        prefix = _int_str_to_binary(str(nonce), 64) + prefix
+    return prefix
+
+def sudi_signed_data(nonce, sigver, der_certs):
+    '''Data signed in the ``show platform sudi certificate sign`` output:
+    nonce, signature version and the DER certificates of the stack.'''
+    return _signed_prefix(nonce, sigver) + ''.join(der_certs)
+
+def integrity_signed_data(nonce, sigver, pcr0, pcr8):
+    '''Data signed in the ``show platform integrity sign`` output: nonce,
+    signature version, PCR0 and PCR8.'''
+    return _signed_prefix(nonce, sigver) + binascii.a2b_hex(pcr0) + binascii.a2b_hex(pcr8)
+
+def verify_sudi_evidence(nonce, sigver, signature, der_certs, nonce_index=None,
+                         revocation=None):
+    '''Verification core for SUDI evidence, shared by
+    ``verify_show_platform_sudi`` and the device_validation CLI method.
+
+    - nonce (str): nonce integer as string or ``None`` type for no nonce
+    - sigver (str): signature version
+    - signature (str): signature in hex
+    - der_certs (list): root, manufacturing and SUDI certificates in DER
+    - nonce_index (NonceService.ReplayIndex): reject stale or replayed nonces
+    - revocation (RevocationIndex.RevocationIndex): reject revoked SUDI
+        certificates
+    - returns: True if the signature verifies, raises AssertionError when
+        the evidence is malformed, the nonce is rejected or the SUDI
+        certificate is revoked'''
+    _check_nonce(nonce_index, nonce, "sudi")
+
+    assert len(der_certs) > 0, "Did not find any PEM stack certificates"
+    assert len(der_certs) == 3, "Did not find three certificates in PEM stack"
+    if revocation is not None:
+        revoked = revocation.revoked(der_certs[-1])
+        assert revoked is None, "SUDI certificate is revoked ({0})".format(revoked)
+
+    verified = _verify_versioned(verifier_from_der(der_certs[-1]), sigver,
+                                 binascii.a2b_hex(signature),
+                                 sudi_signed_data(nonce, sigver, der_certs))
+    if verified:
+        _check_nonce(nonce_index, nonce, "sudi", consume=True)
+    return verified
+
+def verify_integrity_evidence(nonce, sigver, signature, pcr0, pcr8, boot0_hash,
+                              bootldr_hash, os_hashes, sudi_der, nonce_index=None):
+    '''Verification core for integrity evidence, shared by
+    ``verify_show_platform_integrity`` and the device_validation CLI method.
+
+    PCR0 and PCR8 are recomputed from the reported hashes before the
+    signature is checked.
+
+    - nonce (str): nonce integer as string or ``None`` type for no nonce
+    - sigver (str): signature version
+    - signature (str): signature in hex
+    - pcr0, pcr8 (str): reported PCR values in hex
+    - boot0_hash, bootldr_hash (str): reported boot hashes in hex
+    - os_hashes (list): reported OS hashes in hex
+    - sudi_der (str): the SUDI public certificate in DER format
+    - nonce_index (NonceService.ReplayIndex): reject stale or replayed nonces
+    - returns: True if the signature verifies, raises AssertionError when
+        the evidence is malformed, a PCR does not match or the nonce is
+        rejected'''
+    _check_nonce(nonce_index, nonce, "integrity")
+
+    assert boot0_hash, "Unable to find Boot 0 Hash pattern in output"
+    assert bootldr_hash, "Unable to find Boot Loader Hash pattern in output"
+    assert os_hashes, "Unable to find OS Hash pattern in output"
+
+    pcr0 = pcr0.upper()
+    pcr8 = pcr8.upper()
+    expected_pcr0 = get_expected_pcr_value([boot0_hash, bootldr_hash])
+    expected_pcr8 = get_expected_pcr_value(os_hashes)
+
+    assert expected_pcr0 == pcr0, \
+            "PCR0 does not match expected value of:\n{0}".format(expected_pcr0)
+    assert expected_pcr8 == pcr8, \
+            "PCR8 does not match expected value of:\n{0}".format(expected_pcr8)
+
+    verified = _verify_versioned(verifier_from_der(sudi_der), sigver,
+                                 binascii.a2b_hex(signature),
+                                 integrity_signed_data(nonce, sigver, pcr0, pcr8))
+    if verified:
+        _check_nonce(nonce_index, nonce, "integrity", consume=True)
+    return verified
 
 def verify_show_platform_sudi(**kwargs):
     '''Validate the signed output of the ``show platform sudi certificate sign
     (nonce ###)`` command.
 
     This keyword should be used when the complete output of the\n``show platform
-    sudi certificate sign (nonce ###)`` is avaiable. This keyword supports
-    *Signature version 1* command output.
+    sudi certificate sign (nonce ###)`` is avaiable. This keyword supports the
+    signature versions and RSA/ECDSA key types registered in
+    ``CryptoBackend.SIGNATURES`` (*Signature version 1*).
 
     The SUDI public certificate embedded in the output is used to verify the
     siganture in the output.
@@ -152,7 +333,13 @@ def verify_show_platform_sudi(**kwargs):
 
     - nonce (str): nonce integer as string or ``None`` type for no nonce
     - output (str): The complete output of the ``show platform sudi certificate``
-        IOS command as a string'''
+        IOS command as a string
+
+    Optional keyword arguments:
+
+    - nonce_index (NonceService.ReplayIndex): reject stale or replayed nonces
+    - revocation (RevocationIndex.RevocationIndex): reject revoked SUDI
+        certificates'''
     logging.debug(
         "Entering %s with parameters %s",
         inspect.currentframe().f_code.co_name, locals())
@@ -166,50 +353,18 @@ def verify_show_platform_sudi(**kwargs):
     output_ver1_pat = (
         r'Signature\s+version:\s+(?P<sigver>[0-9]+)\s+'
         r'Signature:\s+'
-        r'(?P<signature>[0-9A-F]{512})'
+        r'(?P<signature>[0-9A-F]+)'
         )
 
     # Parse output with sanity checks
 
-    cert_pem_body_list = extract_pem_cert_bodies(kwargs['output'])
-
-    assert cert_pem_body_list.__len__() > 0, "Did not find any PEM stack certificates"
-    assert cert_pem_body_list.__len__() == 3, "Did not find three certificates in PEM stack"
-
     match = re.search(output_ver1_pat, kwargs['output'], re.M)
     assert match is not None, \
-            "Unable to find Signature version 1 pattern in output"
-
-    # Build binary data for verification
-    sig_binary = binascii.a2b_hex(match.group('signature'))
-
-    if kwargs['nonce'] is not None:
-        nonce_binary = _int_str_to_binary(kwargs['nonce'], 64)
-    else:
-        nonce_binary = None
-
-    sigver_binary = _int_str_to_binary(match.group('sigver'), 32)
-
-    if nonce_binary is not None:
-        data_binary = nonce_binary + sigver_binary
-    else:
-        data_binary = sigver_binary
-
-    for pem_cert_item in cert_pem_body_list:
-        data_binary += _pem_to_der(pem_cert_item)
-    # Generate verifier object
-
-    sig_verifier = verifier_from_pem_stack(kwargs['output'])
-
-    # Verify binary data and return results
-
-    data_binary_hash = SHA256.new(data_binary)
-    data_binary_hash_old = SHA1.new(data_binary)
+            "Unable to find Signature version pattern in output"
 
-    # No easy way to determine hash algorithm from cert via Crypto library,
-    # so try both SHA256 and SHA1 hashes.
-    return sig_verifier.verify(data_binary_hash, sig_binary) or \
-            sig_verifier.verify(data_binary_hash_old, sig_binary)
+    return verify_sudi_evidence(kwargs['nonce'], match.group('sigver'),
+                                match.group('signature'), der_certificates(kwargs['output']),
+                                kwargs.get('nonce_index'), kwargs.get('revocation'))
 
 def get_expected_pcr_value(hash_list):
     '''Given a list of hash strings, calculate the expected PCR values
@@ -221,11 +376,12 @@ def get_expected_pcr_value(hash_list):
 
     pcr_init = "0000000000000000000000000000000000000000000000000000000000000000"
     pcr_bin = binascii.a2b_hex(pcr_init)
+    backend = CryptoBackend.get_backend()
     for hash_str in hash_list:
         hash_bin = binascii.a2b_hex(hash_str)
-        hash_sha256_bin = SHA256.new(hash_bin).digest()
+        hash_sha256_bin = backend.digest("sha256", hash_bin)
         #print "cur_256 " + binascii.b2a_hex(hash_sha256_bin)
-        pcr_bin = SHA256.new(pcr_bin + hash_sha256_bin).digest()
+        pcr_bin = backend.digest("sha256", pcr_bin + hash_sha256_bin)
         #print "cur_pcr " + binascii.b2a_hex(pcr_bin).upper()
 
     return binascii.b2a_hex(pcr_bin).upper()
@@ -236,8 +392,9 @@ def verify_show_platform_integrity(**kwargs):
     ###)`` command.
 
     This keyword should be used when the complete output of the\n``show platform
-    integrity sign (nonce ###)`` is avaiable. This keyword supports *Signature
-    version 1* command output.
+    integrity sign (nonce ###)`` is avaiable. This keyword supports the
+    signature versions and RSA/ECDSA key types registered in
+    ``CryptoBackend.SIGNATURES`` (*Signature version 1*).
 
     The output of the ``show platform sudi certificate`` is required since it
     contains the SUDI public certificate used to verify the signature.
@@ -248,7 +405,11 @@ def verify_show_platform_integrity(**kwargs):
     - output (str): The complete output of the ``show platform integrity sign
         (nonce ###)`` IOS command as a string
     - show_sudi_cert (str): the complete output of the ``show platform sudi
-        certificate`` IOS command as a string'''
+        certificate`` IOS command as a string
+
+    Optional keyword arguments:
+
+    - nonce_index (NonceService.ReplayIndex): reject stale or replayed nonces'''
     logging.debug(
         "Entering %s with parameters %s",
         inspect.currentframe().f_code.co_name, locals())
@@ -265,7 +426,7 @@ def verify_show_platform_integrity(**kwargs):
         r'PCR8:\s+(?P<pcr8>[0-9A-F]{64})\s+'
         r'Signature\s+version:\s+(?P<sigver>[0-9]+)\s+'
         r'Signature:\s+'
-        r'(?P<signature>[0-9A-F]{512})'
+        r'(?P<signature>[0-9A-F]+)'
         )
 
     hash_dict = {
@@ -276,27 +437,21 @@ def verify_show_platform_integrity(**kwargs):
 
     # Parse output with sanity checks
 
-    cert_pem_body_list = extract_pem_cert_bodies(kwargs['show_sudi_cert'])
+    cert_ders = der_certificates(kwargs['show_sudi_cert'])
 
-    assert cert_pem_body_list.__len__() > 0, "Did not find any PEM stack certificates " + \
+    assert cert_ders.__len__() > 0, "Did not find any PEM stack certificates " + \
                 "from show_sudi_cert value"
-    assert cert_pem_body_list.__len__() == 3, "Did not find three certificates PEM in stack " +\
+    assert cert_ders.__len__() == 3, "Did not find three certificates PEM in stack " +\
                 "from show_sudi_cert value"
 
     match = re.search(output_ver1_pat, kwargs['output'], re.M)
     assert match is not None, \
-            "Unable to find PCR registers and Signature version 1 pattern in output"
+            "Unable to find PCR registers and Signature version pattern in output"
 
     hash_dict['match_boot0_hash'] = re.search(
         hash_dict['output_ver1_boot0_hash_pat'], kwargs['output'], re.M)
-    assert hash_dict['match_boot0_hash'] is not None, \
-            "Unable to find Boot 0 Hash pattern in output"
-
     hash_dict['match_bootldr_hash'] = re.search(
         hash_dict['output_ver1_bootldr_hash_pat'], kwargs['output'], re.M)
-    assert hash_dict['match_bootldr_hash'] is not None, \
-            "Unable to find Boot Loader Hash pattern in output"
-
     hash_dict['match_os_hash'] = re.search(
         hash_dict['output_ver1_os_hash_pat'], kwargs['output'], re.M)
 
@@ -314,60 +469,65 @@ def verify_show_platform_integrity(**kwargs):
     else:
         os_hashes = [hash_dict['match_os_hash'].group('oshash')]
 
-    assert os_hashes is not None, \
-            "Unable to find OS Hash pattern in output"
-
-    # Build binary data for verification
-    sig_binary = binascii.a2b_hex(match.group('signature'))
-
-    if kwargs['nonce'] is not None:
-        nonce_binary = _int_str_to_binary(kwargs['nonce'], 64)
-    else:
-        nonce_binary = None
-
-    sigver_binary = _int_str_to_binary(match.group('sigver'), 32)
-
-    if nonce_binary is not None:
-        data_binary = nonce_binary + sigver_binary
-    else:
-        data_binary = sigver_binary
-
-    expected_pcr0 = get_expected_pcr_value([
-        hash_dict['match_boot0_hash'].group('boot0hash'),
-        hash_dict['match_bootldr_hash'].group('bootldrhash')])
-
-    expected_pcr8 = get_expected_pcr_value(os_hashes)
-
-    assert expected_pcr0 == match.group('pcr0'), \
-            "PCR0 does not match expected value of:\n{0}".format(expected_pcr0)
-    assert expected_pcr8 == match.group('pcr8'), \
-            "PCR8 does not match expected value of:\n{0}".format(expected_pcr8)
-
-    #print "expected_pcr0:  " + expected_pcr0
-    #print "expected_pcr8:  " + expected_pcr8
-
-    # PCR register hashes
-    pcr0_binary = binascii.a2b_hex(match.group('pcr0'))
-    pcr8_binary = binascii.a2b_hex(match.group('pcr8'))
-
-    if nonce_binary is not None:
-        data_binary = nonce_binary + sigver_binary + pcr0_binary + pcr8_binary
-    else:
-        data_binary = sigver_binary + pcr0_binary + pcr8_binary
-
-    # Generate verifier object
-
-    sig_verifier = verifier_from_pem_stack(kwargs['show_sudi_cert'])
-
-    # Verify binary data and return results
-
-    data_binary_hash = SHA256.new(data_binary)
-    data_binary_hash_old = SHA1.new(data_binary)
-
-    # No easy way to determine hash algorithm from cert via Crypto library,
-    # so try both SHA256 and SHA1 hashes.
-    return sig_verifier.verify(data_binary_hash, sig_binary) or \
-            sig_verifier.verify(data_binary_hash_old, sig_binary)
+    boot0_hash = None
+    if hash_dict['match_boot0_hash'] is not None:
+        boot0_hash = hash_dict['match_boot0_hash'].group('boot0hash')
+    bootldr_hash = None
+    if hash_dict['match_bootldr_hash'] is not None:
+        bootldr_hash = hash_dict['match_bootldr_hash'].group('bootldrhash')
+
+    # Recompute the PCRs and verify the signature
+
+    return verify_integrity_evidence(
+        kwargs['nonce'], match.group('sigver'), match.group('signature'),
+        match.group('pcr0'), match.group('pcr8'), boot0_hash, bootldr_hash, os_hashes,
+        cert_ders[-1], kwargs.get('nonce_index'))
+
+# regex extract_pem_cert_bodies used before _scan_pem, kept for the benchmark
+LEGACY_PEM_PAT = re.compile(
+    r'^-{5}BEGIN CERTIFICATE-{5}\s+'
+    r'([a-zA-Z0-9/+=\s]+)\s+'
+    r'-{5}END CERTIFICATE-{5}', re.M)
+# the regex backtracks cubically on whitespace runs, beyond this it takes minutes
+LEGACY_MAX_BYTES = 1024
+
+def adversarial_pem_inputs(size):
+    '''Malformed device output of about size bytes that defeats naive PEM
+    matching: (name, text) pairs.'''
+    begin = PEM_BEGIN + "\n"
+    return [
+        ("whitespace run, no END", begin + " " * size),
+        ("body lines, no END", begin + "QUJD\n" * (size // 5)),
+        ("mixed whitespace, no END", begin + "A \r\n" * (size // 4)),
+        ("repeated BEGIN lines", begin * (size // len(begin))),
+        ("bad character before END", begin + "A" * size + "!\n" + PEM_END + "\n"),
+        ("repeated BEGIN, one END", begin * (size // len(begin)) + PEM_END + "\n"),
+    ]
+
+def benchmark_pem_scan(sizes=(256, 1024, 65536, 1024 * 1024)):
+    '''Worst case seconds of the scanner and of the legacy regex on the
+    adversarial inputs: [(input name, size, scanner, regex or None)].
+    The regex is only run up to LEGACY_MAX_BYTES.'''
+    results = []
+    for size in sizes:
+        for name, text in adversarial_pem_inputs(size):
+            start = time.time()
+            der_certificates(text)
+            scanned = time.time() - start
+            legacy = None
+            if size <= LEGACY_MAX_BYTES:
+                start = time.time()
+                LEGACY_PEM_PAT.findall(_clean_eol(text))
+                legacy = time.time() - start
+            results.append((name, size, scanned, legacy))
+    return results
 
 if __name__ == "__main__":
-    print "Successful compile"
+    if sys.argv[1:] == ["--pem-benchmark"]:
+        print "%-28s %8s %12s %12s" % ("input", "bytes", "scanner", "regex")
+        for name, size, scanned, legacy in benchmark_pem_scan():
+            print "%-28s %8d %10.3fms %12s" % (
+                name, size, scanned * 1e3,
+                "%10.3fms" % (legacy * 1e3) if legacy is not None else "skipped")
+    else:
+        print "Successful compile"
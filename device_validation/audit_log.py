@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Append-only, tamper-evident audit log of verification results.
+Result records are written one JSON line each and sealed in
+batches into Merkle trees (RFC 6962 hashing); each batch line
+carries the tree root and the previous batch's root, so editing,
+dropping or reordering any record changes every later root.
+Inclusion of a single record is proven with O(log n) hashes.
+
+   ./audit_log.py verify audit.log
+   ./audit_log.py prove audit.log <ip address>
+"""
+###############################################
+#
+# File Name: audit_log.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import sys
+import json
+import time
+import hashlib
+import binascii
+import threading
+
+BATCH_SIZE = 1024
+EMPTY_ROOT = "0" * 64
+
+
+def leaf_hash(line):
+    """
+    Merkle leaf hash of one record line
+    """
+
+    return hashlib.sha256("\x00" + line).digest()
+
+
+def node_hash(left, right):
+    """
+    Merkle interior node hash
+    """
+
+    return hashlib.sha256("\x01" + left + right).digest()
+
+
+def _split(count):
+    """
+    Largest power of two below count
+    """
+
+    k = 1
+    while k * 2 < count:
+        k *= 2
+    return k
+
+
+def merkle_root(hashes):
+    """
+    Root of the Merkle tree over a list of leaf hashes
+    """
+
+    if not hashes:
+        return hashlib.sha256("").digest()
+    level = list(hashes)
+    # pairwise reduction gives the same tree as the recursive split
+    while len(level) > 1:
+        paired = [node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+def audit_path(index, hashes):
+    """
+    Sibling hashes proving leaf index is in the tree over hashes
+    """
+
+    if len(hashes) <= 1:
+        return []
+    k = _split(len(hashes))
+    if index < k:
+        return audit_path(index, hashes[:k]) + [merkle_root(hashes[k:])]
+    return audit_path(index - k, hashes[k:]) + [merkle_root(hashes[:k])]
+
+
+def verify_inclusion(leaf, index, count, path, root):
+    """
+    Check an audit path (RFC 9162, section 2.1.3.2)
+    """
+
+    if index >= count:
+        return False
+    fn = index
+    sn = count - 1
+    result = leaf
+    for sibling in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            result = node_hash(sibling, result)
+            while not fn & 1 and fn != 0:
+                fn >>= 1
+                sn >>= 1
+        else:
+            result = node_hash(result, sibling)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and result == root
+
+
+class AuditLog(object):
+    """
+    Batched Merkle audit log
+
+    append() only buffers a line and a leaf hash, so it costs the
+    same on a 10k device run as on a single device; every
+    batch_size records (and on close) the batch is sealed and the
+    file flushed. An index of the latest record per address is
+    kept so proofs only re-read one batch.
+
+    A readonly log (for proofs) can be opened while another process
+    appends to it; it never modifies the file.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, readonly=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self.batches = []
+        self.latest = {}
+        self.pending = []
+        self.pending_offset = 0
+        self.last_root = EMPTY_ROOT
+        if os.path.exists(path):
+            self._load()
+        self.log_file = None
+        if not readonly:
+            self.log_file = open(path, 'ab')
+            self.log_file.seek(0, os.SEEK_END)
+            if not self.pending:
+                self.pending_offset = self.log_file.tell()
+
+    def _repair_tail(self, offset, line):
+        """
+        Deal with a last line cut short by a crash: a complete record
+        that only lost its newline gets it back, anything else is moved
+        to <path>.torn and cut off, so the next append starts a new line.
+        Returns the line to index, or None.
+        """
+
+        try:
+            json.loads(line)
+        except ValueError:
+            with open(self.path + ".torn", 'ab') as torn_file:
+                torn_file.write(line + "\n")
+            with open(self.path, 'r+b') as log_file:
+                log_file.truncate(offset)
+            print >> sys.stderr, ("Warning: %s ended in a partial record (%d bytes), "
+                                  "moved to %s.torn" % (self.path, len(line), self.path))
+            return None
+        with open(self.path, 'ab') as log_file:
+            log_file.write("\n")
+        print >> sys.stderr, "Warning: %s ended without a newline, added" % self.path
+        return line + "\n"
+
+    def _load(self):
+        """
+        Index an existing log; unsealed records join the next batch
+
+        A torn last line is repaired (or, read only, skipped);
+        corruption anywhere else raises ValueError.
+        """
+
+        offset = 0
+        with open(self.path, 'rb') as log_file:
+            for number, line in enumerate(log_file, 1):
+                if not line.endswith("\n"):
+                    # only the last line can lack its newline
+                    if self.readonly:
+                        break
+                    line = self._repair_tail(offset, line)
+                    if line is None:
+                        break
+                text = line.rstrip("\n")
+                try:
+                    entry = json.loads(text)
+                except ValueError:
+                    raise ValueError("%s line %d: not a log entry" % (self.path, number))
+                if "batch" in entry:
+                    self.batches.append(entry)
+                    self.last_root = entry["root"]
+                    self.pending = []
+                    self.pending_offset = offset + len(line)
+                else:
+                    self.latest[entry.get("address")] = (len(self.batches), len(self.pending))
+                    self.pending.append(leaf_hash(text))
+                offset += len(line)
+
+    def append(self, record):
+        """
+        Add one result record (a dict), returns its batch number
+        """
+
+        line = json.dumps(record, sort_keys=True, separators=(",", ":"))
+        with self.lock:
+            self.log_file.write(line + "\n")
+            self.latest[record.get("address")] = (len(self.batches), len(self.pending))
+            self.pending.append(leaf_hash(line))
+            if len(self.pending) >= self.batch_size:
+                self._seal()
+            return len(self.batches)
+
+    def _seal(self):
+        """
+        Close the pending batch under a Merkle root
+        """
+
+        if not self.pending:
+            return None
+        entry = {"batch": len(self.batches),
+                 "offset": self.pending_offset,
+                 "count": len(self.pending),
+                 "root": binascii.hexlify(merkle_root(self.pending)),
+                 "prev": self.last_root,
+                 "time": round(time.time(), 3)}
+        self.log_file.write(json.dumps(entry, sort_keys=True, separators=(",", ":")) + "\n")
+        self.log_file.flush()
+        self.batches.append(entry)
+        self.last_root = entry["root"]
+        self.pending = []
+        self.pending_offset = self.log_file.tell()
+        return entry["root"]
+
+    def seal(self):
+        """
+        Seal the records appended so far, returns the root (hex)
+        """
+
+        with self.lock:
+            return self._seal()
+
+    def close(self):
+        """
+        Seal the last batch and close the file
+        """
+
+        if self.log_file is None:
+            return
+        with self.lock:
+            self._seal()
+            self.log_file.close()
+
+    def prove(self, address):
+        """
+        Inclusion proof for the latest sealed record of a device
+
+        Returns a dict with the record line, its leaf index, the
+        batch size, the audit path and the batch root (hex), or None.
+        """
+
+        with self.lock:
+            position = self.latest.get(address)
+            if position is None or position[0] >= len(self.batches):
+                return None
+            batch = self.batches[position[0]]
+
+        with open(self.path, 'rb') as log_file:
+            log_file.seek(batch["offset"])
+            lines = [log_file.readline().rstrip("\n") for _ in range(batch["count"])]
+        hashes = [leaf_hash(line) for line in lines]
+        return {"record": lines[position[1]],
+                "index": position[1],
+                "count": batch["count"],
+                "batch": batch["batch"],
+                "path": [binascii.hexlify(node) for node in audit_path(position[1], hashes)],
+                "root": batch["root"]}
+
+
+def check_proof(proof):
+    """
+    Verify a proof returned by AuditLog.prove
+    """
+
+    return verify_inclusion(leaf_hash(proof["record"]), proof["index"], proof["count"],
+                            [binascii.unhexlify(node) for node in proof["path"]],
+                            binascii.unhexlify(proof["root"]))
+
+
+def verify_file(path):
+    """
+    Recompute every batch root and the root chain
+
+    Returns (sealed batches, unsealed records, list of errors).
+    """
+
+    errors = []
+    batches = 0
+    pending = []
+    prev = EMPTY_ROOT
+    with open(path, 'rb') as log_file:
+        for number, line in enumerate(log_file, 1):
+            text = line.rstrip("\n")
+            try:
+                entry = json.loads(text)
+            except ValueError:
+                errors.append("line %d: not a log entry" % number)
+                continue
+            if "batch" not in entry:
+                pending.append(leaf_hash(text))
+                continue
+            if entry["batch"] != batches:
+                errors.append("line %d: batch %s out of order" % (number, entry["batch"]))
+            if entry["prev"] != prev:
+                errors.append("line %d: batch %d does not chain to the previous root"
+                              % (number, batches))
+            if entry["count"] != len(pending) or \
+                    binascii.hexlify(merkle_root(pending)) != entry["root"]:
+                errors.append("line %d: batch %d root mismatch" % (number, batches))
+            prev = entry["root"]
+            batches += 1
+            pending = []
+    return batches, len(pending), errors
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "verify":
+        BATCHES, UNSEALED, ERRORS = verify_file(sys.argv[2])
+        for error in ERRORS:
+            print error
+        print "%d batches verified, %d unsealed records, %d errors" % (
+            BATCHES, UNSEALED, len(ERRORS))
+        sys.exit(1 if ERRORS else 0)
+    elif len(sys.argv) == 4 and sys.argv[1] == "prove":
+        PROOF = AuditLog(sys.argv[2], readonly=True).prove(sys.argv[3])
+        if PROOF is None:
+            print "No sealed record for %s" % sys.argv[3]
+            sys.exit(1)
+        print json.dumps(PROOF, indent=2, sort_keys=True)
+        print "Proof %s" % ("verified" if check_proof(PROOF) else "FAILED")
+        sys.exit(0 if check_proof(PROOF) else 1)
+    print __doc__
+    sys.exit(2)
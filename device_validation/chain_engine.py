@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Certificate chain validation engine for device_validation.
+Each unique issuer path is validated once against the trust
+anchors and the verified (issuer, subject) edges are memoized,
+so a device's SUDI leaf only needs a single signature check
+against an issuer that is already trusted.
+"""
+###############################################
+#
+# File Name: chain_engine.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import threading
+from OpenSSL import crypto
+
+##
+# labels for the links of a 'show platform sudi' certificate stack
+##
+LINK_LABELS = ("Root", "Manufacturing", "SUDI")
+
+NOT_CHECKED = "not checked, issuer failed validation"
+
+
+class ChainLink(object):
+    """
+    Validation result for one certificate of a chain
+    """
+
+    __slots__ = ("label", "subject", "error", "cached")
+
+    def __init__(self, label, subject, error, cached):
+        self.label = label
+        self.subject = subject
+        self.error = error
+        self.cached = cached
+
+    @property
+    def passed(self):
+        """
+        True if this link validated
+        """
+
+        return self.error is None
+
+
+class ChainValidator(object):
+    """
+    Memoizing certificate chain validator
+
+    anchors is the list of trusted crypto.X509 certificates. The
+    validator is thread safe and meant to live for the whole run.
+    """
+
+    def __init__(self, anchors):
+        self.anchor_digests = set(cert.digest("sha256") for cert in anchors)
+        self.base_store = self._new_store(anchors, partial=False)
+        self.by_subject = {}
+        for cert in anchors:
+            self._trust(cert)
+        self.edges = {}
+        self.issuer_stores = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _new_store(certs, partial):
+        """
+        Build an X509Store, optionally treating its certs as anchors
+        of a partial chain
+        """
+
+        store = crypto.X509Store()
+        for cert in certs:
+            store.add_cert(cert)
+        if partial and hasattr(crypto.X509StoreFlags, "PARTIAL_CHAIN"):
+            store.set_flags(crypto.X509StoreFlags.PARTIAL_CHAIN)
+        return store
+
+    @staticmethod
+    def _check(store, cert):
+        """
+        Verify a certificate against a store, None on success
+        """
+
+        try:
+            crypto.X509StoreContext(store, cert).verify_certificate()
+        except crypto.X509StoreContextError as err:
+            return str(err)
+        return None
+
+    def _trust(self, cert):
+        """
+        Index a validated CA certificate by subject name
+        """
+
+        self.by_subject.setdefault(cert.get_subject().hash(), {})[cert.digest("sha256")] = cert
+
+    def _issuer_store(self, issuer, issuer_digest):
+        """
+        Store trusting just an already validated issuer
+        """
+
+        store = self.issuer_stores.get(issuer_digest)
+        if store is None:
+            if hasattr(crypto.X509StoreFlags, "PARTIAL_CHAIN"):
+                store = self._new_store([issuer], partial=True)
+            else:
+                store = self.base_store
+                store.add_cert(issuer)
+            self.issuer_stores[issuer_digest] = store
+        return store
+
+    def _edge(self, issuer, issuer_digest, cert, digest, memoize):
+        """
+        Validate one (issuer, subject) edge, using the memo if possible
+        """
+
+        key = (issuer_digest, digest)
+        with self.lock:
+            if key in self.edges:
+                return self.edges[key], True
+            if issuer is not None:
+                store = self._issuer_store(issuer, issuer_digest)
+
+        if issuer is None:
+            # top of the stack: must be, or chain to, a trust anchor
+            if digest in self.anchor_digests:
+                error = None
+            else:
+                error = self._check(self.base_store, cert)
+        else:
+            error = self._check(store, cert)
+
+        if memoize:
+            with self.lock:
+                self.edges[key] = error
+                if error is None:
+                    self._trust(cert)
+        return error, False
+
+    def verify_path(self, certs, labels=LINK_LABELS):
+        """
+        Validate a root-first certificate stack link by link
+
+        Every link but the leaf is memoized. Returns a ChainLink per
+        certificate; links below a failed link are not checked.
+        """
+
+        links = []
+        issuer = None
+        issuer_digest = None
+        for idx, cert in enumerate(certs):
+            label = labels[idx] if idx < len(labels) else "Certificate %d" % (idx + 1)
+            subject = cert.get_subject().CN
+            if links and not links[-1].passed:
+                links.append(ChainLink(label, subject, NOT_CHECKED, False))
+                continue
+            digest = cert.digest("sha256")
+            error, cached = self._edge(issuer, issuer_digest, cert, digest,
+                                       memoize=(idx < len(certs) - 1))
+            links.append(ChainLink(label, subject, error, cached))
+            issuer = cert
+            issuer_digest = digest
+        return links
+
+    def verify_leaf(self, cert, label="SUDI"):
+        """
+        Validate a single leaf certificate
+
+        If its issuer is an anchor or an already validated CA only
+        that signature is checked, otherwise the full store is used.
+        """
+
+        issuer = None
+        with self.lock:
+            candidates = self.by_subject.get(cert.get_issuer().hash(), {})
+            if len(candidates) == 1:
+                issuer_digest, issuer = candidates.items()[0]
+        if issuer is not None:
+            error, _ = self._edge(issuer, issuer_digest, cert, cert.digest("sha256"),
+                                  memoize=False)
+        else:
+            error = self._check(self.base_store, cert)
+        return ChainLink(label, cert.get_subject().CN, error, False)
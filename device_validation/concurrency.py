@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive per-site concurrency control for device collection.
+Each site gets an AIMD (additive increase, multiplicative
+decrease) limit on in-flight collections: the limit grows by
+about one per round of successful, fast collections and is cut
+when collections fail or their latency rises well above the
+fastest latency seen at that site. device_validation hands out
+no more devices of a site than its limit admits, in one-shot,
+worker and continuous runs alike.
+"""
+###############################################
+#
+# File Name: concurrency.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import time
+import threading
+from contextlib import contextmanager
+
+##
+# controller defaults
+##
+INITIAL_LIMIT = 2.0
+MIN_LIMIT = 1.0
+MAX_LIMIT = 64.0
+INCREASE = 1.0
+DECREASE = 0.5
+# latency above this multiple of the site's fastest counts as congestion
+LATENCY_FACTOR = 3.0
+# latencies below this never count as congestion
+LATENCY_FLOOR = 1.0
+
+
+class AimdLimit(object):
+    """
+    In-flight limit for one site
+
+    acquire() blocks while the site is at its limit. release()
+    feeds the collection latency and outcome back: a success adds
+    increase/limit (about +increase per round trip of the whole
+    window), a failure or slow collection multiplies the limit by
+    decrease, at most once per observed latency so one burst of
+    failures only counts once.
+    """
+
+    def __init__(self, initial=INITIAL_LIMIT, minimum=MIN_LIMIT, maximum=MAX_LIMIT,
+                 increase=INCREASE, decrease=DECREASE):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.inflight = 0
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for room under the limit and take a slot
+        """
+
+        with self.cond:
+            while self.inflight >= max(int(self.limit), 1):
+                self.cond.wait()
+            self.inflight += 1
+
+    def congested(self, latency, error):
+        """
+        Whether a collection outcome signals overload
+        """
+
+        if error:
+            return True
+        if self.best_latency is None:
+            return False
+        return latency > max(LATENCY_FACTOR * self.best_latency, LATENCY_FLOOR)
+
+    def release(self, latency, error, now=None):
+        """
+        Give the slot back and adjust the limit
+        """
+
+        now = time.time() if now is None else now
+        with self.cond:
+            self.inflight -= 1
+            if self.congested(latency, error):
+                self.failures += 1
+                if now - self.last_decrease >= latency:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.successes += 1
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            if not error and (self.best_latency is None or latency < self.best_latency):
+                self.best_latency = latency
+            self.cond.notify_all()
+
+
+class CollectionOutcome(object):
+    """
+    Set error when a collection failed without raising
+    """
+
+    __slots__ = ("error",)
+
+    def __init__(self):
+        self.error = False
+
+
+class SiteLimiter(object):
+    """
+    AIMD limits for every site, created on first use
+    """
+
+    def __init__(self, **limit_args):
+        self.limit_args = limit_args
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def site(self, site):
+        """
+        The limit object for a site
+        """
+
+        with self.lock:
+            limit = self.sites.get(site)
+            if limit is None:
+                limit = self.sites[site] = AimdLimit(**self.limit_args)
+            return limit
+
+    def limit(self, site):
+        """
+        Current whole in-flight limit for a site
+        """
+
+        return max(int(self.site(site).limit), 1)
+
+    @contextmanager
+    def slot(self, site):
+        """
+        Run one collection inside the site's limit
+
+        An exception or outcome.error marks the collection failed.
+        """
+
+        limit = self.site(site)
+        limit.acquire()
+        outcome = CollectionOutcome()
+        start = time.time()
+        try:
+            yield outcome
+        except Exception:
+            outcome.error = True
+            raise
+        finally:
+            limit.release(time.time() - start, outcome.error)
+
+    def snapshot(self):
+        """
+        {site: (limit, inflight, successes, failures)}
+        """
+
+        with self.lock:
+            sites = self.sites.items()
+        return dict((name, (limit.limit, limit.inflight, limit.successes, limit.failures))
+                    for name, limit in sites)
+
+    def summary_lines(self):
+        """
+        One human readable line per site
+        """
+
+        return ["%-24s limit %5.1f  in-flight %3d  ok %6d  congested %6d" %
+                ((name,) + values) for name, values in sorted(self.snapshot().items())]
+
+    def prometheus_text(self, prefix="device_validation"):
+        """
+        Per-site limits in Prometheus text exposition format
+        """
+
+        metric = prefix + "_site_concurrency_limit"
+        out = ["# HELP %s Adaptive in-flight collection limit per site." % metric,
+               "# TYPE %s gauge" % metric]
+        for name, values in sorted(self.snapshot().items()):
+            out.append('%s{site="%s"} %.3f' % (metric, name, values[0]))
+        return "\n".join(out) + "\n"
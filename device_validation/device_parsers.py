@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental parsers for device CLI responses.
+Output is fed in chunks as it arrives from the SSH session and
+certificates and fields are emitted as soon as they are complete,
+so no command response has to be buffered in full.
+"""
+###############################################
+#
+# File Name: device_parsers.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+from xml.etree import ElementTree
+
+##
+# memory bounds for a single command response
+##
+MAX_LINE_BYTES = 8192
+MAX_CERT_BYTES = 16384
+MAX_CERTS = 8
+MAX_RESPONSE_BYTES = 1024 * 1024
+
+BEGIN_CERT = "-----BEGIN CERTIFICATE-----"
+END_CERT = "-----END CERTIFICATE-----"
+
+##
+# namespaces of PnP deviceAuth responses
+##
+PNP_NAMESPACES = ("urn:cisco:pnp", "urn:cisco:pnp:device-auth")
+
+
+class LineStream(object):
+    """
+    Split a chunked byte stream into lines
+
+    Only the current incomplete line is held, and it is cut at
+    max_line bytes so a run of output without line endings
+    cannot grow the buffer without bound.
+    """
+
+    def __init__(self, max_line=MAX_LINE_BYTES):
+        self.max_line = max_line
+        self.pending = []
+        self.pending_len = 0
+        self.truncated = 0
+
+    def feed(self, chunk):
+        """
+        Return the lines completed by this chunk, without line endings
+        """
+
+        lines = []
+        start = 0
+        while True:
+            end = chunk.find("\n", start)
+            if end == -1:
+                self._hold(chunk[start:])
+                return lines
+            self._hold(chunk[start:end])
+            lines.append("".join(self.pending).rstrip("\r"))
+            self.pending = []
+            self.pending_len = 0
+            start = end + 1
+
+    def _hold(self, fragment):
+        """
+        Add a fragment to the current line, respecting max_line
+        """
+
+        room = self.max_line - self.pending_len
+        if len(fragment) > room:
+            self.truncated += len(fragment) - room
+            fragment = fragment[:room]
+        if fragment:
+            self.pending.append(fragment)
+            self.pending_len += len(fragment)
+
+    def tail(self):
+        """
+        Current incomplete line (normally the device prompt)
+        """
+
+        return "".join(self.pending)
+
+
+class StreamParser(object):
+    """
+    Base class for incremental command response parsers
+
+    feed() returns the (name, value) events completed by each chunk.
+    Completed values are also kept in self.fields. When echo is set,
+    output before the echoed command line is ignored. The response is
+    complete once the trailing incomplete line is the device prompt:
+    hostname followed by '#' or '>' when the hostname is known, or
+    anything that looks like a prompt otherwise.
+    """
+
+    def __init__(self, max_bytes=MAX_RESPONSE_BYTES):
+        self.stream = LineStream()
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.fields = {}
+        self.complete = False
+        self.error = None
+        self.prompt = None
+        self.echo = None
+        self.echoed = False
+        self.hostname = None
+
+    def feed(self, chunk):
+        """
+        Consume the next chunk of output
+        """
+
+        events = []
+        self.received += len(chunk)
+        if self.received > self.max_bytes:
+            self.error = "response exceeded %d bytes" % self.max_bytes
+            self.complete = True
+            return events
+
+        for line in self.stream.feed(chunk):
+            if self.echo is not None and not self.echoed:
+                # skip anything left over from before the command
+                self.echoed = self.echo in line
+                continue
+            self.handle_line(line, events)
+
+        tail = self.stream.tail().strip()
+        if (self.echo is None or self.echoed) and self.is_prompt(tail):
+            self.prompt = tail
+            self.complete = True
+        return events
+
+    def is_prompt(self, tail):
+        """
+        Check whether the incomplete trailing line is a device prompt
+        """
+
+        if self.hostname is not None:
+            return tail[:-1] == self.hostname and tail[-1:] in ("#", ">")
+        return (len(tail) > 1 and tail[-1] in "#>" and " " not in tail)
+
+    def emit(self, events, name, value):
+        """
+        Record a completed field
+        """
+
+        self.fields[name] = value
+        events.append((name, value))
+
+    def handle_line(self, line, events):
+        """
+        Handle one complete line of output
+        """
+
+        raise NotImplementedError
+
+
+class SudiCertParser(StreamParser):
+    """
+    Parser for 'show platform sudi cert sign nonce ...'
+
+    Emits a "certificate" event per PEM certificate (CRCA, CMCA,
+    SUDI in that order), then "sig_ver" and "signature".
+    """
+
+    def __init__(self, max_bytes=MAX_RESPONSE_BYTES):
+        StreamParser.__init__(self, max_bytes)
+        self.certs = []
+        self.cert_lines = None
+        self.cert_len = 0
+        self.want_signature = False
+
+    def handle_line(self, line, events):
+        if "signature" in self.fields:
+            return
+
+        if self.cert_lines is not None:
+            self.cert_len += len(line) + 1
+            if self.cert_len > MAX_CERT_BYTES:
+                self.error = "certificate exceeded %d bytes" % MAX_CERT_BYTES
+                self.cert_lines = None
+                return
+            self.cert_lines.append(line.strip())
+            if END_CERT in line:
+                pem = "\n".join(self.cert_lines) + "\n"
+                self.cert_lines = None
+                if len(self.certs) >= MAX_CERTS:
+                    self.error = "more than %d certificates" % MAX_CERTS
+                    return
+                self.certs.append(pem)
+                events.append(("certificate", pem))
+        elif BEGIN_CERT in line:
+            self.cert_lines = [BEGIN_CERT]
+            self.cert_len = len(BEGIN_CERT) + 1
+        elif self.want_signature:
+            if line.strip():
+                self.emit(events, "signature", line.strip())
+        elif "show platform" in line:
+            return
+        elif "Signature version:" in line:
+            self.emit(events, "sig_ver", line.split(":", 1)[1].strip())
+        elif "Signature:" in line:
+            self.want_signature = True
+
+
+class IntegrityParser(StreamParser):
+    """
+    Parser for 'show platform integrity sign nonce ...'
+
+    Emits the platform, boot and OS version and hash fields, the
+    PCR0/PCR8 values, then "sig_ver" and "signature".
+    """
+
+    FIELDS = {
+        "Platform": "platform",
+        "Boot 0 Version": "boot0_version",
+        "Boot 0 Hash": "boot0_hash",
+        "Boot Loader Version": "bootldr_version",
+        "Boot Loader Hash": "bootldr_hash",
+        "OS Version": "os_version",
+        "OS Hash": "os_hash",
+        "PCR0": "pcr0",
+        "PCR8": "pcr8",
+        "Signature version": "sig_ver",
+    }
+
+    def __init__(self, max_bytes=MAX_RESPONSE_BYTES):
+        StreamParser.__init__(self, max_bytes)
+        self.os_hashes = None
+        self.want_signature = False
+
+    def handle_line(self, line, events):
+        if "signature" in self.fields:
+            return
+
+        if self.want_signature:
+            if line.strip():
+                self.emit(events, "signature", line.strip())
+            return
+
+        key, sep, value = line.partition(":")
+        key = key.strip()
+        if not sep or "show platform" in line:
+            return
+        if key == "Signature":
+            self.want_signature = True
+        elif key == "OS Hashes":
+            self.os_hashes = []
+        elif key in self.FIELDS:
+            if self.os_hashes is not None and "os_hashes" not in self.fields:
+                self.emit(events, "os_hashes", self.os_hashes)
+            self.emit(events, self.FIELDS[key], value.strip())
+        elif self.os_hashes is not None and "os_hashes" not in self.fields:
+            # "<package name>: <hash>" entry under the OS Hashes header
+            self.os_hashes.append(value.strip())
+
+
+class PkiSerialParser(StreamParser):
+    """
+    Parser for 'show crypto pki certificate verbose | i serialNumber=PID:'
+
+    Emits "sudi_serial" and "pid" from the first SUDI subject line.
+    """
+
+    def handle_line(self, line, events):
+        if "sudi_serial" in self.fields or "SN:" not in line:
+            return
+
+        self.emit(events, "sudi_serial", line.split("SN:", 1)[1].strip())
+        if "PID:" in line:
+            self.emit(events, "pid", line.split("PID:", 1)[1].split(" ")[0])
+
+
+class InventoryParser(StreamParser):
+    """
+    Parser for 'show inventory'
+
+    Emits "udi" from the line following the chassis entry.
+    """
+
+    def __init__(self, max_bytes=MAX_RESPONSE_BYTES):
+        StreamParser.__init__(self, max_bytes)
+        self.want_udi = False
+
+    def handle_line(self, line, events):
+        if "udi" in self.fields:
+            return
+
+        if self.want_udi:
+            self.emit(events, "udi", line.replace(" ", ""))
+        elif "Chassis" in line or "chassis" in line:
+            self.want_udi = True
+
+
+class DeviceAuthParser(object):
+    """
+    Incremental parser for PnP deviceAuth responses
+
+    The response bytes are fed to an expat parser as they arrive
+    and only the text of the four deviceAuth elements in the PnP
+    namespaces is kept; no tree is built. The response is complete
+    as soon as all four fields have been seen, so the rest of the
+    body does not need to be read.
+    """
+
+    FIELDS = {
+        "challenge-response": "challenge_rsp",
+        "sudi-cert": "sudi_cert",
+        "encryption-method": "enc_method",
+        "hashing-method": "hash_method",
+    }
+
+    def __init__(self, max_bytes=MAX_RESPONSE_BYTES):
+        self.parser = ElementTree.XMLParser(target=self)
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.fields = {}
+        self.complete = False
+        self.error = None
+        self.current = None
+        self.text = []
+        self.text_len = 0
+
+    def _field(self, tag):
+        """
+        Field name for a namespaced tag, None if not wanted
+        """
+
+        if not tag.startswith("{"):
+            return None
+        namespace, _, local = tag[1:].partition("}")
+        if namespace not in PNP_NAMESPACES:
+            return None
+        return self.FIELDS.get(local)
+
+    ## expat target interface
+    def start(self, tag, attrib):
+        name = self._field(tag)
+        if name is not None and name not in self.fields:
+            self.current = name
+            self.text = []
+            self.text_len = 0
+
+    def data(self, data):
+        if self.current is not None:
+            self.text_len += len(data)
+            if self.text_len > MAX_CERT_BYTES * 2:
+                self.error = "%s exceeded %d bytes" % (self.current, MAX_CERT_BYTES * 2)
+                self.current = None
+                return
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.current is not None and self._field(tag) == self.current:
+            self.fields[self.current] = "".join(self.text).strip()
+            self.current = None
+            if len(self.fields) == len(self.FIELDS):
+                self.complete = True
+
+    def close(self):
+        return self.fields
+
+    def feed(self, chunk):
+        """
+        Consume the next chunk of the response body
+        """
+
+        if self.complete:
+            return
+        self.received += len(chunk)
+        if self.received > self.max_bytes:
+            self.error = "response exceeded %d bytes" % self.max_bytes
+            self.complete = True
+            return
+        try:
+            self.parser.feed(chunk)
+        except SyntaxError as err:
+            # ElementTree.ParseError derives from SyntaxError; trailing
+            # garbage after all fields were found is not an error
+            if not self.complete:
+                self.error = "malformed response: %s" % err
+            self.complete = True
+
+    def finish(self):
+        """
+        End of the response body reached
+        """
+
+        if not self.complete:
+            try:
+                self.parser.close()
+            except SyntaxError as err:
+                self.error = "malformed response: %s" % err
+            self.complete = True
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact per-device record for device_validation.
+One DeviceRecord carries a device's inventory fields, what was
+learned during verification and the evidence collected from it.
+Certificates are held only until the device is verified, then
+dropped or spilled to disk, so collector memory does not grow
+with fleet size.
+
+   ./device_record.py [--devices N] [--inflight N]
+"""
+###############################################
+#
+# File Name: device_record.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+from collections import deque
+
+UNKNOWN = "UNKNOWN"
+PASS_RC = 31
+# PnP has no integrity check, its four checks passing is a pass
+PNP_PASS_RC = 15
+
+
+def pass_rc(method):
+    """
+    auth_rc of a passed verification with the given method
+    """
+
+    return PNP_PASS_RC if method == "PNP" else PASS_RC
+
+
+class DeviceRecord(object):
+    """
+    Inventory fields, learned identity, result and evidence of one device
+
+    en_udi is the UDI for PnP rows and the enable password for CLI rows.
+    """
+
+    __slots__ = ("address", "method", "user", "passwd", "en_udi", "sudi_serial", "pid",
+                 "site", "auth_rc", "nonce", "pcr0", "pcr8", "boot_version", "os_version",
+                 "certs", "spilled")
+
+    def __init__(self, address, method, user, passwd, en_udi=UNKNOWN, sudi_serial=UNKNOWN,
+                 pid=UNKNOWN, site=None):
+        self.address = address
+        self.method = method
+        self.user = user
+        self.passwd = passwd
+        self.en_udi = en_udi
+        self.sudi_serial = sudi_serial
+        self.pid = pid
+        self.site = site
+        self.auth_rc = 0
+        self.nonce = None
+        self.pcr0 = None
+        self.pcr8 = None
+        self.boot_version = None
+        self.os_version = None
+        self.certs = None
+        self.spilled = None
+
+    @classmethod
+    def from_row(cls, row, site=None):
+        """
+        Record for an inventory row of 4 to 7 fields, None otherwise
+        """
+
+        if len(row) < 4 or len(row) > 7:
+            return None
+        return cls(*row, site=site)
+
+    def identity_known(self):
+        return UNKNOWN not in (self.en_udi, self.sudi_serial, self.pid)
+
+    def release(self, spill=None):
+        """
+        Drop the evidence blobs once the device is verified, writing
+        them to spill (an EvidenceSpill) first if given
+        """
+
+        if self.certs is not None and spill is not None:
+            self.spilled = spill.write(self)
+        self.certs = None
+
+    def audit_record(self):
+        """
+        Result record for the audit log
+        """
+
+        record = {"address": self.address,
+                  "method": self.method,
+                  "sudi_serial": self.sudi_serial,
+                  "pcr0": self.pcr0,
+                  "pcr8": self.pcr8,
+                  "auth_rc": self.auth_rc,
+                  "nonce": self.nonce,
+                  "time": round(time.time(), 3)}
+        if self.spilled is not None:
+            record["evidence"] = self.spilled
+        return record
+
+
+class EvidenceSpill(object):
+    """
+    Directory of collected certificates, one PEM file per verification
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, record):
+        """
+        Write a record's certificates, returns the file path
+        """
+
+        name = "%s-%s.pem" % (record.address.replace(":", "_"), record.nonce or int(time.time()))
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as spill_file:
+            spill_file.write("".join(record.certs))
+        return path
+
+
+##
+# memory benchmark
+##
+BENCH_CERT = "-----BEGIN CERTIFICATE-----\n%s-----END CERTIFICATE-----\n" % (
+    ("A" * 64 + "\n") * 20)
+
+
+def _rss_kb():
+    """
+    Current resident set size in KB (peak size where /proc is missing)
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _bench_row(idx):
+    return ("10.%d.%d.%d" % (idx >> 16 & 255, idx >> 8 & 255, idx & 255), "CLI",
+            "admin", "secret", "enable", "FOC%08d" % idx, "WS-C3650-24PS")
+
+
+def bench_model(model, devices, inflight):
+    """
+    Push devices through collection with inflight of them open at a
+    time and the results kept for the run, returns RSS (KB) samples
+
+    model "record" releases certificates once verified, "retain"
+    keeps them on the record and "tuple" is the loose tuple and
+    dict model the records replaced.
+    """
+
+    results = []
+    open_devices = deque()
+    samples = []
+    step = max(devices // 10, 1)
+    base = _rss_kb()
+    for idx in xrange(devices):
+        row = _bench_row(idx)
+        certs = [BENCH_CERT[:-1] + "%d\n" % n for n in range(3)]
+        if model == "tuple":
+            evidence = {"nonce": str(idx), "pcr0": "%064X" % idx, "pcr8": "%064X" % idx,
+                        "certs": certs}
+            device = (row, evidence)
+        else:
+            device = DeviceRecord.from_row(row)
+            device.nonce = str(idx)
+            device.pcr0 = device.pcr8 = "%064X" % idx
+            device.certs = certs
+        open_devices.append(device)
+        if len(open_devices) > inflight:
+            done = open_devices.popleft()
+            if model == "tuple":
+                results.append((PASS_RC,) + done[0][4:] + (done[1],))
+            else:
+                done.auth_rc = PASS_RC
+                if model == "record":
+                    done.release()
+                results.append(done)
+        if (idx + 1) % step == 0:
+            samples.append((idx + 1, _rss_kb() - base))
+    return samples
+
+
+def run_benchmark(devices, inflight):
+    """
+    Run each model in a fresh interpreter and print RSS growth
+    """
+
+    print "RSS growth (MB) with %d devices in flight" % inflight
+    print "%-8s" % "devices" + "".join("%12s" % model for model in ("tuple", "retain", "record"))
+    columns = []
+    for model in ("tuple", "retain", "record"):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--model",
+                                       model, "--devices", str(devices), "--inflight",
+                                       str(inflight)])
+        columns.append([line.split() for line in out.splitlines()])
+    for rows in zip(*columns):
+        print "%-8s" % rows[0][0] + "".join("%12.1f" % (int(row[1]) / 1024.0) for row in rows)
+    last = [int(rows[-1][1]) for rows in columns]
+    print "bytes per device: " + "  ".join(
+        "%s %d" % (model, kb * 1024 // devices) for model, kb in zip(("tuple", "retain", "record"),
+                                                                    last))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="device record memory benchmark")
+    PARSER.add_argument("--devices", type=int, default=100000)
+    PARSER.add_argument("--inflight", type=int, default=64)
+    PARSER.add_argument("--model", help=argparse.SUPPRESS)
+    ARGS = PARSER.parse_args()
+    if ARGS.model:
+        for count, rss in bench_model(ARGS.model, ARGS.devices, ARGS.inflight):
+            print count, rss
+    else:
+        run_benchmark(ARGS.devices, ARGS.inflight)
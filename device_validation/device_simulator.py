@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Simulated device fleet for load-testing device_validation.
+Thousands of fake devices answer the SSH CLI dialogue and the
+PnP deviceAuth request with responses built from the example
+files, with configurable latency, jitter and failure rates.
+
+Every device has its own loopback address (127.10.0.1, ...).
+One CLI listener and one PnP HTTP listener serve the whole
+fleet and tell devices apart by the local address a client
+connected to. The CLI is plain TCP; device_validation reaches
+it through the --connect relay in place of ssh:
+
+   ./device_simulator.py --devices 2000 --inventory sim.csv
+   ./device_validation.py --inventory sim.csv \\
+       --ssh-command "./device_simulator.py --connect %(address)s 2222" \\
+       --pnp-url "http://%(address)s:8080/pnp/webui"
+
+The example evidence is replayed as is, so it is signed over
+the example nonce: signature checks fail, but every device
+still costs a full collection, parse and verification.
+"""
+###############################################
+#
+# File Name: device_simulator.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import re
+import sys
+import csv
+import time
+import base64
+import random
+import socket
+import select
+import struct
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+# shared verification libraries live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import RevocationIndex
+
+##
+# defaults
+##
+EXAMPLE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUDI_EXAMPLE = os.path.join(EXAMPLE_DIR, "sudi_example.txt")
+SPI_EXAMPLE = os.path.join(EXAMPLE_DIR, "spi_example.txt")
+BASE_ADDRESS = "127.10.0.0"
+SSH_PORT = 2222
+PNP_PORT = 8080
+RELAY_CHUNK = 4096
+
+SUDI_CMD = re.compile(r"^show platform sudi cert\S*\s+sign(?:\s+nonce\s+(\d+))?\s*$")
+INTEGRITY_CMD = re.compile(r"^show platform integrity\s+sign(?:\s+nonce\s+(\d+))?\s*$")
+SUDI_PID = re.compile(r"PID:(\S+) SN:")
+
+
+def load_example(path):
+    """
+    Read an example file, dropping the echoed command line
+    """
+
+    with open(path, 'r') as example:
+        lines = example.read().replace("\r\n", "\n").split("\n")
+    if lines and "#show " in lines[0]:
+        lines = lines[1:]
+    return "\r\n".join(line for line in lines if line.strip()) + "\r\n"
+
+
+class Evidence(object):
+    """
+    Device responses built from the example files
+    """
+
+    def __init__(self, sudi_path=SUDI_EXAMPLE, spi_path=SPI_EXAMPLE):
+        self.sudi_output = load_example(sudi_path)
+        self.integrity_output = load_example(spi_path)
+
+        pems = re.findall(r"-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----",
+                          self.sudi_output, re.S)
+        self.sudi_pem = pems[-1].replace("\r\n", "\n") + "\n"
+
+        # the SUDI subject serialNumber reads "PID:<pid> SN:<serial>"; the
+        # serial is read with its DER length so it stops where the value does
+        der = base64.b64decode("".join(self.sudi_pem.splitlines()[1:-1]))
+        match = SUDI_PID.search(der)
+        self.pid = match.group(1) if match else "SIM-PID"
+        self.serial = RevocationIndex.sudi_serial(der) or "SIM00000000"
+
+
+class SimDevice(object):
+    """
+    One simulated device
+    """
+
+    __slots__ = ("address", "method", "hostname", "user", "passwd", "en_pass")
+
+    def __init__(self, address, method, hostname, user, passwd, en_pass):
+        self.address = address
+        self.method = method
+        self.hostname = hostname
+        self.user = user
+        self.passwd = passwd
+        self.en_pass = en_pass
+
+
+class Fleet(object):
+    """
+    The simulated devices and their behaviour
+
+    latency and jitter are in seconds; fail_rate is the chance a
+    response drops the connection (or returns HTTP 503) and
+    stall_rate the chance it is never sent.
+    """
+
+    def __init__(self, size, evidence, base_address=BASE_ADDRESS, pnp_fraction=0.0,
+                 latency=0.0, jitter=0.0, fail_rate=0.0, stall_rate=0.0,
+                 user="admin", passwd="cisco", seed=None):
+        self.evidence = evidence
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.stall_rate = stall_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.order = []
+        base = struct.unpack(">I", socket.inet_aton(base_address))[0]
+        for idx in range(size):
+            address = socket.inet_ntoa(struct.pack(">I", base + idx + 1))
+            method = "PNP" if self.random.random() < pnp_fraction else "CLI"
+            device = SimDevice(address, method, "SIM%05d" % (idx + 1), user, passwd,
+                               "enable%05d" % (idx + 1))
+            self.devices[address] = device
+            self.order.append(device)
+
+    def udi(self):
+        """
+        UDI string as reported by 'show inventory'
+        """
+
+        return "PID: %s , VID: V01 , SN: %s" % (self.evidence.pid, self.evidence.serial)
+
+    def outcome(self):
+        """
+        Pick the fate of the next response: "ok", "fail" or "stall"
+        """
+
+        with self.lock:
+            roll = self.random.random()
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(delay, 0.0))
+        if roll < self.fail_rate:
+            return "fail"
+        if roll < self.fail_rate + self.stall_rate:
+            return "stall"
+        return "ok"
+
+    def write_inventory(self, path):
+        """
+        Write a devices.csv style inventory for the fleet
+        """
+
+        with open(path, 'wb') as csv_outfile:
+            csv_out = csv.writer(csv_outfile, delimiter=',', quotechar='"')
+            for device in self.order:
+                row = [device.address, device.method, device.user, device.passwd]
+                if device.method == "CLI":
+                    row.append(device.en_pass)
+                csv_out.writerow(row)
+
+
+class CliHandler(SocketServer.StreamRequestHandler):
+    """
+    IOS-like CLI session: login, enable, term len and the show
+    commands device_validation issues
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.fleet = self.server.fleet
+        self.device = self.fleet.devices.get(self.connection.getsockname()[0])
+        self.privileged = False
+
+    def send(self, text):
+        self.wfile.write(text)
+        self.wfile.flush()
+
+    def prompt(self):
+        self.send("%s%s" % (self.device.hostname, "#" if self.privileged else ">"))
+
+    def readline(self):
+        """
+        Read one line of input, None once the client is gone
+        """
+
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return line.rstrip("\r\n")
+
+    def ask_password(self, expected):
+        """
+        Prompt for a password, True if the right one was entered
+        """
+
+        self.send("Password: ")
+        answer = self.readline()
+        self.send("\r\n")
+        return answer == expected
+
+    def handle(self):
+        if self.device is None:
+            return
+        if not self.ask_password(self.device.passwd):
+            self.send("Permission denied\r\n")
+            return
+        self.prompt()
+
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            # echo the command, as the device would on its tty
+            self.send(line + "\r\n")
+            if not self.command(line.strip()):
+                return
+
+    def command(self, cmd):
+        """
+        Run one command, False to end the session
+        """
+
+        if cmd in ("exit", "quit", "logout"):
+            return False
+
+        fate = self.fleet.outcome() if cmd.startswith("show ") else "ok"
+        if fate == "fail":
+            return False
+        if fate == "stall":
+            # hold the session open without answering
+            while self.readline() is not None:
+                pass
+            return False
+
+        evidence = self.fleet.evidence
+        if cmd == "enable":
+            if self.ask_password(self.device.en_pass):
+                self.privileged = True
+            else:
+                self.send("% Bad secrets\r\n\r\n")
+        elif cmd == "" or cmd.startswith("term"):
+            pass
+        elif cmd == "show inventory":
+            self.send('NAME: "Chassis", DESCR: "Simulated %s Chassis"\r\n%s\r\n\r\n'
+                      % (evidence.pid, self.fleet.udi()))
+        elif cmd.startswith("show crypto pki certificate"):
+            self.send("    serialNumber=PID:%s SN:%s\r\n" % (evidence.pid, evidence.serial))
+        elif SUDI_CMD.match(cmd):
+            self.send(evidence.sudi_output)
+        elif INTEGRITY_CMD.match(cmd):
+            self.send(evidence.integrity_output)
+        else:
+            self.send("                ^\r\n% Invalid input detected at '^' marker.\r\n\r\n")
+        self.prompt()
+        return True
+
+
+class PnpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    /pnp/webui listener answering deviceAuth challenge requests
+    """
+
+    RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<pnp xmlns="urn:cisco:pnp" version="1.0" udi="{udi}">
+<response correlator="{corr}" xmlns="urn:cisco:pnp:device-auth" success="1">
+<deviceAuth>
+<challenge-response>{challenge}</challenge-response>
+<sudi-cert>{sudi}</sudi-cert>
+<encryption-method>RSA</encryption-method>
+<hashing-method>SHA256</hashing-method>
+</deviceAuth>
+</response>
+</pnp>
+'''
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def reply(self, code, body=""):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        fleet = self.server.fleet
+        device = fleet.devices.get(self.connection.getsockname()[0])
+        body = self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+        if device is None or self.path != "/pnp/webui":
+            self.reply(404)
+            return
+
+        creds = base64.b64encode(device.user + ":" + device.passwd)
+        if self.headers.getheader("Authorization") != "Basic " + creds:
+            self.reply(401)
+            return
+
+        fate = fleet.outcome()
+        if fate == "fail":
+            self.reply(503)
+            return
+        if fate == "stall":
+            # wait for the client to give up
+            self.rfile.read(1)
+            self.close_connection = 1
+            return
+
+        corr = re.search(r'correlator="([^"]*)"', body)
+        self.reply(200, self.RESPONSE.format(
+            udi=fleet.udi().replace(" ", ""),
+            corr=corr.group(1) if corr else "",
+            challenge=base64.b64encode(os.urandom(256)),
+            sudi=base64.b64encode(fleet.evidence.sudi_pem)))
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+def serve(fleet, bind="0.0.0.0", ssh_port=SSH_PORT, pnp_port=PNP_PORT):
+    """
+    Start the CLI and PnP listeners in background threads
+    """
+
+    servers = []
+    for server_class, handler, port in ((ThreadingTCPServer, CliHandler, ssh_port),
+                                        (ThreadingHTTPServer, PnpHandler, pnp_port)):
+        server = server_class((bind, port), handler)
+        server.fleet = fleet
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+    return servers
+
+
+def relay(address, port):
+    """
+    Stand-in for ssh: relay the terminal to a simulated device
+    """
+
+    sock = socket.create_connection((address, port))
+    stdin = sys.stdin.fileno()
+    old_attrs = None
+    if os.isatty(stdin):
+        import tty
+        import termios
+        old_attrs = termios.tcgetattr(stdin)
+        # raw mode: the device echoes, as over ssh
+        tty.setraw(stdin)
+    try:
+        while True:
+            readable = select.select([sock, stdin], [], [])[0]
+            if sock in readable:
+                data = sock.recv(RELAY_CHUNK)
+                if not data:
+                    return
+                os.write(sys.stdout.fileno(), data)
+            if stdin in readable:
+                data = os.read(stdin, RELAY_CHUNK)
+                if not data:
+                    return
+                sock.sendall(data)
+    finally:
+        sock.close()
+        if old_attrs is not None:
+            termios.tcsetattr(stdin, termios.TCSADRAIN, old_attrs)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="simulated device fleet")
+    PARSER.add_argument("--connect", nargs=2, metavar=("ADDRESS", "PORT"),
+                        help="relay this terminal to a simulated device (ssh stand-in)")
+    PARSER.add_argument("--devices", type=int, default=100, help="number of devices")
+    PARSER.add_argument("--base-address", default=BASE_ADDRESS,
+                        help="devices get the addresses following this one")
+    PARSER.add_argument("--bind", default="0.0.0.0", help="listen address")
+    PARSER.add_argument("--ssh-port", type=int, default=SSH_PORT, help="CLI listener port")
+    PARSER.add_argument("--pnp-port", type=int, default=PNP_PORT, help="PnP listener port")
+    PARSER.add_argument("--pnp-fraction", type=float, default=0.0,
+                        help="fraction of devices validated through PnP")
+    PARSER.add_argument("--latency", type=float, default=0.0, help="response latency (ms)")
+    PARSER.add_argument("--jitter", type=float, default=0.0, help="latency jitter (ms)")
+    PARSER.add_argument("--fail-rate", type=float, default=0.0,
+                        help="chance a response drops the session")
+    PARSER.add_argument("--stall-rate", type=float, default=0.0,
+                        help="chance a response never arrives")
+    PARSER.add_argument("--sudi-example", default=SUDI_EXAMPLE)
+    PARSER.add_argument("--spi-example", default=SPI_EXAMPLE)
+    PARSER.add_argument("--inventory", metavar="CSV", help="write the fleet as devices.csv")
+    PARSER.add_argument("--seed", type=int, help="random seed")
+    ARGS = PARSER.parse_args()
+
+    if ARGS.connect:
+        relay(ARGS.connect[0], int(ARGS.connect[1]))
+        sys.exit(0)
+
+    FLEET = Fleet(ARGS.devices, Evidence(ARGS.sudi_example, ARGS.spi_example),
+                  base_address=ARGS.base_address, pnp_fraction=ARGS.pnp_fraction,
+                  latency=ARGS.latency / 1000.0, jitter=ARGS.jitter / 1000.0,
+                  fail_rate=ARGS.fail_rate, stall_rate=ARGS.stall_rate, seed=ARGS.seed)
+    if ARGS.inventory:
+        FLEET.write_inventory(ARGS.inventory)
+    serve(FLEET, ARGS.bind, ARGS.ssh_port, ARGS.pnp_port)
+    print "Simulating %d devices from %s (CLI port %d, PnP port %d)" % (
+        ARGS.devices, FLEET.order[0].address if FLEET.order else "-",
+        ARGS.ssh_port, ARGS.pnp_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
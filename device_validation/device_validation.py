@@ -74,10 +74,74 @@ the validations: PNP API and CLI.
 #   To validate a single device in the input file:
 #      ./device_validation.py <ip address>
 #
+#   To keep the inventory in SQLite instead of devices.csv:
+#      ./device_validation.py --inventory devices.db --import-csv devices.csv [--site SITE]
+#      ./device_validation.py --inventory devices.db [--site SITE] [--pid PID]
+#                             [--stale-hours HOURS] [<ip address>]
+#
+#   Optional arguments:
+#      --metrics FILE   write per-stage timing histograms, per-site
+#                       concurrency limits and fleet counters (Prometheus text)
+#      --profile FILE   run a single device under cProfile, save the stats
+#      --audit-log FILE append every result to a tamper-evident Merkle tree
+#                       log; check it with ./audit_log.py verify FILE
+#      --workers N      verify at most N devices at a time (by default as many
+#                       as the adaptive per-site limits admit)
+#      --site-inflight N verify at most N devices of one site at a time
+#      --continuous HOURS [--reboot-hints FILE]
+#                       keep verifying, every device at least once per HOURS,
+#                       spread evenly across the period
+#      --coordinate [HOST:]PORT --shard-secret FILE [--shard-cert FILE --shard-key FILE]
+#                       split the selected devices over worker processes by
+#                       consistent hashing and merge their results (SQLite
+#                       inventory only); HOST defaults to 127.0.0.1, any other
+#                       address needs the TLS certificate and key
+#      --worker https://HOST:PORT --shard-secret FILE [--shard-ca FILE] [--worker-id ID]
+#                       verify the devices a coordinator assigns
+#      --spill-dir DIR  keep each device's certificates in DIR once verified
+#                       (they are otherwise dropped from memory)
+#      --prescan [--connect-timeout SECONDS] [--ssh-port PORT]
+#                       probe every device's SSH/PnP port concurrently before
+#                       collection and skip the ones that do not answer
+#      --cooldown FILE  hold back devices that failed recently, backing off
+#                       exponentially from 1 minute to 24 hours
+#      --latency-history FILE
+#                       derive each CLI command's timeout from the latencies
+#                       seen for it (3 x p99, 2 to 30 seconds), kept in FILE
+#      --fleet-stats FILE
+#                       keep running counts by PID, site, boot/OS version and
+#                       failed check, with verification time percentiles, in
+#                       FILE (JSON, refreshed every minute during the run)
+#      --pcr-history DIR
+#                       append every device's PCR0/PCR8, boot and OS versions
+#                       to a columnar history; query it with
+#                       ./pcr_history.py DIR changed pcr8 --days 7
+#      --revoked INDEX  fail the certificate chain check of devices whose SUDI
+#                       serial or certificate fingerprint is in INDEX, built
+#                       with ../RevocationIndex.py build LIST INDEX
+#      --ssh-transport auto|paramiko|pexpect
+#                       log in to CLI devices in process with paramiko (default
+#                       when installed) or by spawning ssh under pexpect
+#      --known-hosts FILE [--accept-new-host-keys]
+#                       device host keys (default ~/.ssh/known_hosts); unknown
+#                       hosts are rejected unless new keys are accepted, which
+#                       trusts and saves them on first use
+#      --ssh-command, --pnp-url TEMPLATE
+#                       how to reach devices, with %(user)s and %(address)s
+#
+#   To load-test against simulated devices (see device_simulator.py):
+#      ./device_simulator.py --devices 1000 --inventory sim.csv &
+#      ./device_validation.py --inventory sim.csv \
+#          --ssh-command "./device_simulator.py --connect %(address)s 2222" \
+#          --pnp-url "http://%(address)s:8080/pnp/webui"
+#
+#   To measure per-device collector memory for a 100k device run:
+#      ./device_record.py --devices 100000
+#
 # Dependencies:
 #   The python dependencies are as follows:
-#        os, csv, requests, base64, string, random, struct
-#        argparse, pexpect, binascii, xml.etree, OpenSSL, six
+#        os, csv, requests, base64, string, struct
+#        argparse, pexpect or paramiko, xml.etree, OpenSSL, six
 #   If any of these packages are missing, use your python package
 #   installer to install them on your system.
 #   This script was tested against python 2.7. Any other version is
@@ -108,17 +172,45 @@ the validations: PNP API and CLI.
 ###############################################
 
 import os
-import csv
+import sys
+import re
+import time
 import base64
 import string
-import random
+import socket
 import argparse
-import binascii
-from xml.etree import ElementTree
+import threading
+import Queue
+import urlparse
+from collections import deque
 from OpenSSL import crypto
 from six import b
-import pexpect
+try:
+    import pexpect
+except ImportError:
+    # only needed without the in-process SSH transport
+    pexpect = None
 import requests
+import stage_timing
+import device_parsers
+import inventory
+import chain_engine
+import scheduler
+import concurrency
+import audit_log
+import sharding
+import device_record
+import reachability
+import ssh_transport
+import pcr_history
+import fleet_stats
+
+# shared verification libraries live in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NonceService
+import CryptoBackend
+import VerifySignature
+import RevocationIndex
 
 ##
 # File containing the devices to authenticate
@@ -131,6 +223,81 @@ OUTPUT_FILE = 'validated_output_devices.csv'
 # constants
 ##
 UNKNOWN_STR = "Uknown"
+READ_CHUNK = 4096
+COMMAND_TIMEOUT = 30
+PNP_TIMEOUT = (reachability.CONNECT_TIMEOUT, COMMAND_TIMEOUT)
+SSH_TRANSPORT = "pexpect"
+PROMPT_PAT = r"(?:^|[\r\n])([A-Za-z0-9][\w.:/()-]*)([>#])[ \t]*$"
+SSH_COMMAND = "ssh %(user)s@%(address)s"
+PNP_URL = "http://%(address)s/pnp/webui"
+SCHEDULER_POLL = 1.0
+COVERAGE_REPORT_INTERVAL = 600
+FLEET_REPORT_INTERVAL = 60
+
+##
+# errors that end a CLI session on either SSH transport
+##
+SESSION_ERRORS = ssh_transport.ERRORS
+if pexpect is not None:
+    SESSION_ERRORS += (pexpect.TIMEOUT, pexpect.EOF)
+
+##
+# per-stage timers for the run
+##
+TIMINGS = stage_timing.StageTimings()
+
+##
+# per-command timeouts learned from command latencies
+##
+COMMAND_TIMEOUTS = stage_timing.CommandTimeouts(COMMAND_TIMEOUT)
+
+##
+# CSPRNG nonce/correlator source and index of issued nonces
+##
+NONCES = NonceService.NonceService()
+
+##
+# serializes inventory access from verification threads
+##
+STORE_LOCK = threading.Lock()
+
+##
+# adaptive per-site limit on in-flight sudi/auth challenge collections
+##
+SITE_LIMITS = concurrency.SiteLimiter()
+
+##
+# tamper-evident log of results, opened with --audit-log
+##
+AUDIT_LOG = None
+
+##
+# directory verified certificates are spilled to, set with --spill-dir
+##
+EVIDENCE_SPILL = None
+
+##
+# devices held back after failing, kept with --cooldown
+##
+COOLDOWN = None
+
+##
+# columnar history of reported PCRs, kept with --pcr-history
+##
+PCR_HISTORY = None
+
+##
+# memory-mapped index of revoked SUDI certificates, loaded with --revoked
+##
+REVOCATION = None
+
+##
+# fleet aggregates updated as each device finishes, reported every
+# FLEET_REPORT_INTERVAL seconds and kept live in --fleet-stats
+##
+FLEET = fleet_stats.FleetStats()
+FLEET_REPORT_LOCK = threading.Lock()
+NEXT_FLEET_REPORT = time.time() + FLEET_REPORT_INTERVAL
 
 
 ##
@@ -440,16 +607,25 @@ syYPde6JtrC9VapvGknb6X3/XyuH8f/ygZf/WFzxMthTkjVawSiisAyK4NVjVREM
 -----END CERTIFICATE-----
 """)
 
+TRUST_CHAIN_PEMS = (TRUST_CHAIN_PEM1, TRUST_CHAIN_PEM2, TRUST_CHAIN_PEM3, TRUST_CHAIN_PEM4,
+                    TRUST_CHAIN_PEM5, TRUST_CHAIN_PEM6, TRUST_CHAIN_PEM7, TRUST_CHAIN_PEM8,
+                    TRUST_CHAIN_PEM9, TRUST_CHAIN_PEM10, TRUST_CHAIN_PEM11, TRUST_CHAIN_PEM12)
 
+##
+# chain validator, created on first use by create_cert_store()
+##
+CHAIN_VALIDATOR = None
+CHAIN_VALIDATOR_LOCK = threading.Lock()
 
-def get_random_number(size=19, chars=string.digits):
+
+def get_random_number(size=19):
     """
     Generate a random number
         -default size is 19 digits
         -max nonce value that show command can support
     """
 
-    return ''.join(random.choice(chars) for _ in range(size))
+    return NONCES.nonce(size)
 
 
 
@@ -459,7 +635,7 @@ def get_random(size=32, chars=string.ascii_uppercase + string.digits):
     -default size is 32 characters
     """
 
-    return ''.join(random.choice(chars) for _ in range(size))
+    return NONCES.token(size, chars)
 
 
 
@@ -468,125 +644,262 @@ def get_data_from_device(address, userid, pass_wd, cmd):
     Generic PnP Get Device Data
     """
 
-    url = ("http://%s/pnp/webui" % address)
+    url = PNP_URL % {"address": address}
     creds = userid + ":" + pass_wd
     auth_string = base64.b64encode(creds)
     headers = {"Authorization":"Basic " + auth_string}
-    res = requests.post(url, data=cmd, headers=headers, verify=False)
+    res = requests.post(url, data=cmd, headers=headers, verify=False, timeout=PNP_TIMEOUT)
     return res.text
 
 
 
+def stream_device_data(address, userid, pass_wd, cmd, parser):
+    """
+    PnP request whose response body is fed to an incremental
+    parser as it arrives, stopping once the parser is complete
+    """
+
+    url = PNP_URL % {"address": address}
+    creds = userid + ":" + pass_wd
+    auth_string = base64.b64encode(creds)
+    headers = {"Authorization":"Basic " + auth_string}
+    res = requests.post(url, data=cmd, headers=headers, verify=False, stream=True,
+                        timeout=PNP_TIMEOUT)
+    try:
+        for chunk in res.iter_content(READ_CHUNK):
+            parser.feed(chunk)
+            if parser.complete:
+                break
+        parser.finish()
+    finally:
+        res.close()
+    return parser
+
+
+
+def stream_command(p_p, cmd, parser, hostname=None, timeout=None):
+    """
+    Send a command and feed its output to an incremental parser
+    as it arrives, until the parser sees the next prompt (the
+    device's own prompt if its hostname is known); the timeout
+    defaults to the one learned for the command
+    """
+
+    # anything the session already buffered predates the command
+    p_p.buffer = ""
+    parser.echo = cmd
+    parser.hostname = hostname
+    p_p.sendline(cmd)
+
+    start = time.time()
+    deadline = start + (COMMAND_TIMEOUTS.timeout(cmd) if timeout is None else timeout)
+    while not parser.complete:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ssh_transport.SessionTimeout("Timeout waiting for output of '%s'" % cmd)
+        parser.feed(p_p.read_nonblocking(READ_CHUNK, remaining))
+    COMMAND_TIMEOUTS.observe(cmd, time.time() - start)
+    return parser
+
+
+
+def session_expect(p_p, command, pattern):
+    """
+    expect() with the timeout learned for the command just sent,
+    recording how long the device took to answer
+    """
+
+    start = time.time()
+    idx = p_p.expect(pattern, timeout=COMMAND_TIMEOUTS.timeout(command))
+    COMMAND_TIMEOUTS.observe(command, time.time() - start)
+    return idx
+
+
+
+def prompt_pattern(hostname, modes="#>"):
+    """
+    Regex matching only the device's own prompt at the end of the output
+    """
+
+    return r"(?:^|[\r\n])%s[%s][ \t]*$" % (re.escape(hostname), modes)
+
+
+
+def learn_prompt(p_p):
+    """
+    Wait for the first prompt after login, returns the device's
+    hostname and prompt character ('>' or '#' when privileged)
+    """
+
+    session_expect(p_p, "login", PROMPT_PAT)
+    return p_p.match.group(1), p_p.match.group(2)
+
+
+
 def create_cert_store():
     """
-    Create the Certificate Store to use for Validation
+    Create the Certificate Chain Validator to use for Validation
+    (built once and shared by every device in the run)
     """
 
-    trust_chain1 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM1)
-    trust_chain2 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM2)
-    trust_chain3 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM3)
-    trust_chain4 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM4)
-    trust_chain5 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM5)
-    trust_chain6 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM6)
-    trust_chain7 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM7)
-    trust_chain8 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM8)
-    trust_chain9 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM9)
-    trust_chain10 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM10)
-    trust_chain11 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM11)
-    trust_chain12 = crypto.load_certificate(crypto.FILETYPE_PEM, TRUST_CHAIN_PEM12)
-    store = crypto.X509Store()
-    store.add_cert(trust_chain1)
-    store.add_cert(trust_chain2)
-    store.add_cert(trust_chain3)
-    store.add_cert(trust_chain4)
-    store.add_cert(trust_chain5)
-    store.add_cert(trust_chain6)
-    store.add_cert(trust_chain7)
-    store.add_cert(trust_chain8)
-    store.add_cert(trust_chain9)
-    store.add_cert(trust_chain10)
-    store.add_cert(trust_chain11)
-    store.add_cert(trust_chain12)
-    return store
+    global CHAIN_VALIDATOR
+    with CHAIN_VALIDATOR_LOCK:
+        if CHAIN_VALIDATOR is None:
+            trust_chain = [crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+                           for pem in TRUST_CHAIN_PEMS]
+            CHAIN_VALIDATOR = chain_engine.ChainValidator(trust_chain)
+    return CHAIN_VALIDATOR
 
 
 
-def get_device_udi_sudi(address, userid, pass_wd):
+def sudi_revoked(cert):
     """
-    get device UDI and SUDI
+    Serial or fingerprint the SUDI certificate is listed under in the
+    --revoked index, None when it is not listed or there is no index
+    """
+
+    if REVOCATION is None:
+        return None
+    with TIMINGS.stage("revocation_check"):
+        return REVOCATION.revoked(crypto.dump_certificate(crypto.FILETYPE_ASN1, cert))
+
+
+def load_public_key(cert):
+    """
+    Import the key of a crypto.X509 cert into the shared crypto backend
+    """
+
+    backend = CryptoBackend.get_backend()
+    return backend, backend.load_certificate(crypto.dump_certificate(crypto.FILETYPE_ASN1, cert))
+
+
+
+def verify_pnp_signature(cert, signature, data, enc_method, hash_method):
+    """
+    Verify a PnP challenge response with the encryption and hashing
+    method the device reported, checked against its SUDI key type
+    """
+
+    backend, key = load_public_key(cert)
+    try:
+        digest = CryptoBackend.SIGNATURES.pnp_digest(backend.key_type(key), enc_method,
+                                                     hash_method)
+    except AssertionError as err:
+        raise ValueError(str(err))
+    if not backend.verify(key, signature, data, digest):
+        raise ValueError("bad signature")
+
+
+
+def ssh_login(address, userid, pass_wd):
+    """
+    Open a CLI session to the device, over the in-process SSH
+    transport or by spawning SSH_COMMAND under pexpect, and send the
+    login password; returns None if the login did not get that far
     """
 
-    # ssh to the device
-    login_cmd = "ssh %s@%s" % (userid, address)
+    if SSH_TRANSPORT == "paramiko":
+        start = time.time()
+        try:
+            p_p = ssh_transport.ChannelSession.connect(address, ARGS.ssh_port, userid, pass_wd,
+                                                       COMMAND_TIMEOUTS.timeout("ssh"),
+                                                       ARGS.known_hosts,
+                                                       ARGS.accept_new_host_keys)
+        except ssh_transport.SessionClosed as err:
+            print "\t%s" % err
+            return None
+        COMMAND_TIMEOUTS.observe("ssh", time.time() - start)
+        return p_p
+
+    login_cmd = SSH_COMMAND % {"user": userid, "address": address}
     p_p = pexpect.spawn(login_cmd)
 
     # we should get either a password prompt or prompt asking
     # us to add new key for device to known hosts
-    i = p_p.expect(["assword:", "continue connecting", pexpect.TIMEOUT, pexpect.EOF])
+    start = time.time()
+    i = p_p.expect(["assword:", "continue connecting", pexpect.TIMEOUT, pexpect.EOF],
+                   timeout=COMMAND_TIMEOUTS.timeout("ssh"))
+    if i in (0, 1):
+        COMMAND_TIMEOUTS.observe("ssh", time.time() - start)
     if i == 0:
         # got password prompt, send the password
         p_p.sendline(pass_wd)
+    elif i == 1 and not ARGS.accept_new_host_keys:
+        # unknown host key, only trusted with --accept-new-host-keys
+        print "\tHost key of %s is not known, rejected" % address
+        p_p.close()
+        return None
     elif i == 1:
         # got new device key prompt, say yes and then look for password prompt and send it
         p_p.sendline("yes")
         p_p.expect("assword:")
         p_p.sendline(pass_wd)
     else:
-        # either timed out or some other problem, error out
-        print "Failed to login to %s" % address
-        return (-1, "UNKNOWN", "UNKNOWN", "UNKNOWN")
-
-    # should get either non priveledged or priveledged prompt
-    i = p_p.expect([">", "#"])
-    if (i != 0 and i != 1):
-        # don't know what happened, error out
-        print "Uexpected prompt response on %s" % address
-        return (-2, "UNKNOWN", "UNKNOWN", "UNKNOWN")
-
-    # set term length
-    p_p.sendline("term len 0")
-    p_p.expect([">", "#"])
-
-    # get the SUDI
-    p_p.sendline("show crypto pki certificate verbose | i serialNumber=PID:")
-    p_p.expect([">", "#"])
-    response = p_p.before
-    serial_pid = response.split("SN:")
-    serial = serial_pid[1].split("\n")
-    ret_sudi_serial = serial[0]
-    count = len(serial)
-    ret_sudi_serial = ret_sudi_serial[:-1]
-
-    # get PID from same output
-    pid_line = response.split("PID:")
-    pid = pid_line[2].split(" ")
-    ret_dev_pid = pid[0]
-
-    # get prompt from same output
-    prompt_line = response.split("\n")
-    count = len(prompt_line)
-    prompt = prompt_line[count-1]
-
-    # now get the UDI
-    p_p.sendline("show inventory")
-    p_p.expect([prompt])
-    response = p_p.before
-    outlines = response.split("\n")
-    linecount = len(outlines)
-    for i in range(linecount):
-        if (("Chassis" in outlines[i]) or ("chassis" in outlines[i])):
-            ret_udi_line = outlines[i+1]
-            break
-    ret_udi_line = ret_udi_line[:-1]
-    ret_en_udi = ret_udi_line.replace(" ", "")
-    return (0, ret_en_udi, ret_sudi_serial, ret_dev_pid)
+        p_p.close()
+        return None
+    return p_p
+
+
+
+@TIMINGS.timed("get_device_udi_sudi")
+def get_device_udi_sudi(address, userid, pass_wd):
+    """
+    get device UDI and SUDI
+    """
 
+    with TIMINGS.stage("ssh_login"):
+        # ssh to the device
+        p_p = ssh_login(address, userid, pass_wd)
+        if p_p is None:
+            # either timed out or some other problem, error out
+            print "Failed to login to %s" % address
+            return (-1, "UNKNOWN", "UNKNOWN", "UNKNOWN")
+
+        # should get either non priveledged or priveledged prompt,
+        # only that exact prompt ends a command's output from here on
+        try:
+            hostname, _ = learn_prompt(p_p)
+
+            # set term length
+            p_p.sendline("term len 0")
+            session_expect(p_p, "term len 0", prompt_pattern(hostname))
+        except SESSION_ERRORS:
+            # don't know what happened, error out
+            print "Uexpected prompt response on %s" % address
+            p_p.close()
+            return (-2, "UNKNOWN", "UNKNOWN", "UNKNOWN")
 
+    try:
+        with TIMINGS.stage("show_crypto_pki"):
+            # get the SUDI serial and PID
+            pki = stream_command(p_p, "show crypto pki certificate verbose | i serialNumber=PID:",
+                                 device_parsers.PkiSerialParser(), hostname)
+
+        with TIMINGS.stage("show_inventory"):
+            # now get the UDI
+            inventory = stream_command(p_p, "show inventory", device_parsers.InventoryParser(),
+                                       hostname)
+    except SESSION_ERRORS:
+        print "Timed out reading identity from %s" % address
+        return (-3, "UNKNOWN", "UNKNOWN", "UNKNOWN")
+    finally:
+        p_p.close()
+
+    if (("sudi_serial" not in pki.fields) or ("pid" not in pki.fields) or
+            ("udi" not in inventory.fields)):
+        print "Unable to read UDI/SUDI/PID from %s" % address
+        return (-3, "UNKNOWN", "UNKNOWN", "UNKNOWN")
+
+    return (0, inventory.fields["udi"], pki.fields["sudi_serial"], pki.fields["pid"])
 
+
+
+@TIMINGS.timed("get_device_auth_challenge")
 def get_device_auth_challenge(address, userid, pass_wd, in_en_udi, in_sudi_serial,
-                              in_dev_pid, correlator, challenge_phrase):
+                              in_dev_pid, correlator, challenge_phrase, evidence=None):
     """
     Issue Auth Challenge to the Device
+    (the SUDI certificate is kept on the evidence DeviceRecord, if given)
     """
 
     cmd = '''<?xml version="1.0"?>
@@ -601,53 +914,64 @@ def get_device_auth_challenge(address, userid, pass_wd, in_en_udi, in_sudi_seria
         </pnp>
         '''.format(dudi=in_en_udi, pnp_user=userid, pnp_pw=pass_wd, corr=correlator,
                    message=challenge_phrase)
-    resp = get_data_from_device(address, userid, pass_wd, cmd)
+    ## request and parse the XML response as it streams in
+    with TIMINGS.stage("pnp_request"):
+        auth_out = stream_device_data(address, userid, pass_wd, cmd,
+                                      device_parsers.DeviceAuthParser())
 
     ## initialize data we need
-    challenge_rsp = "Unknown"
-    dev_sudi = "Unknown"
-    enc_method = "Unknown"
-    hash_method = "Unknown"
+    challenge_rsp = auth_out.fields.get("challenge_rsp", UNKNOWN_STR)
+    dev_sudi = auth_out.fields.get("sudi_cert", UNKNOWN_STR)
+    enc_method = auth_out.fields.get("enc_method", UNKNOWN_STR)
+    hash_method = auth_out.fields.get("hash_method", UNKNOWN_STR)
     auth_rc = 0
 
-    ## parse XML response
-    elem = ElementTree.fromstring(resp)
-    walk_all = elem.getiterator()
-    for elt in walk_all:
-        if "challenge-response" in elt.tag:
-            challenge_rsp = elt.text
-        if "sudi-cert" in elt.tag:
-            dev_sudi = elt.text
-        if "encryption-method" in elt.tag:
-            enc_method = elt.text
-        if "hashing-method" in elt.tag:
-            hash_method = elt.text
-
     ## make sure we got the data we needed
     if (challenge_rsp is UNKNOWN_STR or dev_sudi is UNKNOWN_STR or
             enc_method is UNKNOWN_STR or hash_method is UNKNOWN_STR):
         print "\tError: Couldn't retrieve device information for authorization"
-        return auth_rc
+        if auth_out.error:
+            print "\t\t%s" % auth_out.error
+        # no usable answer, a failure like a CLI login failure
+        return -1
 
     ## Validate the certificate chain from the device
     dev_sudi_pem = base64.b64decode(dev_sudi)
-    store = create_cert_store()
-    device_cert = crypto.load_certificate(crypto.FILETYPE_PEM, dev_sudi_pem)
-    store_ctx = crypto.X509StoreContext(store, device_cert)
-    verify_rsp = store_ctx.verify_certificate()
-    if verify_rsp is None:
+    # the parsed response is no longer needed
+    auth_out = None
+    if evidence is not None:
+        evidence.certs = (dev_sudi_pem,)
+    with TIMINGS.stage("create_cert_store"):
+        validator = create_cert_store()
+    with TIMINGS.stage("chain_verify"):
+        device_cert = crypto.load_certificate(crypto.FILETYPE_PEM, dev_sudi_pem)
+        link = validator.verify_leaf(device_cert)
+    revoked = sudi_revoked(device_cert)
+    if not link.passed:
+        print "\tCertificate Validation Failed: %s" % link.error
+    elif revoked is not None:
+        print "\tSUDI Revocation Check Failed: %s is revoked" % revoked
+    else:
         print "\tCertificate Validation Passed!"
         auth_rc = auth_rc | 1
-    else:
-        print "\tCertificate Validation Failed!"
 
     ## Validate the signature on the challenge is valid
-    try:
-        verify_rsp = crypto.verify(device_cert, base64.b64decode(challenge_rsp),
-                                   challenge_phrase, hash_method)
-    except:
-        verify_rsp = "Signature Validation Error!"
-        print "\t==> ERROR: %s <==" % verify_rsp
+    with TIMINGS.stage("signature_verify"):
+        nonce_status = NONCES.index.check(challenge_phrase, "pnp", consume=False)
+        if nonce_status != NonceService.NONCE_OK:
+            verify_rsp = "Challenge phrase %s" % nonce_status
+        else:
+            try:
+                verify_rsp = verify_pnp_signature(device_cert, base64.b64decode(challenge_rsp),
+                                                  challenge_phrase, enc_method, hash_method)
+            except:
+                verify_rsp = "Signature Validation Error!"
+                print "\t==> ERROR: %s <==" % verify_rsp
+        ## Consume the challenge only once the signature over it verified
+        if verify_rsp is None:
+            nonce_status = NONCES.index.check(challenge_phrase, "pnp")
+            if nonce_status != NonceService.NONCE_OK:
+                verify_rsp = "Challenge phrase %s" % nonce_status
 
     if verify_rsp is None:
         print "\tProof of Possession Validation Passed!"
@@ -679,161 +1003,109 @@ def get_device_auth_challenge(address, userid, pass_wd, in_en_udi, in_sudi_seria
     return auth_rc
 
 
+@TIMINGS.timed("get_platform_sudi_status")
 def get_platform_sudi_status(address, userid, pass_wd, in_en_udi, in_sudi_serial,
-                             in_dev_pid, nonce):
+                             in_dev_pid, nonce, evidence=None):
     """
     Validate Status of the Platform SUDI using CLI
+    (the certificates and reported PCR0/PCR8 are kept on the
+    evidence DeviceRecord, if given)
     """
 
-    # ssh to the device
-    login_cmd = "ssh %s@%s" % (userid, address)
-    p_p = pexpect.spawn(login_cmd)
-
-    # we should get either a password prompt or prompt asking
-    # us to add new key for device to known hosts
-    i = p_p.expect(["assword:", "continue connecting", pexpect.TIMEOUT, pexpect.EOF])
-    if i == 0:
-        # got password prompt, send the password
-        p_p.sendline(pass_wd)
-    elif i == 1:
-        # got new device key prompt, say yes and then look for password prompt and send it
-        p_p.sendline("yes")
-        p_p.expect("assword:")
-        p_p.sendline(pass_wd)
-    else:
-        # either timed out or some other problem, error out
-        print "Failed to login to %s" % address
-        return -1
-
-    # should get either non priveledged or priveledged prompt
-    i = p_p.expect([">", "#"])
-    if i == 0:
-        # not in priv mode, enter priv mode
-        p_p.sendline("enable")
-        p_p.expect("assword:")
-        p_p.sendline(in_en_udi)
-    elif i == 1:
-        # already in priv mode
-        p_p.sendline("\n")
-    else:
-        # don't know what happened, error out
-        print "Uexpected prompt response on %s" % address
-        return -2
-
-    # should be in priv mode, set term length
-    p_p.expect("#")
-    p_p.sendline("term len 0")
-    p_p.expect("#")
-
-    # issue the show sudi command
-    sudi_cmd = 'show platform sudi cert sign nonce ' + nonce
-    p_p.sendline(sudi_cmd)
-    p_p.expect("#")
-    response_output = p_p.before
-
-    # parse the response from the show sudi command
-    data_lines = response_output.split("\n")
-    line_count = len(data_lines)
-    auth_rc = 0
-    sig_ver = 0
-    signature = ""
-    dev_crca_pem = ""
-    dev_cmca_pem = ""
-    dev_sudi_pem = ""
-    cert_num = 1
-    for i in range(line_count):
-        if "show platform" in data_lines[i]:
-            continue
-        elif "Signature version:" in data_lines[i]:
-            temp = data_lines[i].split(":")
-            signature_version = temp[1]
-            sig_ver = signature_version.lstrip()
-        elif "Signature:" in data_lines[i]:
-            signature = data_lines[i+1]
-            break
-        else:
-            if cert_num == 1:
-                dev_crca_pem = dev_crca_pem + data_lines[i] + "\n"
-            if cert_num == 2:
-                dev_cmca_pem = dev_cmca_pem + data_lines[i] + "\n"
-            if cert_num == 3:
-                dev_sudi_pem = dev_sudi_pem + data_lines[i] + "\n"
-            if "END CERTIFICATE" in data_lines[i]:
-                cert_num += 1
-
-    ## check data received
-    if ((sig_ver == 0) or (signature == "") or (dev_crca_pem == "") or
-            (dev_cmca_pem == "") or (dev_sudi_pem == "")):
-        print "\tError! Didn't received valid data from device!"
-        return -3
+    with TIMINGS.stage("ssh_login"):
+        # ssh to the device
+        p_p = ssh_login(address, userid, pass_wd)
+        if p_p is None:
+            # either timed out or some other problem, error out
+            print "Failed to login to %s" % address
+            return -1
+
+        # should get either non priveledged or priveledged prompt,
+        # only that exact prompt ends a command's output from here on
+        try:
+            hostname, mode = learn_prompt(p_p)
+            if mode == ">":
+                # not in priv mode, enter priv mode
+                p_p.sendline("enable")
+                session_expect(p_p, "enable", "assword:")
+                p_p.sendline(in_en_udi)
+                session_expect(p_p, "enable", prompt_pattern(hostname, "#"))
+
+            # should be in priv mode, set term length
+            p_p.sendline("term len 0")
+            session_expect(p_p, "term len 0", prompt_pattern(hostname, "#"))
+        except SESSION_ERRORS:
+            # don't know what happened, error out
+            print "Uexpected prompt response on %s" % address
+            p_p.close()
+            return -2
+
+    with TIMINGS.stage("show_platform_sudi"):
+        # issue the show sudi command, certificates are parsed as they arrive
+        sudi_cmd = 'show platform sudi cert sign nonce ' + nonce
+        try:
+            sudi_out = stream_command(p_p, sudi_cmd, device_parsers.SudiCertParser(), hostname)
+        except SESSION_ERRORS:
+            print "\tError! Didn't received valid data from device!"
+            p_p.close()
+            return -3
+
+        auth_rc = 0
+        sig_ver = sudi_out.fields.get("sig_ver", 0)
+        signature = sudi_out.fields.get("signature", "")
+
+        ## check data received
+        if ((sig_ver == 0) or (signature == "") or (len(sudi_out.certs) < 3) or
+                (sudi_out.error is not None)):
+            print "\tError! Didn't received valid data from device!"
+            p_p.close()
+            return -3
+        dev_crca_pem, dev_cmca_pem, dev_sudi_pem = sudi_out.certs[:3]
+        if evidence is not None:
+            evidence.certs = (dev_crca_pem, dev_cmca_pem, dev_sudi_pem)
+        # the parser holds nothing else worth keeping
+        sudi_out = None
 
     ## Validate the certificate chain from the device
-    store = create_cert_store()
-    device_crca = crypto.load_certificate(crypto.FILETYPE_PEM, dev_crca_pem)
-    device_cmca = crypto.load_certificate(crypto.FILETYPE_PEM, dev_cmca_pem)
-    device_sudi = crypto.load_certificate(crypto.FILETYPE_PEM, dev_sudi_pem)
-
-    # verify the root ca certificate
-    store_ctx = crypto.X509StoreContext(store, device_crca)
-    verify_rsp = store_ctx.verify_certificate()
-    if verify_rsp is None:
-        print "\tRoot Certificate Validation Passed!"
-        # root ca certificate passed, check the manufacturing cert now
-        store_ctx = crypto.X509StoreContext(store, device_cmca)
-        verify_rsp = store_ctx.verify_certificate()
-        if verify_rsp is None:
-            print "\tManufacturing Certificate Validation Passed!"
-            # manufacturing cert passed, check the SUDI now
-            store_ctx = crypto.X509StoreContext(store, device_sudi)
-            verify_rsp = store_ctx.verify_certificate()
-            if verify_rsp is None:
-                print "\tSUDI Certificate Validation Passed!"
-                # all 3 certs passed, set the return code bit
-                print "\tCertificate Chain Validation Passed!"
-                auth_rc = auth_rc | 1
-            else:
-                print "\tSUDI Certificate Validation Failed!"
-                print "\tCertificate Chain Validation Passed!"
+    with TIMINGS.stage("create_cert_store"):
+        validator = create_cert_store()
+    with TIMINGS.stage("chain_verify"):
+        device_crca = crypto.load_certificate(crypto.FILETYPE_PEM, dev_crca_pem)
+        device_cmca = crypto.load_certificate(crypto.FILETYPE_PEM, dev_cmca_pem)
+        device_sudi = crypto.load_certificate(crypto.FILETYPE_PEM, dev_sudi_pem)
+
+        # validate root -> manufacturing -> SUDI, each link against its issuer
+        links = validator.verify_path([device_crca, device_cmca, device_sudi])
+    for link in links:
+        if link.passed:
+            print "\t%s Certificate Validation Passed!%s" % (
+                link.label, " (cached)" if link.cached else "")
         else:
-            print "\tManufacturing Certificate Validation Failed!"
-            print "\tCertificate Chain Validation Passed!"
-    else:
-        print "\tRoot Certificate Validation Failed!"
+            print "\t%s Certificate Validation Failed: %s" % (link.label, link.error)
+    revoked = sudi_revoked(device_sudi)
+    if revoked is not None:
+        print "\tSUDI Revocation Check Failed: %s is revoked" % revoked
+    if all(link.passed for link in links) and revoked is None:
+        # all 3 certs passed, set the return code bit
         print "\tCertificate Chain Validation Passed!"
-
-    ## concatenate the nonce and signature version
-    nonce_array = format(long(nonce), "X")
-    sig_ver_array = format(long(sig_ver), "08X")
-    data_to_verify = nonce_array + sig_ver_array
-
-    ## add in the hex representation of the root certificate
-    lines = dev_crca_pem.replace(" ", '').split()
-    der = binascii.a2b_base64(''.join(lines[1:-1]))
-    data_to_verify = data_to_verify + binascii.hexlify(der)
-
-    ## add in the hex representation of the manufacturing cert
-    lines = dev_cmca_pem.replace(" ", '').split()
-    der = binascii.a2b_base64(''.join(lines[1:-1]))
-    data_to_verify = data_to_verify + binascii.hexlify(der)
-
-    ## add in the hex representation of the SUDI cert
-    lines = dev_sudi_pem.replace(" ", '').split()
-    der = binascii.a2b_base64(''.join(lines[1:-1]))
-    data_to_verify = data_to_verify + binascii.hexlify(der)
-    data_to_verify = data_to_verify.upper()
-    data_bytes = binascii.a2b_hex(data_to_verify)
-
-    # convert the signature to binary
-    signature = signature[:-1]
-    signature = signature.upper()
-    signature_bytes = binascii.a2b_hex(signature)
-
-    # verify the signature over the data
-    try:
-        verify_rsp = crypto.verify(device_sudi, signature_bytes, data_bytes, 'sha256')
-    except:
-        verify_rsp = "Signature Validation Error!"
-        print "\t==> ERROR: %s <==" % verify_rsp
+        auth_rc = auth_rc | 1
+    else:
+        print "\tCertificate Chain Validation Failed!"
+
+    with TIMINGS.stage("signature_verify"):
+        # same verification core as VerifyBIV, over the DER certificates
+        cert_ders = VerifySignature.der_certificates(dev_crca_pem + dev_cmca_pem + dev_sudi_pem)
+        try:
+            if VerifySignature.verify_sudi_evidence(nonce, sig_ver, signature, cert_ders,
+                                                    NONCES.index):
+                verify_rsp = None
+            else:
+                verify_rsp = "bad signature"
+        except AssertionError as err:
+            verify_rsp = str(err)
+        except:
+            verify_rsp = "Signature Validation Error!"
+            print "\t==> ERROR: %s <==" % verify_rsp
 
     if verify_rsp is None:
         print "\tProof of Possession Validation Passed!"
@@ -863,68 +1135,55 @@ def get_platform_sudi_status(address, userid, pass_wd, in_en_udi, in_sudi_serial
         print "\t\tExpected: %s, Found: %s" % (in_dev_pid, pid_serial[0])
 
 
-    # issue the show platform integrity command
-    sudi_cmd = 'show platform integrity sign nonce ' + nonce
-    p_p.sendline(sudi_cmd)
-    p_p.expect("#")
-    response_output = p_p.before
-
-    # parse the response from the show sudi command
-    data_lines = response_output.split("\n")
-    line_count = len(data_lines)
-    sig_ver = 0
-    signature = ""
-    pcr0 = ""
-    pcr8 = ""
-    for i in range(line_count):
-        if "Signature version:" in data_lines[i]:
-            temp = data_lines[i].split(":")
-            signature_version = temp[1]
-            sig_ver = signature_version.lstrip()
-        elif "Signature:" in data_lines[i]:
-            signature = data_lines[i+1]
-            break
-        elif "PCR0:" in data_lines[i]:
-            temp = data_lines[i].split(":")
-            pcr0_data = temp[1]
-            pcr0 = pcr0_data.lstrip()
-            pcr0 = pcr0[:-1]
-        elif "PCR8:" in data_lines[i]:
-            temp = data_lines[i].split(":")
-            pcr8_data = temp[1]
-            pcr8 = pcr8_data.lstrip()
-            pcr8 = pcr8[:-1]
-
-    ## check data received
-    if ((sig_ver == 0) or (signature == "") or (pcr0 == "") or
-            (pcr8 == "")):
-        print "\tError! Didn't received valid data from device!"
-        return -3
-
-    ## concatenate the nonce and signature version
-    nonce_array = format(long(nonce), "X")
-    sig_ver_array = format(long(sig_ver), "08X")
-    data_to_verify = nonce_array + sig_ver_array
-
-    ## add in the PCR0
-    data_to_verify = data_to_verify + pcr0
-
-    ## add in the PCR8
-    data_to_verify = data_to_verify + pcr8
-    data_to_verify = data_to_verify.upper()
-    data_bytes = binascii.a2b_hex(data_to_verify)
-
-    # convert the signature to binary
-    signature = signature[:-1]
-    signature = signature.upper()
-    signature_bytes = binascii.a2b_hex(signature)
-
-    # verify the signature over the data
-    try:
-        verify_rsp = crypto.verify(device_sudi, signature_bytes, data_bytes, 'sha256')
-    except:
-        verify_rsp = "Boot Integrity Signature Validation Error!"
-        print "\t==> ERROR: %s <==" % verify_rsp
+    with TIMINGS.stage("show_platform_integrity"):
+        # issue the show platform integrity command
+        sudi_cmd = 'show platform integrity sign nonce ' + nonce
+        try:
+            integrity_out = stream_command(p_p, sudi_cmd, device_parsers.IntegrityParser(),
+                                           hostname)
+        except SESSION_ERRORS:
+            print "\tError! Didn't received valid data from device!"
+            return -3
+        finally:
+            p_p.close()
+
+        sig_ver = integrity_out.fields.get("sig_ver", 0)
+        signature = integrity_out.fields.get("signature", "")
+        pcr0 = integrity_out.fields.get("pcr0", "")
+        pcr8 = integrity_out.fields.get("pcr8", "")
+        boot0_hash = integrity_out.fields.get("boot0_hash")
+        bootldr_hash = integrity_out.fields.get("bootldr_hash")
+        os_hashes = integrity_out.fields.get("os_hashes")
+        if not os_hashes and integrity_out.fields.get("os_hash"):
+            os_hashes = [integrity_out.fields["os_hash"]]
+        if evidence is not None:
+            evidence.pcr0 = pcr0
+            evidence.pcr8 = pcr8
+            evidence.boot_version = (integrity_out.fields.get("bootldr_version") or
+                                     integrity_out.fields.get("boot0_version"))
+            evidence.os_version = integrity_out.fields.get("os_version")
+        integrity_out = None
+
+        ## check data received
+        if ((sig_ver == 0) or (signature == "") or (pcr0 == "") or
+                (pcr8 == "")):
+            print "\tError! Didn't received valid data from device!"
+            return -3
+
+    with TIMINGS.stage("integrity_verify"):
+        # PCRs are recomputed from the reported hashes, as VerifyBIV does
+        try:
+            if VerifySignature.verify_integrity_evidence(nonce, sig_ver, signature, pcr0, pcr8,
+                                                         boot0_hash, bootldr_hash, os_hashes,
+                                                         cert_ders[-1], NONCES.index):
+                verify_rsp = None
+            else:
+                verify_rsp = "bad signature"
+        except AssertionError as err:
+            verify_rsp = str(err)
+        except:
+            verify_rsp = "Boot Integrity Signature Validation Error!"
+            print "\t==> ERROR: %s <==" % verify_rsp
 
     if verify_rsp is None:
         print "\tBoot Integrity Validation Passed!"
@@ -935,44 +1194,416 @@ def get_platform_sudi_status(address, userid, pass_wd, in_en_udi, in_sudi_serial
     return auth_rc
 
 
-def device_pnp_method(dev_addr, userid, pass_wd, in_en_udi, in_sudi_serial, in_dev_pid):
+def device_pnp_method(device):
     """
     PnP Processing
     """
 
-    if ((in_en_udi == "UNKNOWN") or (in_sudi_serial == "UNKNOWN") or (in_dev_pid == "UNKNOWN")):
+    if not device.identity_known():
         print "\tMissing UDI/SUDI/PID for device, retrieving"
-        r_c, in_en_udi, in_sudi_serial, in_dev_pid = get_device_udi_sudi(dev_addr, userid, pass_wd)
+        r_c, en_udi, sudi_serial, dev_pid = get_device_udi_sudi(device.address, device.user,
+                                                                device.passwd)
         if r_c < 0:
-            return (0, in_en_udi, in_sudi_serial, in_dev_pid)
-        else:
-            print "\tUDI(%s) retrieved and stored in dataset" % in_en_udi
-            print "\tSUDI(%s) retrieved and stored in dataset" % in_sudi_serial
-            print "\tPID(%s) retrieved and stored in dataset" % in_dev_pid
+            return 0
+        device.en_udi, device.sudi_serial, device.pid = en_udi, sudi_serial, dev_pid
+        print "\tUDI(%s) retrieved and stored in dataset" % device.en_udi
+        print "\tSUDI(%s) retrieved and stored in dataset" % device.sudi_serial
+        print "\tPID(%s) retrieved and stored in dataset" % device.pid
+
+    device.nonce = get_random()
 
-    r_c = get_device_auth_challenge(dev_addr, userid, pass_wd, in_en_udi, in_sudi_serial,
-                                    in_dev_pid, get_random(7), get_random())
-    return (r_c, in_en_udi, in_sudi_serial, in_dev_pid)
+    # requests errors (timeouts included) raise, which counts against
+    # the site's limit
+    try:
+        with SITE_LIMITS.slot(device.site) as outcome:
+            r_c = get_device_auth_challenge(device.address, device.user, device.passwd,
+                                            device.en_udi, device.sudi_serial, device.pid,
+                                            get_random(7), device.nonce, device)
+            # so does a response without the challenge answer
+            outcome.error = r_c < 0
+    except requests.RequestException as err:
+        # unreachable or timed out, a failure like a CLI login failure
+        print "\tError: PnP request to %s failed: %s" % (device.address, err)
+        return -1
+    return r_c
 
 
 
-def device_cli_method(dev_addr, userid, pass_wd, in_en_udi, in_sudi_serial, in_dev_pid):
+def device_cli_method(device):
     """
     CLI Processing
     """
 
-    if ((in_sudi_serial == "UNKNOWN") or (in_dev_pid == "UNKNOWN")):
+    if ((device.sudi_serial == "UNKNOWN") or (device.pid == "UNKNOWN")):
         print "\tMissing SUDI/PID for device, retrieving"
-        r_c, temp, in_sudi_serial, in_dev_pid = get_device_udi_sudi(dev_addr, userid, pass_wd)
+        r_c, temp, sudi_serial, dev_pid = get_device_udi_sudi(device.address, device.user,
+                                                              device.passwd)
         if r_c < 0:
-            return (0, in_en_udi, in_sudi_serial, in_dev_pid)
+            return 0
+        device.sudi_serial, device.pid = sudi_serial, dev_pid
+        print "\tSUDI(%s) retrieved and stored in dataset" % device.sudi_serial
+        print "\tPID(%s) retrieved and stored in dataset" % device.pid
+
+    device.nonce = get_random_number()
+
+    with SITE_LIMITS.slot(device.site) as outcome:
+        r_c = get_platform_sudi_status(device.address, device.user, device.passwd,
+                                       device.en_udi, device.sudi_serial, device.pid,
+                                       device.nonce, device)
+        # negative return codes are login failures and timeouts
+        outcome.error = r_c < 0
+    return r_c
+
+
+
+@TIMINGS.timed("verify_device")
+def verify_device(device):
+    """
+    Run the requested validation method against a single device
+    (a DeviceRecord, updated with what was learned and the result)
+    """
+
+    rc = 0
+    print "Verifying %s using %s:" % (device.address, device.method)
+    if device.method == "PNP":
+        rc = device_pnp_method(device)
+    elif device.method == "CLI":
+        rc = device_cli_method(device)
+    else:
+        print "\tERROR: Unknown processing method %s" % device.method
+    device.auth_rc = rc
+    return rc
+
+
+
+def process_row(store, row, site=None):
+    """
+    Validate the device in one inventory row and store what was learned
+    """
+
+    rc = sanity_check_row(row)
+    if rc == 0:
+        # row we wanted to process was invalid, leave it as is
+        return None
+
+    if site is None:
+        with STORE_LOCK:
+            site = store.site_of(row[0])
+    device = device_record.DeviceRecord.from_row(row, site)
+
+    start = time.time()
+    if ARGS.profile:
+        rc = stage_timing.profile_call(ARGS.profile, verify_device, device)
+    else:
+        rc = verify_device(device)
+    FLEET.add(device, rc, time.time() - start)
+
+    if rc == device_record.pass_rc(device.method):
+        print "Result: Passed(%d)\n\n" %  rc
+    else:
+        print "Result: Failed(%d)\n\n" %  rc
+
+    # certificates are only needed until the device is verified
+    device.release(EVIDENCE_SPILL)
+
+    # store any identity learned from the device
+    with STORE_LOCK:
+        if device.identity_known():
+            store.update_identity(device.address, device.en_udi, device.sudi_serial, device.pid)
+        store.record_result(device.address, rc)
+
+    if AUDIT_LOG is not None:
+        AUDIT_LOG.append(device.audit_record())
+    if PCR_HISTORY is not None and (device.pcr0 or device.pcr8):
+        PCR_HISTORY.append(device.address, device.pcr0, device.pcr8, device.boot_version,
+                           device.os_version, rc)
+
+    # negative return codes are login failures and timeouts
+    if COOLDOWN is not None:
+        if rc < 0:
+            COOLDOWN.failed(device.address)
+        else:
+            COOLDOWN.succeeded(device.address)
+    report_fleet()
+    return rc
+
+
+
+def report_fleet(force=False):
+    """
+    Print the fleet progress line and refresh the --fleet-stats file,
+    at most once every FLEET_REPORT_INTERVAL seconds unless forced
+    """
+
+    global NEXT_FLEET_REPORT
+    with FLEET_REPORT_LOCK:
+        now = time.time()
+        if not force and now < NEXT_FLEET_REPORT:
+            return
+        NEXT_FLEET_REPORT = now + FLEET_REPORT_INTERVAL
+        print FLEET.progress_line()
+        if ARGS.fleet_stats:
+            FLEET.write(ARGS.fleet_stats)
+
+
+
+def collection_port(row):
+    """
+    TCP port a device is collected on: the PnP listener or SSH
+    """
+
+    if row[1] == "PNP":
+        url = urlparse.urlparse(PNP_URL % {"address": row[0]})
+        return url.port or (443 if url.scheme == "https" else 80)
+    return ARGS.ssh_port
+
+
+
+def reachable_rows(store, rows):
+    """
+    Return the rows worth a collection session and the rows of
+    devices skipped while on cooldown. With --prescan, devices not
+    accepting a connection on their collection port are dropped too,
+    recorded as login failures and put on cooldown.
+    """
+
+    now = time.time()
+    collect = []
+    skipped = []
+    for row in rows:
+        if COOLDOWN is not None and COOLDOWN.blocked(row[0], now):
+            skipped.append(row)
         else:
-            print "\tSUDI(%s) retrieved and stored in dataset" % in_sudi_serial
-            print "\tPID(%s) retrieved and stored in dataset" % in_dev_pid
+            collect.append(row)
+    if skipped:
+        print "Skipping %d devices on cooldown after recent failures" % len(skipped)
+
+    if not ARGS.prescan or not collect:
+        return collect, skipped
+
+    targets = dict((row[0], (row[0], collection_port(row))) for row in collect if len(row) >= 4)
+    probes = reachability.prescan(set(targets.values()), ARGS.connect_timeout)
+    reachable = []
+    for row in collect:
+        target = targets.get(row[0])
+        error = probes.get(target) if target else None
+        if error is None:
+            reachable.append(row)
+            continue
+        print "%s unreachable on port %d: %s" % (row[0], target[1], error)
+        with STORE_LOCK:
+            store.record_result(row[0], -1)
+        if COOLDOWN is not None:
+            COOLDOWN.failed(row[0], now)
+    print "Pre-scan: %d of %d devices reachable" % (len(reachable), len(collect))
+    return reachable, skipped
+
+
+
+def read_reboot_hints(schedule, path):
+    """
+    Pull forward devices listed (one address per line) in the
+    reboot hints file, then empty the file
+    """
+
+    if not path or not os.path.exists(path):
+        return
+    with open(path, 'r+') as hints:
+        addresses = hints.read().split()
+        hints.seek(0)
+        hints.truncate()
+    for address in addresses:
+        schedule.hint_reboot(address)
+
+
+
+def site_cap(site):
+    """
+    Devices of a site to verify at once: its adaptive limit, capped
+    by --site-inflight
+    """
+
+    if ARGS.site_inflight:
+        return min(ARGS.site_inflight, SITE_LIMITS.limit(site))
+    return SITE_LIMITS.limit(site)
+
+
 
-    r_c = get_platform_sudi_status(dev_addr, userid, pass_wd, in_en_udi, in_sudi_serial,
-                                   in_dev_pid, get_random_number())
-    return (r_c, in_en_udi, in_sudi_serial, in_dev_pid)
+def run_batch(store, rows, done=None):
+    """
+    Verify the rows once, as many at a time as the adaptive per-site
+    limits admit (at most --workers); done(row, rc) is called for
+    every row, rc None when the row was invalid or raised
+    """
+
+    queues = {}
+    for row in rows:
+        with STORE_LOCK:
+            site = store.site_of(row[0])
+        queues.setdefault(site, deque()).append(row)
+    inflight = {}
+    busy = [0]
+    threads = []
+    work = Queue.Queue()
+    busy_cond = threading.Condition()
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            site, row = item
+            try:
+                rc = process_row(store, row, site)
+            except Exception as err:
+                print "Error validating %s: %s" % (row[0], err)
+                rc = None
+            if done is not None:
+                done(row, rc)
+            with busy_cond:
+                busy[0] -= 1
+                inflight[site] -= 1
+                busy_cond.notify()
+
+    with busy_cond:
+        while queues or busy[0]:
+            for site in queues.keys():
+                queue = queues[site]
+                # the limits adapt as collections finish, re-read each pass
+                while (queue and inflight.get(site, 0) < site_cap(site) and
+                       (not ARGS.workers or busy[0] < ARGS.workers)):
+                    inflight[site] = inflight.get(site, 0) + 1
+                    busy[0] += 1
+                    if len(threads) < busy[0]:
+                        thread = threading.Thread(target=worker)
+                        thread.daemon = True
+                        thread.start()
+                        threads.append(thread)
+                    work.put((site, queue.popleft()))
+                if not queue:
+                    del queues[site]
+            if queues or busy[0]:
+                # woken when a collection finishes
+                busy_cond.wait(SCHEDULER_POLL)
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+
+
+def run_continuous(store, rows):
+    """
+    Verify the selected rows continuously, every device at least
+    once per period, with verification spread across the period
+    """
+
+    addresses = set(row[0] for row in rows)
+    schedule = scheduler.RollingScheduler(ARGS.continuous * 3600, site_cap)
+    with STORE_LOCK:
+        schedule.load([state for state in store.schedule_state() if state[0] in addresses])
+
+    sites = set(device.site for device in schedule.devices.values())
+    def capacity():
+        # concurrent verifications follow the sum of the site limits,
+        # --workers only caps them
+        total = sum(site_cap(site) for site in sites)
+        return min(total, ARGS.workers) if ARGS.workers else total
+
+    work = Queue.Queue()
+    busy = [0]
+    threads = []
+    busy_cond = threading.Condition()
+
+    def finished():
+        with busy_cond:
+            busy[0] -= 1
+            busy_cond.notify()
+
+    def worker():
+        while True:
+            device = work.get()
+            hold = COOLDOWN.blocked(device.address) if COOLDOWN is not None else 0
+            if hold:
+                # failed recently, try again once the cooldown is over
+                schedule.postpone(device, hold)
+                finished()
+                continue
+            with STORE_LOCK:
+                found = store.select(address=device.address)
+            try:
+                rc = process_row(store, found[0]) if found else None
+            except Exception as err:
+                print "Error validating %s: %s" % (device.address, err)
+                rc = None
+            schedule.done(device, bool(found) and rc == device_record.pass_rc(found[0][1]))
+            finished()
+
+    print "Verifying %d devices every %.1f hours, %d at a time to start" % (
+        len(schedule.devices), ARGS.continuous, capacity())
+    next_report = time.time() + COVERAGE_REPORT_INTERVAL
+    try:
+        while True:
+            read_reboot_hints(schedule, ARGS.reboot_hints)
+            with busy_cond:
+                free = capacity() - busy[0]
+            devices = schedule.take(free) if free > 0 else []
+            with busy_cond:
+                busy[0] += len(devices)
+                # threads only ever block on the queue, keep one per busy slot
+                while len(threads) < busy[0]:
+                    thread = threading.Thread(target=worker)
+                    thread.daemon = True
+                    thread.start()
+                    threads.append(thread)
+            for device in devices:
+                work.put(device)
+
+            if time.time() >= next_report:
+                print "Coverage: %.1f%% of %d devices passed in the last period" % (
+                    100 * schedule.coverage(), len(schedule.devices))
+                next_report = time.time() + COVERAGE_REPORT_INTERVAL
+
+            if devices:
+                continue
+            wait = schedule.next_due()
+            with busy_cond:
+                # woken early when a worker frees up
+                busy_cond.wait(SCHEDULER_POLL if not wait else min(wait, SCHEDULER_POLL))
+    except KeyboardInterrupt:
+        print "Stopping continuous verification"
+
+
+
+def run_worker(store):
+    """
+    Verify the devices the coordinator assigns to this worker
+    until every device of the run has a result
+    """
+
+    store.join()
+    store.start_heartbeat()
+    print "Worker %s joined %s" % (store.worker, store.url)
+    try:
+        while True:
+            rows = store.assignment()
+            if rows is None:
+                break
+            if not rows:
+                # other workers still finishing, wait for a rebalance
+                time.sleep(SCHEDULER_POLL)
+                continue
+            rows, skipped = reachable_rows(store, rows)
+            for row in skipped:
+                # still settle it with the coordinator
+                store.record_result(row[0], None)
+            def settle(row, rc):
+                if rc is None:
+                    # invalid row or error: still settle it with the coordinator
+                    store.record_result(row[0], None)
+            run_batch(store, rows, settle)
+    finally:
+        store.leave()
 
 
 
@@ -1001,86 +1632,200 @@ def sanity_check_row(in_row):
 # parse the input arguments to the command
 PARSER = argparse.ArgumentParser()
 PARSER.add_argument("a", nargs='?', default="ALL")
+PARSER.add_argument("--inventory", metavar="FILE", default=DEVICE_FILE,
+                    help="device inventory, a CSV file or an SQLite database (.db)")
+PARSER.add_argument("--import-csv", metavar="CSV",
+                    help="load devices from a CSV file into the SQLite inventory and exit")
+PARSER.add_argument("--site", help="only validate devices at this site (SQLite inventory)")
+PARSER.add_argument("--pid", help="only validate devices with this product id")
+PARSER.add_argument("--stale-hours", type=float, metavar="HOURS",
+                    help="only validate devices that have not passed within HOURS")
+PARSER.add_argument("--metrics", metavar="FILE",
+                    help="write per-stage timing histograms in Prometheus text format")
+PARSER.add_argument("--profile", metavar="FILE",
+                    help="run the single device under cProfile and save the stats")
+PARSER.add_argument("--audit-log", metavar="FILE",
+                    help="append results to a Merkle tree audit log (see audit_log.py)")
+PARSER.add_argument("--continuous", type=float, metavar="HOURS",
+                    help="keep verifying the selected devices, each at least once every HOURS")
+PARSER.add_argument("--workers", type=int, metavar="N",
+                    help="at most N verifications at a time (default: the sum of the "
+                    "adaptive per-site limits)")
+PARSER.add_argument("--site-inflight", type=int, metavar="N",
+                    help="at most N devices of one site at a time")
+PARSER.add_argument("--reboot-hints", metavar="FILE",
+                    help="continuous mode: file of rebooted device addresses to verify first")
+PARSER.add_argument("--coordinate", metavar="[HOST:]PORT",
+                    help="coordinate a sharded run of the selected devices over workers "
+                    "(HOST defaults to 127.0.0.1)")
+PARSER.add_argument("--worker", metavar="URL",
+                    help="verify devices assigned by a coordinator, e.g. https://HOST:PORT")
+PARSER.add_argument("--shard-secret", metavar="FILE",
+                    help="file holding the secret shared by the coordinator and its workers")
+PARSER.add_argument("--shard-cert", metavar="FILE",
+                    help="coordinator TLS certificate (PEM), needed off the loopback address")
+PARSER.add_argument("--shard-key", metavar="FILE", help="coordinator TLS private key (PEM)")
+PARSER.add_argument("--shard-ca", metavar="FILE",
+                    help="CA certificates workers verify the coordinator with")
+PARSER.add_argument("--worker-id", help="worker name (default hostname:pid)")
+PARSER.add_argument("--spill-dir", metavar="DIR",
+                    help="write each device's certificates to DIR once verified")
+PARSER.add_argument("--prescan", action="store_true",
+                    help="probe every device's collection port first, skip unreachable ones")
+PARSER.add_argument("--connect-timeout", type=float, default=reachability.CONNECT_TIMEOUT,
+                    metavar="SECONDS", help="pre-scan connect timeout (default %(default)s)")
+PARSER.add_argument("--ssh-port", type=int, default=22,
+                    help="SSH port of CLI devices, for the pre-scan and the paramiko "
+                    "transport (default %(default)s)")
+PARSER.add_argument("--cooldown", metavar="FILE",
+                    help="hold back devices that failed recently, with exponential backoff")
+PARSER.add_argument("--latency-history", metavar="FILE",
+                    help="learn per-command CLI timeouts from latencies kept in FILE")
+PARSER.add_argument("--pcr-history", metavar="DIR",
+                    help="append each device's PCR0/PCR8 and versions to a columnar "
+                    "history in DIR, query it with ./pcr_history.py")
+PARSER.add_argument("--fleet-stats", metavar="FILE",
+                    help="keep a JSON fleet summary in FILE, refreshed every %d seconds "
+                    "during the run" % FLEET_REPORT_INTERVAL)
+PARSER.add_argument("--revoked", metavar="INDEX",
+                    help="fail the chain check of SUDI certificates listed in INDEX, built "
+                    "with ../RevocationIndex.py build")
+PARSER.add_argument("--ssh-transport", choices=("auto", "paramiko", "pexpect"), default="auto",
+                    help="CLI sessions in process (paramiko) or by spawning --ssh-command "
+                    "(pexpect); auto uses paramiko if installed and --ssh-command is not set")
+PARSER.add_argument("--known-hosts", default=ssh_transport.KNOWN_HOSTS, metavar="FILE",
+                    help="host keys the paramiko transport checks devices against, "
+                    "default %(default)s")
+PARSER.add_argument("--accept-new-host-keys", action="store_true",
+                    help="trust the host key of devices seen for the first time and save it "
+                    "(changed keys are still rejected)")
+PARSER.add_argument("--ssh-command", default=SSH_COMMAND, metavar="TEMPLATE",
+                    help="CLI login command, default '%(default)s'")
+PARSER.add_argument("--pnp-url", default=PNP_URL, metavar="TEMPLATE",
+                    help="PnP listener URL, default '%(default)s'")
 ARGS = PARSER.parse_args()
 SEARCH_IP = ARGS.a
-
-# read in the device file and either process all
-# entries or just the one supplied on the command line
-with open(DEVICE_FILE, 'rb') as csvfile:
-    ## open a new output file
-    with open(OUTPUT_FILE, 'wb') as csv_outfile:
-        CSV_OUT = csv.writer(csv_outfile, delimiter=',', quotechar='"')
-
-        ## read the device file contents
-        DEVFILE = csv.reader(csvfile, delimiter=',', quotechar='"')
-        for row in DEVFILE:
-            # check for device address passed in on command line
-            if SEARCH_IP != "ALL":
-                if SEARCH_IP != row[0]:
-                    # not the device we want to verify, skip it
-                    CSV_OUT.writerow(row)
-                    continue
-
-            rc = sanity_check_row(row)
-            if rc == 0:
-                # row we wanted to process was invalid, write out and continue
-                CSV_OUT.writerow(row)
-                continue
-
-            # store required parameters
-            dev_address = row[0]
-            method = row[1]
-            user = row[2]
-            passwd = row[3]
-            en_udi = "UNKNOWN"
-            sudi_serial = "UNKNOWN"
-            dev_pid = "UNKNOWN"
-
-            # partial 5 tuples
-            if rc == 5:
-                en_udi = row[4]
-
-            # partial 6 tuples
-            elif rc == 6:
-                en_udi = row[4]
-                sudi_serial = row[5]
-
-            # Full parameter list
-            elif rc == 7:
-                en_udi = row[4]
-                sudi_serial = row[5]
-                dev_pid = row[6]
-
-            # shouldn't get here
-            else:
-                # row we wanted to process is fubar somehow, skip it
-                CSV_OUT.writerow(row)
-                continue
-
-            rc = 0
-            print "Verifying %s using %s:" % (dev_address, method)
-            if method == "PNP":
-                rc, en_udi, sudi_serial, dev_pid = device_pnp_method(dev_address, user, passwd,
-                                                                     en_udi, sudi_serial, dev_pid)
-            elif method == "CLI":
-                rc, en_udi, sudi_serial, dev_pid = device_cli_method(dev_address, user, passwd,
-                                                                     en_udi, sudi_serial, dev_pid)
-            else:
-                print "\tERROR: Unknown processing method %s" % method
-
-            if rc == 31:
-                print "Result: Passed(%d)\n\n" %  rc
-            else:
-                print "Result: Failed(%d)\n\n" %  rc
-
-            # write out the row to the output file
-            if (en_udi == "UNKNOWN" or sudi_serial == "UNKNOWN" or dev_pid == "UNKNOWN"):
-                CSV_OUT.writerow(row)
-            else:
-                CSV_OUT.writerow([dev_address, method, user, passwd, en_udi, sudi_serial, dev_pid])
+SSH_COMMAND = ARGS.ssh_command
+SSH_TRANSPORT = ARGS.ssh_transport
+if SSH_TRANSPORT == "auto":
+    # a custom ssh command only means something to the pexpect transport
+    USE_PARAMIKO = ssh_transport.available() and (pexpect is None or
+                                                   SSH_COMMAND == PARSER.get_default("ssh_command"))
+    SSH_TRANSPORT = "paramiko" if USE_PARAMIKO else "pexpect"
+if SSH_TRANSPORT == "paramiko" and not ssh_transport.available():
+    PARSER.error("--ssh-transport paramiko requires the paramiko package")
+if SSH_TRANSPORT == "pexpect" and pexpect is None:
+    PARSER.error("the pexpect package is required without paramiko")
+PNP_URL = ARGS.pnp_url
+
+if ARGS.profile and SEARCH_IP == "ALL":
+    PARSER.error("--profile requires a single device address")
+
+SHARD_SECRET = None
+if ARGS.coordinate or ARGS.worker:
+    if not ARGS.shard_secret:
+        PARSER.error("--coordinate and --worker require --shard-secret")
+    try:
+        SHARD_SECRET = sharding.read_secret(ARGS.shard_secret)
+    except (IOError, ValueError) as err:
+        PARSER.error(str(err))
+if ARGS.worker:
+    # identity and results are merged into the coordinator's inventory
+    STORE = sharding.CoordinatorStore(
+        ARGS.worker, ARGS.worker_id or "%s:%d" % (socket.gethostname(), os.getpid()),
+        SHARD_SECRET, ARGS.shard_ca)
+else:
+    STORE = inventory.open_inventory(ARGS.inventory, OUTPUT_FILE, OLD_DEVICE_FILE)
+if ARGS.coordinate and not isinstance(STORE, inventory.SqliteInventory):
+    # the CSV format keeps no results, the workers' results would be lost
+    PARSER.error("--coordinate requires an SQLite --inventory")
+if ARGS.audit_log:
+    AUDIT_LOG = audit_log.AuditLog(ARGS.audit_log)
+if ARGS.spill_dir:
+    EVIDENCE_SPILL = device_record.EvidenceSpill(ARGS.spill_dir)
+if ARGS.cooldown:
+    COOLDOWN = reachability.Cooldown(ARGS.cooldown)
+if ARGS.latency_history:
+    COMMAND_TIMEOUTS = stage_timing.CommandTimeouts(COMMAND_TIMEOUT, path=ARGS.latency_history)
+if ARGS.pcr_history:
+    PCR_HISTORY = pcr_history.PcrHistory(ARGS.pcr_history)
+if ARGS.revoked:
+    REVOCATION = RevocationIndex.RevocationIndex(ARGS.revoked)
+
+if ARGS.import_csv:
+    if ARGS.worker or not isinstance(STORE, inventory.SqliteInventory):
+        PARSER.error("--import-csv requires an SQLite --inventory")
+    print "Imported %d devices into %s" % (STORE.import_csv(ARGS.import_csv, ARGS.site),
+                                           ARGS.inventory)
+    STORE.close()
+    sys.exit(0)
+
+# select either all entries, the one supplied on the command
+# line or the requested subset from the inventory
+VERIFIED_BEFORE = None
+if ARGS.stale_hours is not None:
+    VERIFIED_BEFORE = time.time() - ARGS.stale_hours * 3600
+ROWS = []
+if not ARGS.worker:
+    try:
+        ROWS = STORE.select(address=None if SEARCH_IP == "ALL" else SEARCH_IP,
+                            site=ARGS.site, pid=ARGS.pid, verified_before=VERIFIED_BEFORE)
+    except ValueError as err:
+        PARSER.error(str(err))
+
+if ARGS.coordinate:
+    COORDINATOR = sharding.Coordinator(STORE, ROWS, SHARD_SECRET)
+    HOST, _, PORT = ARGS.coordinate.rpartition(":")
+    HOST = HOST or "127.0.0.1"
+    if HOST not in sharding.LOOPBACK and not (ARGS.shard_cert and ARGS.shard_key):
+        PARSER.error("--coordinate on %s requires --shard-cert and --shard-key" % HOST)
+    print "Coordinating %d devices on %s" % (len(ROWS), ARGS.coordinate)
+    COORDINATOR.serve(HOST, int(PORT), certfile=ARGS.shard_cert, keyfile=ARGS.shard_key)
+    print "\nSharded run results:"
+    for line in COORDINATOR.report_lines():
+        print "\t" + line
+elif ARGS.worker:
+    run_worker(STORE)
+elif ARGS.continuous:
+    run_continuous(STORE, ROWS)
+else:
+    run_batch(STORE, reachable_rows(STORE, ROWS)[0])
 
 # update the data files
-print "Updating the %s file to contain latest data" % DEVICE_FILE
-os.rename(DEVICE_FILE, OLD_DEVICE_FILE)
-os.rename(OUTPUT_FILE, DEVICE_FILE)
+if ARGS.worker:
+    print "Results were merged into the coordinator's inventory"
+else:
+    print "Updating the %s file to contain latest data" % ARGS.inventory
+STORE.close()
+if COOLDOWN is not None:
+    COOLDOWN.save()
+COMMAND_TIMEOUTS.save()
+if PCR_HISTORY is not None:
+    PCR_HISTORY.close()
+if AUDIT_LOG is not None:
+    AUDIT_LOG.close()
+    print "Audit log %s sealed, latest batch root %s" % (ARGS.audit_log, AUDIT_LOG.last_root)
+
+# report where the time went
+print "\nStage timings:"
+for line in TIMINGS.summary_lines():
+    print "\t" + line
+print "\nCLI command timeouts:"
+for line in COMMAND_TIMEOUTS.summary_lines():
+    print "\t" + line
+print "\nSite concurrency limits:"
+for line in SITE_LIMITS.summary_lines():
+    print "\t" + line
+print "\nFleet summary:"
+for line in FLEET.summary_lines():
+    print "\t" + line
+if ARGS.fleet_stats:
+    FLEET.write(ARGS.fleet_stats)
+    print "Fleet summary written to %s" % ARGS.fleet_stats
+if ARGS.metrics:
+    TIMINGS.write_prometheus(ARGS.metrics)
+    with open(ARGS.metrics, 'a') as metrics_file:
+        metrics_file.write(SITE_LIMITS.prometheus_text())
+        metrics_file.write(FLEET.prometheus_text())
+    print "Stage timing metrics written to %s" % ARGS.metrics
 print "Finished Processing"
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Online fleet aggregates for device_validation.
+Every finished device updates running counts by PID, site, boot
+and OS version, by failed auth_rc check and by collection error,
+plus a verification time histogram, so a fleet summary is ready
+at any point of a run without another pass over the logs. Memory
+does not grow with the fleet: each grouping keeps at most
+MAX_GROUPS distinct values and folds the rest into "(other)".
+"""
+###############################################
+#
+# File Name: fleet_stats.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import json
+import time
+import threading
+import stage_timing
+import device_record
+
+##
+# auth_rc bits, in the order the checks run
+##
+AUTH_CHECKS = ((1, "chain"),
+               (2, "proof_of_possession"),
+               (4, "sudi_serial"),
+               (8, "pid"),
+               (16, "integrity"))
+# PnP has no integrity check
+PNP_CHECKS = AUTH_CHECKS[:4]
+
+##
+# collection errors (auth_rc <= 0)
+##
+RC_ERRORS = {0: "not_verified", -1: "login", -2: "prompt", -3: "no_data"}
+
+GROUPINGS = ("pid", "site", "boot_version", "os_version")
+# distinct values kept per grouping, the rest are counted as OTHER
+MAX_GROUPS = 256
+OTHER = "(other)"
+UNKNOWN = "(unknown)"
+
+
+class FleetStats(object):
+    """
+    Running fleet aggregates, safe to update from worker threads
+    """
+
+    def __init__(self, max_groups=MAX_GROUPS):
+        self.max_groups = max_groups
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.devices = 0
+        self.passed = 0
+        # grouping -> value -> [devices, passed]
+        self.groups = dict((name, {}) for name in GROUPINGS)
+        self.failed_checks = dict((name, 0) for _, name in AUTH_CHECKS)
+        self.errors = {}
+        self.latency = stage_timing.Histogram()
+
+    def _group(self, grouping, value, passed):
+        values = self.groups[grouping]
+        key = value or UNKNOWN
+        if key not in values and len(values) >= self.max_groups:
+            key = OTHER
+        counts = values.setdefault(key, [0, 0])
+        counts[0] += 1
+        counts[1] += passed
+
+    def add(self, device, rc, seconds):
+        """
+        Count one finished device (a DeviceRecord) with its auth_rc and
+        verification time
+        """
+
+        passed = int(rc == device_record.pass_rc(device.method))
+        checks = PNP_CHECKS if device.method == "PNP" else AUTH_CHECKS
+        with self.lock:
+            self.devices += 1
+            self.passed += passed
+            self.latency.observe(seconds)
+            if rc > 0:
+                for bit, name in checks:
+                    if not rc & bit:
+                        self.failed_checks[name] += 1
+            else:
+                error = RC_ERRORS.get(rc, "rc %d" % rc)
+                self.errors[error] = self.errors.get(error, 0) + 1
+            self._group("pid", device.pid if device.pid != "UNKNOWN" else None, passed)
+            self._group("site", device.site, passed)
+            self._group("boot_version", device.boot_version, passed)
+            self._group("os_version", device.os_version, passed)
+
+    def snapshot(self):
+        """
+        JSON serializable copy of the aggregates
+        """
+
+        with self.lock:
+            elapsed = time.time() - self.started
+            latency = dict(("p%d" % pct, round(self.latency.percentile(pct), 3))
+                           for pct in stage_timing.SUMMARY_PERCENTILES)
+            latency["max"] = round(self.latency.max, 3)
+            return {"time": round(time.time(), 3),
+                    "elapsed": round(elapsed, 1),
+                    "devices": self.devices,
+                    "passed": self.passed,
+                    "failed": self.devices - self.passed,
+                    "devices_per_minute": round(60 * self.devices / elapsed, 1) if elapsed else 0,
+                    "failed_checks": dict(self.failed_checks),
+                    "errors": dict(self.errors),
+                    "latency_seconds": latency,
+                    "groups": dict((grouping, dict((value, {"devices": counts[0],
+                                                            "passed": counts[1]})
+                                                   for value, counts in values.items()))
+                                   for grouping, values in self.groups.items())}
+
+    def progress_line(self):
+        """
+        One line view of the run so far
+        """
+
+        with self.lock:
+            if not self.devices:
+                return "Fleet: no devices finished yet"
+            failed = self.devices - self.passed
+            return "Fleet: %d devices, %d passed, %d failed, p50 %.1fs p99 %.1fs" % (
+                self.devices, self.passed, failed, self.latency.percentile(50),
+                self.latency.percentile(99))
+
+    def summary_lines(self, top=10):
+        """
+        Human readable fleet summary, the top groups of each grouping
+        """
+
+        data = self.snapshot()
+        lines = ["%d devices: %d passed, %d failed (%.1f per minute)" % (
+            data["devices"], data["passed"], data["failed"], data["devices_per_minute"])]
+        lines.append("verification time: " + "  ".join(
+            "%s %.3fs" % (name, data["latency_seconds"][name])
+            for name in ["p%d" % pct for pct in stage_timing.SUMMARY_PERCENTILES] + ["max"]))
+        failed = ", ".join("%s %d" % (name, data["failed_checks"][name])
+                           for _, name in AUTH_CHECKS if data["failed_checks"][name])
+        lines.append("failed checks: " + (failed or "none"))
+        if data["errors"]:
+            lines.append("collection errors: " + ", ".join(
+                "%s %d" % item for item in sorted(data["errors"].items())))
+        for grouping in GROUPINGS:
+            values = sorted(data["groups"][grouping].items(),
+                            key=lambda item: (-item[1]["devices"], item[0]))
+            for value, counts in values[:top]:
+                lines.append("%-12s %-40s %7d devices %7d passed" % (
+                    grouping, value[:40], counts["devices"], counts["passed"]))
+            if len(values) > top:
+                lines.append("%-12s ... %d more" % (grouping, len(values) - top))
+        return lines
+
+    def write(self, path):
+        """
+        Replace path with the current snapshot (JSON)
+        """
+
+        data = json.dumps(self.snapshot(), indent=1, sort_keys=True)
+        with open(path + ".tmp", 'w') as stats_file:
+            stats_file.write(data)
+        os.rename(path + ".tmp", path)
+
+    def prometheus_text(self, prefix="device_validation"):
+        """
+        Fleet counters in Prometheus text exposition format
+        """
+
+        data = self.snapshot()
+        out = ["# HELP %s_fleet_devices Devices verified in this run." % prefix,
+               "# TYPE %s_fleet_devices gauge" % prefix,
+               '%s_fleet_devices{result="passed"} %d' % (prefix, data["passed"]),
+               '%s_fleet_devices{result="failed"} %d' % (prefix, data["failed"]),
+               "# HELP %s_fleet_failed_checks Devices failing each auth_rc check." % prefix,
+               "# TYPE %s_fleet_failed_checks gauge" % prefix]
+        for _, name in AUTH_CHECKS:
+            out.append('%s_fleet_failed_checks{check="%s"} %d' %
+                       (prefix, name, data["failed_checks"][name]))
+        out.extend(["# HELP %s_fleet_group_devices Devices per PID, site and version." % prefix,
+                    "# TYPE %s_fleet_group_devices gauge" % prefix])
+        for grouping in GROUPINGS:
+            for value, counts in sorted(data["groups"][grouping].items()):
+                out.append('%s_fleet_group_devices{group="%s",value="%s"} %d' %
+                           (prefix, grouping, value.replace('\\', '\\\\').replace('"', '\\"'),
+                            counts["devices"]))
+        return "\n".join(out) + "\n"
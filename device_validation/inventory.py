@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Device inventory backends for device_validation.
+The CSV backend keeps the original devices.csv behaviour; the
+SQLite backend indexes address, SUDI serial, PID, site and last
+verified (passed) time so single devices and subsets are selected without
+scanning or rewriting the whole fleet.
+"""
+###############################################
+#
+# File Name: inventory.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import csv
+import time
+import sqlite3
+import device_record
+
+##
+# CSV File Format (CLI): address,method,user,pass,en_pass,sudi_serial,pid
+# CSV File Format (PNP): address,method,user,pass,udi,sudi_serial,pid
+##
+ROW_FIELDS = ("address", "method", "user", "passwd", "en_udi", "sudi_serial", "pid")
+DEFAULT_SITE = "default"
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    address TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    user TEXT NOT NULL,
+    passwd TEXT NOT NULL,
+    en_udi TEXT,
+    sudi_serial TEXT,
+    pid TEXT,
+    site TEXT NOT NULL DEFAULT 'default',
+    last_verified REAL,
+    last_attempt REAL,
+    last_rc INTEGER
+);
+CREATE INDEX IF NOT EXISTS devices_sudi_serial ON devices (sudi_serial);
+CREATE INDEX IF NOT EXISTS devices_pid ON devices (pid);
+CREATE INDEX IF NOT EXISTS devices_site ON devices (site, last_verified);
+CREATE INDEX IF NOT EXISTS devices_last_verified ON devices (last_verified);
+"""
+
+
+def open_inventory(path, output_path=None, old_path=None):
+    """
+    Open the inventory backend matching the file name
+    """
+
+    if path.lower().endswith(SQLITE_SUFFIXES):
+        return SqliteInventory(path)
+    return CsvInventory(path, output_path, old_path)
+
+
+class CsvInventory(object):
+    """
+    devices.csv backed inventory
+
+    Rows are loaded once with an address index, updated in memory and
+    the file is rewritten on close, keeping the original as old_path.
+    There is no site or last verified information in the CSV format.
+    """
+
+    def __init__(self, path, output_path=None, old_path=None):
+        self.path = path
+        self.output_path = output_path or path + ".new"
+        self.old_path = old_path or os.path.splitext(path)[0] + ".old.csv"
+        self.rows = []
+        self.by_address = {}
+        with open(path, 'rb') as csvfile:
+            for row in csv.reader(csvfile, delimiter=',', quotechar='"'):
+                if not row:
+                    continue
+                self.by_address.setdefault(row[0], []).append(len(self.rows))
+                self.rows.append(row)
+
+    def select(self, address=None, site=None, pid=None, verified_before=None):
+        """
+        Rows matching all of the given criteria
+        """
+
+        if site is not None:
+            raise ValueError("site selection requires an SQLite inventory")
+
+        # rows are never marked verified in CSV, so verified_before matches all
+        if address is not None:
+            candidates = [self.rows[i] for i in self.by_address.get(address, [])]
+        else:
+            candidates = self.rows
+        return [row for row in candidates
+                if pid is None or (len(row) > 6 and row[6] == pid)]
+
+    def site_of(self, address):
+        """
+        Site the device belongs to
+        """
+
+        return DEFAULT_SITE
+
+    def schedule_state(self):
+        """
+        (address, site, last_verified) for every device
+        """
+
+        return [(address, DEFAULT_SITE, None) for address in self.by_address]
+
+    def update_identity(self, address, en_udi, sudi_serial, pid):
+        """
+        Store learned UDI, SUDI serial and PID for a device
+        """
+
+        for i in self.by_address.get(address, []):
+            row = self.rows[i]
+            self.rows[i] = row[:4] + [en_udi, sudi_serial, pid]
+
+    def record_result(self, address, auth_rc, when=None):
+        """
+        Result bookkeeping is not kept in the CSV format
+        """
+
+        pass
+
+    def close(self):
+        """
+        Rewrite the CSV file, keeping the previous version
+        """
+
+        with open(self.output_path, 'wb') as csv_outfile:
+            csv_out = csv.writer(csv_outfile, delimiter=',', quotechar='"')
+            for row in self.rows:
+                csv_out.writerow(row)
+        os.rename(self.path, self.old_path)
+        os.rename(self.output_path, self.path)
+
+
+class SqliteInventory(object):
+    """
+    SQLite backed inventory with indexed lookups
+
+    Learned identity fields and results are updated per row, so a
+    run only touches the rows it verifies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+        columns = [info[1] for info in self.conn.execute("PRAGMA table_info(devices)")]
+        if "last_attempt" not in columns:
+            # inventories created before attempts were kept apart
+            self.conn.execute("ALTER TABLE devices ADD COLUMN last_attempt REAL")
+            self.conn.commit()
+
+    def import_csv(self, csv_path, site=None):
+        """
+        Load (or replace) devices from a devices.csv style file
+        """
+
+        count = 0
+        with open(csv_path, 'rb') as csvfile:
+            for row in csv.reader(csvfile, delimiter=',', quotechar='"'):
+                if len(row) < 4:
+                    continue
+                fields = (row + [None] * len(ROW_FIELDS))[:len(ROW_FIELDS)]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO devices (%s, site) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    % ", ".join(ROW_FIELDS), fields + [site or DEFAULT_SITE])
+                count += 1
+        self.conn.commit()
+        return count
+
+    def select(self, address=None, site=None, pid=None, verified_before=None):
+        """
+        Rows matching all of the given criteria, in devices.csv layout
+        """
+
+        where = []
+        params = []
+        if address is not None:
+            where.append("address = ?")
+            params.append(address)
+        if site is not None:
+            where.append("site = ?")
+            params.append(site)
+        if pid is not None:
+            where.append("pid = ?")
+            params.append(pid)
+        if verified_before is not None:
+            where.append("(last_verified IS NULL OR last_verified < ?)")
+            params.append(verified_before)
+
+        query = "SELECT %s FROM devices" % ", ".join(ROW_FIELDS)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        rows = []
+        for record in self.conn.execute(query, params).fetchall():
+            row = [field if field is not None else "" for field in record]
+            # drop trailing unknown fields so the row length matches the CSV layout
+            while len(row) > 4 and row[-1] == "":
+                row.pop()
+            rows.append(row)
+        return rows
+
+    def site_of(self, address):
+        """
+        Site the device belongs to
+        """
+
+        record = self.conn.execute("SELECT site FROM devices WHERE address = ?",
+                                   (address,)).fetchone()
+        return record[0] if record else DEFAULT_SITE
+
+    def schedule_state(self):
+        """
+        (address, site, last_verified) for every device
+        """
+
+        return self.conn.execute("SELECT address, site, last_verified FROM devices").fetchall()
+
+    def update_identity(self, address, en_udi, sudi_serial, pid):
+        """
+        Store learned UDI, SUDI serial and PID for a device
+        """
+
+        self.conn.execute("UPDATE devices SET en_udi = ?, sudi_serial = ?, pid = ? "
+                          "WHERE address = ?", (en_udi, sudi_serial, pid, address))
+        self.conn.commit()
+
+    def record_result(self, address, auth_rc, when=None):
+        """
+        Store the result and time of the latest attempt; last_verified
+        only moves when the device passed, so failed and unreachable
+        devices stay due for --stale-hours and the scheduler
+        """
+
+        when = time.time() if when is None else when
+        record = self.conn.execute("SELECT method FROM devices WHERE address = ?",
+                                   (address,)).fetchone()
+        if record is None:
+            return
+        if auth_rc == device_record.pass_rc(record[0]):
+            self.conn.execute("UPDATE devices SET last_rc = ?, last_attempt = ?, "
+                              "last_verified = ? WHERE address = ?",
+                              (auth_rc, when, when, address))
+        else:
+            self.conn.execute("UPDATE devices SET last_rc = ?, last_attempt = ? "
+                              "WHERE address = ?", (auth_rc, when, address))
+        self.conn.commit()
+
+    def close(self):
+        """
+        Close the database
+        """
+
+        self.conn.close()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Columnar history of PCR values for device_validation.
+Every verification appends one row (device, time, PCR0, PCR8,
+boot loader and OS version, auth_rc) to a directory of fixed
+width binary column files; devices and versions are dictionary
+encoded. Queries memory-map only the columns they need and scan
+them in chunks, so the history never has to be loaded whole.
+
+   ./pcr_history.py DIR changed pcr8 [--days 7]
+   ./pcr_history.py DIR distribution pcr0
+   ./pcr_history.py DIR history <ip address>
+"""
+###############################################
+#
+# File Name: pcr_history.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import sys
+import mmap
+import time
+import array
+import struct
+import argparse
+import binascii
+import threading
+from collections import Counter
+
+##
+# column name -> struct format; device, boot and os are dictionary ids
+##
+COLUMNS = (("device", "I"),
+           ("time", "d"),
+           ("pcr0", "32s"),
+           ("pcr8", "32s"),
+           ("boot", "I"),
+           ("os", "I"),
+           ("auth_rc", "b"))
+WIDTHS = dict((name, struct.calcsize("<" + fmt)) for name, fmt in COLUMNS)
+
+# rows decoded per step of a scan
+SCAN_CHUNK = 65536
+NO_PCR = "\x00" * 32
+
+
+def _pcr_bytes(value):
+    """
+    Binary PCR from its hex form, zeros when unknown
+    """
+
+    if not value:
+        return NO_PCR
+    return binascii.unhexlify(value)
+
+
+class _Index(object):
+    """
+    Append-only string dictionary kept in a text file
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.values = []
+        if os.path.exists(path):
+            with open(path, 'rb') as dict_file:
+                # a value still being written has no newline yet
+                self.values = dict_file.read().split("\n")[:-1]
+        self.ids = dict((value, idx) for idx, value in enumerate(self.values))
+        self.dict_file = None if readonly else open(path, 'ab')
+
+    def id_of(self, value):
+        value = (value or "").replace("\n", " ")
+        idx = self.ids.get(value)
+        if idx is None:
+            idx = self.ids[value] = len(self.values)
+            self.values.append(value)
+            self.dict_file.write(value + "\n")
+            self.dict_file.flush()
+        return idx
+
+    def close(self):
+        if self.dict_file is not None:
+            self.dict_file.close()
+
+
+class _Column(object):
+    """
+    Read-only memory map of one column file
+    """
+
+    def __init__(self, path, fmt, rows):
+        self.fmt = fmt
+        self.width = struct.calcsize("<" + fmt)
+        self.rows = rows
+        self.map = None
+        if rows:
+            with open(path, 'rb') as col_file:
+                self.map = mmap.mmap(col_file.fileno(), rows * self.width,
+                                     access=mmap.ACCESS_READ)
+
+    def numbers(self, start, stop):
+        """
+        Numeric values of rows [start, stop) as an array
+        """
+
+        values = array.array(self.fmt)
+        if stop > start:
+            values.fromstring(self.map[start * self.width:stop * self.width])
+            if sys.byteorder != "little":
+                values.byteswap()
+        return values
+
+    def value(self, row):
+        """
+        Raw bytes of one fixed width row
+        """
+
+        return self.map[row * self.width:(row + 1) * self.width]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+
+class PcrHistory(object):
+    """
+    Columnar PCR history in a directory
+
+    append() is thread safe. Rows are appended in time order, which
+    lets time windows be found by binary search.
+
+    Only one writer may open a directory. A readonly history (the
+    query CLI) can be opened while the writer runs: it sees the rows
+    every column held when it was opened and never modifies a file.
+    """
+
+    def __init__(self, directory, readonly=False):
+        self.directory = directory
+        self.readonly = readonly
+        if not readonly and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.files = {}
+
+        # rows every column holds; the dictionaries are read after the
+        # columns, and are written before them, so they cover every row
+        self.rows = min(self._size(name) // WIDTHS[name] for name, _ in COLUMNS)
+        self.devices = _Index(os.path.join(directory, "devices.dict"), readonly)
+        self.versions = _Index(os.path.join(directory, "versions.dict"), readonly)
+        self.last_time = 0.0
+        if self.rows:
+            times, = self._columns("time")
+            self.last_time = times.numbers(self.rows - 1, self.rows)[0]
+            times.close()
+
+        if not readonly:
+            # a torn append leaves some columns a row longer; drop it
+            for name, _ in COLUMNS:
+                col_file = open(self._path(name), 'ab')
+                col_file.truncate(self.rows * WIDTHS[name])
+                self.files[name] = col_file
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".col")
+
+    def _size(self, name):
+        path = self._path(name)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, address, pcr0, pcr8, boot_version=None, os_version=None, auth_rc=0,
+               when=None):
+        """
+        Add the result of one verification (PCRs in hex, None if unknown)
+
+        Times never go back: a when earlier than the last row is
+        recorded as the time of the last row.
+        """
+
+        with self.lock:
+            when = time.time() if when is None else when
+            self.last_time = max(self.last_time, when)
+            values = {"device": self.devices.id_of(address),
+                      "time": self.last_time,
+                      "pcr0": _pcr_bytes(pcr0),
+                      "pcr8": _pcr_bytes(pcr8),
+                      "boot": self.versions.id_of(boot_version),
+                      "os": self.versions.id_of(os_version),
+                      "auth_rc": max(-128, min(127, auth_rc))}
+            for name, fmt in COLUMNS:
+                self.files[name].write(struct.pack("<" + fmt, values[name]))
+            # flush the row to every column, so the columns on disk never
+            # drift more than a row apart and readers see it right away
+            for name, _ in COLUMNS:
+                self.files[name].flush()
+            self.rows += 1
+
+    def flush(self):
+        with self.lock:
+            for col_file in self.files.values():
+                col_file.flush()
+
+    def close(self):
+        with self.lock:
+            for col_file in self.files.values():
+                col_file.close()
+            self.devices.close()
+            self.versions.close()
+
+    def _columns(self, *names):
+        """
+        Memory maps of the named columns over the rows written so far
+        """
+
+        self.flush()
+        formats = dict(COLUMNS)
+        return [_Column(self._path(name), formats[name], self.rows) for name in names]
+
+    @staticmethod
+    def _first_row_at(times, when):
+        """
+        First row whose time is at least when (binary search)
+        """
+
+        low, high = 0, times.rows
+        while low < high:
+            mid = (low + high) // 2
+            if times.numbers(mid, mid + 1)[0] < when:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def changes(self, column, since, until=None):
+        """
+        PCR changes with a time in [since, until)
+
+        Returns (address, time, previous hex, new hex) tuples in time
+        order. Only the window and, going back from its start, enough
+        rows to find each device's previous value are scanned.
+        """
+
+        devices, times, values = self._columns("device", "time", column)
+        try:
+            start = self._first_row_at(times, since)
+            stop = self.rows if until is None else self._first_row_at(times, until)
+
+            # devices seen in the window need their value from before it
+            pending = set()
+            for chunk in range(start, stop, SCAN_CHUNK):
+                pending.update(devices.numbers(chunk, min(stop, chunk + SCAN_CHUNK)))
+            last = {}
+            row = start
+            while pending and row > 0:
+                low = max(0, row - SCAN_CHUNK)
+                ids = devices.numbers(low, row)
+                for idx in range(len(ids) - 1, -1, -1):
+                    device = ids[idx]
+                    if device in pending:
+                        value = values.value(low + idx)
+                        if value != NO_PCR:
+                            last[device] = value
+                            pending.discard(device)
+                row = low
+
+            found = []
+            for chunk in range(start, stop, SCAN_CHUNK):
+                end = min(stop, chunk + SCAN_CHUNK)
+                ids = devices.numbers(chunk, end)
+                stamps = times.numbers(chunk, end)
+                for idx, device in enumerate(ids):
+                    value = values.value(chunk + idx)
+                    if value == NO_PCR:
+                        continue
+                    previous = last.get(device)
+                    if previous is not None and previous != value:
+                        found.append((self.devices.values[device], stamps[idx],
+                                      binascii.hexlify(previous).upper(),
+                                      binascii.hexlify(value).upper()))
+                    last[device] = value
+            return found
+        finally:
+            for col in (devices, times, values):
+                col.close()
+
+    def distribution(self, column):
+        """
+        Fleet distribution of the latest known value of a PCR
+
+        Returns (hex value, device count) tuples, most common first.
+        The scan runs backwards and stops once every device is seen.
+        """
+
+        devices, values = self._columns("device", column)
+        try:
+            latest = {}
+            remaining = len(self.devices.values)
+            row = self.rows
+            while row > 0 and len(latest) < remaining:
+                low = max(0, row - SCAN_CHUNK)
+                ids = devices.numbers(low, row)
+                for idx in range(len(ids) - 1, -1, -1):
+                    if ids[idx] not in latest:
+                        value = values.value(low + idx)
+                        if value != NO_PCR:
+                            latest[ids[idx]] = value
+                row = low
+            counts = Counter(binascii.hexlify(value).upper() for value in latest.values())
+            return counts.most_common()
+        finally:
+            devices.close()
+            values.close()
+
+    def history(self, address):
+        """
+        (time, PCR0, PCR8, boot version, OS version, auth_rc) of every
+        verification of one device
+        """
+
+        device = self.devices.ids.get(address)
+        if device is None:
+            return []
+        columns = self._columns("device", "time", "pcr0", "pcr8", "boot", "os", "auth_rc")
+        devices, times, pcr0, pcr8, boot, os_col, auth_rc = columns
+        try:
+            rows = []
+            for chunk in range(0, self.rows, SCAN_CHUNK):
+                ids = devices.numbers(chunk, min(self.rows, chunk + SCAN_CHUNK))
+                for idx, found in enumerate(ids):
+                    if found != device:
+                        continue
+                    row = chunk + idx
+                    rows.append((times.numbers(row, row + 1)[0],
+                                 binascii.hexlify(pcr0.value(row)).upper(),
+                                 binascii.hexlify(pcr8.value(row)).upper(),
+                                 self.versions.values[boot.numbers(row, row + 1)[0]],
+                                 self.versions.values[os_col.numbers(row, row + 1)[0]],
+                                 auth_rc.numbers(row, row + 1)[0]))
+            return rows
+        finally:
+            for col in columns:
+                col.close()
+
+
+def _when(stamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="query the PCR history")
+    PARSER.add_argument("directory")
+    PARSER.add_argument("query", choices=("changed", "distribution", "history"))
+    PARSER.add_argument("target", help="pcr0 or pcr8, or the device address for history")
+    PARSER.add_argument("--days", type=float, default=7,
+                        help="changed: look back this many days (default %(default)s)")
+    ARGS = PARSER.parse_args()
+    if not os.path.isdir(ARGS.directory):
+        PARSER.error("no PCR history in %s" % ARGS.directory)
+    HISTORY = PcrHistory(ARGS.directory, readonly=True)
+    if ARGS.query != "history" and ARGS.target not in ("pcr0", "pcr8"):
+        PARSER.error("target must be pcr0 or pcr8")
+
+    if ARGS.query == "changed":
+        CHANGES = HISTORY.changes(ARGS.target, time.time() - ARGS.days * 86400)
+        for address, stamp, old, new in CHANGES:
+            print "%s  %-15s %s -> %s" % (_when(stamp), address, old, new)
+        print "%d %s changes in the last %g days" % (len(CHANGES), ARGS.target.upper(),
+                                                    ARGS.days)
+    elif ARGS.query == "distribution":
+        for value, count in HISTORY.distribution(ARGS.target):
+            print "%7d  %s" % (count, value)
+    else:
+        for stamp, pcr0, pcr8, boot, os_version, rc in HISTORY.history(ARGS.target):
+            print "%s  rc %3d  PCR0 %s  PCR8 %s  boot %s  OS %s" % (
+                _when(stamp), rc, pcr0, pcr8, boot, os_version)
+    HISTORY.close()
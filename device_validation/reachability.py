@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Reachability pre-scan for device_validation.
+Before collection every selected device gets a TCP connect probe
+on its collection port (SSH for CLI, the PnP listener for PNP).
+Probes run concurrently with non-blocking sockets, so a scan of
+the whole inventory costs about one connect timeout. Devices that
+were unreachable or failed to log in recently are held back on a
+cooldown list with exponential backoff.
+"""
+###############################################
+#
+# File Name: reachability.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import json
+import time
+import errno
+import select
+import socket
+import threading
+
+##
+# probe and backoff constants (seconds)
+##
+CONNECT_TIMEOUT = 3.0
+MAX_PARALLEL_PROBES = 512
+COOLDOWN_BASE = 60
+COOLDOWN_MAX = 24 * 3600
+
+
+def prescan(targets, timeout=CONNECT_TIMEOUT, parallel=MAX_PARALLEL_PROBES):
+    """
+    TCP connect probe of (address, port) targets
+
+    Up to parallel connects are in flight at a time. Returns a dict
+    of target -> None if it accepted the connection, or the error.
+    """
+
+    results = {}
+    pending = list(targets)
+    while pending:
+        batch, pending = pending[:parallel], pending[parallel:]
+        in_flight = {}
+        for target in batch:
+            try:
+                family, kind, proto, _, sockaddr = socket.getaddrinfo(
+                    target[0], target[1], 0, socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, kind, proto)
+            except (socket.error, socket.gaierror) as err:
+                results[target] = str(err)
+                continue
+            sock.setblocking(0)
+            code = sock.connect_ex(sockaddr)
+            if code in (0, errno.EISCONN):
+                results[target] = None
+                sock.close()
+            elif code in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                in_flight[sock] = target
+            else:
+                results[target] = os.strerror(code)
+                sock.close()
+
+        deadline = time.time() + timeout
+        while in_flight:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            _, writable, _ = select.select([], list(in_flight), [], remaining)
+            for sock in writable:
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                results[in_flight.pop(sock)] = os.strerror(code) if code else None
+                sock.close()
+        for sock, target in in_flight.items():
+            results[target] = "timed out"
+            sock.close()
+    return results
+
+
+class Cooldown(object):
+    """
+    Devices held back after failing, with exponential backoff
+
+    Each consecutive failure doubles the hold, from base up to
+    maximum. The list is kept in a JSON file when a path is given,
+    so it carries over between runs.
+    """
+
+    def __init__(self, path=None, base=COOLDOWN_BASE, maximum=COOLDOWN_MAX):
+        self.path = path
+        self.base = base
+        self.maximum = maximum
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r') as cooldown_file:
+                self.entries = dict((address, tuple(entry)) for address, entry
+                                    in json.load(cooldown_file).items())
+
+    def blocked(self, address, now=None):
+        """
+        Seconds the device is still held back for, 0 if it may be tried
+        """
+
+        with self.lock:
+            entry = self.entries.get(address)
+        if entry is None:
+            return 0
+        return max(0, entry[1] - (now or time.time()))
+
+    def failed(self, address, now=None):
+        """
+        Record a failure, returns the new hold in seconds
+        """
+
+        now = now or time.time()
+        with self.lock:
+            failures = self.entries.get(address, (0, 0))[0] + 1
+            hold = min(self.maximum, self.base * 2 ** (failures - 1))
+            self.entries[address] = (failures, now + hold)
+        return hold
+
+    def succeeded(self, address):
+        with self.lock:
+            self.entries.pop(address, None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, sort_keys=True)
+        with open(self.path + ".tmp", 'w') as cooldown_file:
+            cooldown_file.write(data)
+        os.rename(self.path + ".tmp", self.path)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling continuous-attestation scheduler for device_validation.
+Devices are kept in a priority queue keyed on when they are next
+due. Due times are spread evenly across the period so collection
+load stays flat, failures and reboot hints pull a device forward,
+and no device is ever scheduled later than one period after its
+last verification.
+"""
+###############################################
+#
+# File Name: scheduler.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import time
+import heapq
+import threading
+
+##
+# retry backoff after a failed verification (seconds)
+##
+RETRY_BASE = 300
+# share of the period a device is scheduled ahead of its deadline, to
+# absorb queueing and pickup delays
+SLACK = 0.1
+
+
+class DeviceSchedule(object):
+    """
+    Scheduling state of one device
+    """
+
+    __slots__ = ("address", "site", "last_verified", "failures", "due", "version")
+
+    def __init__(self, address, site, last_verified):
+        self.address = address
+        self.site = site
+        self.last_verified = last_verified
+        self.failures = 0
+        self.due = None
+        self.version = 0
+
+
+class RollingScheduler(object):
+    """
+    Priority queue of devices ordered by due time
+
+    period is the coverage period in seconds: every device is due
+    slack * period ahead of the deadline one period after its last
+    passed verification, so a pickup delay up to the slack still
+    keeps it covered. Heap entries
+    carry a version so rescheduling a device just pushes a new entry
+    and stale ones are skipped when popped. max_site_inflight caps
+    how many devices of one site are handed out at a time; it is a
+    number or a function of the site name (e.g. an adaptive limit).
+    """
+
+    def __init__(self, period, max_site_inflight=None, retry_base=RETRY_BASE, slack=SLACK):
+        self.period = float(period)
+        # seconds between a device's due time and its deadline
+        self.lead = self.period * slack
+        self.max_site_inflight = max_site_inflight
+        self.retry_base = retry_base
+        self.devices = {}
+        self.heap = []
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def load(self, states, now=None):
+        """
+        Add devices and spread their first due times over the period
+
+        states is a list of (address, site, last_verified) tuples,
+        last_verified (the last pass) None for never verified devices. Devices are
+        given evenly spaced slots in deadline order; a device whose
+        deadline falls before its slot keeps its deadline instead.
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            for address, site, last_verified in states:
+                self.devices[address] = DeviceSchedule(address, site, last_verified)
+
+            def deadline(device):
+                if device.last_verified is None:
+                    return now
+                return device.last_verified + self.period - self.lead
+
+            ordered = sorted(self.devices.values(), key=deadline)
+            spacing = self.period / max(len(ordered), 1)
+            for idx, device in enumerate(ordered):
+                slot = now + idx * spacing
+                device_deadline = deadline(device)
+                if device_deadline > now:
+                    slot = min(slot, device_deadline)
+                self._push(device, slot)
+
+    def _site_cap(self, site):
+        """
+        How many devices of a site may be in flight
+        """
+
+        if self.max_site_inflight is None:
+            return float("inf")
+        if callable(self.max_site_inflight):
+            return self.max_site_inflight(site)
+        return self.max_site_inflight
+
+    def _push(self, device, due):
+        device.version += 1
+        device.due = due
+        heapq.heappush(self.heap, (due, device.version, device.address))
+
+    def hint_reboot(self, address, now=None):
+        """
+        A device rebooted: verify it as soon as possible
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            device = self.devices.get(address)
+            if device is not None and device.due > now:
+                self._push(device, now)
+
+    def next_due(self, now=None):
+        """
+        Seconds until the next device is due (0 if one is), None if empty
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            while self.heap:
+                due, version, address = self.heap[0]
+                if self.devices[address].version != version:
+                    heapq.heappop(self.heap)
+                    continue
+                return max(due - now, 0.0)
+        return None
+
+    def take(self, limit, now=None):
+        """
+        Hand out up to limit due devices, earliest first
+
+        Devices whose site is at its in-flight cap stay queued.
+        """
+
+        now = time.time() if now is None else now
+        taken = []
+        deferred = []
+        with self.lock:
+            while self.heap and len(taken) < limit:
+                due, version, address = self.heap[0]
+                if due > now:
+                    break
+                heapq.heappop(self.heap)
+                device = self.devices[address]
+                if device.version != version:
+                    continue
+                site_count = self.inflight.get(device.site, 0)
+                if site_count >= self._site_cap(device.site):
+                    deferred.append((due, version, address))
+                    continue
+                self.inflight[device.site] = site_count + 1
+                # not due again until done() reschedules it
+                device.version += 1
+                taken.append(device)
+            for entry in deferred:
+                heapq.heappush(self.heap, entry)
+        return taken
+
+    def done(self, device, passed, now=None):
+        """
+        Record a verification and schedule the device's next one
+
+        passed tells whether the device passed every check of its
+        method. A pass is due again the lead time before one period
+        is up. A failure is retried with exponential backoff, never
+        later than that.
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            self.inflight[device.site] -= 1
+            if passed:
+                device.last_verified = now
+                device.failures = 0
+                self._push(device, now + self.period - self.lead)
+            else:
+                device.failures += 1
+                retry = self.retry_base * (2 ** min(device.failures - 1, 16))
+                self._push(device, now + min(retry, self.period - self.lead))
+
+    def postpone(self, device, seconds, now=None):
+        """
+        Hand a device back untried, due again in seconds (e.g. while it
+        is on cooldown)
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            self.inflight[device.site] -= 1
+            self._push(device, now + seconds)
+
+    def coverage(self, now=None):
+        """
+        Fraction of devices that passed within the last period
+        """
+
+        now = time.time() if now is None else now
+        with self.lock:
+            if not self.devices:
+                return 1.0
+            covered = sum(1 for device in self.devices.values()
+                          if device.last_verified is not None and
+                          device.last_verified >= now - self.period)
+            return float(covered) / len(self.devices)
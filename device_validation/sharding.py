@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-node sharded verification for device_validation.
+A coordinator owns the inventory and splits the selected devices
+over the live workers with a consistent hash ring on the device
+address, so a worker joining or leaving only moves its share of
+devices. Workers fetch their devices, verify them and report
+identity and results back, which the coordinator merges into the
+one inventory and a per-worker report. Every call carries a shared
+secret, and the coordinator serves over TLS unless it only listens
+on the loopback interface, since assignments carry credentials.
+"""
+###############################################
+#
+# File Name: sharding.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import ssl
+import hmac
+import time
+import bisect
+import hashlib
+import threading
+import xmlrpclib
+from collections import deque
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+import device_record
+
+##
+# protocol constants (seconds)
+##
+RING_REPLICAS = 128
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+# a leased device without a result is handed out again after this
+LEASE_TIMEOUT = 600
+ASSIGN_CHUNK = 16
+LOOPBACK = ("127.0.0.1", "localhost", "::1")
+
+##
+# coordinator calls, each taking the shared secret first
+##
+RPC_METHODS = ("join", "leave", "heartbeat", "assignment", "site_of",
+               "update_identity", "record_result")
+
+
+class AuthError(Exception):
+    """
+    A call did not carry the shared secret
+    """
+
+
+def read_secret(path):
+    """
+    Shared secret of a sharded run, the first line of a file
+    """
+
+    with open(path, 'r') as secret_file:
+        secret = secret_file.readline().strip()
+    if len(secret) < 16:
+        raise ValueError("the shared secret in %s must be at least 16 characters" % path)
+    return secret
+
+
+class HashRing(object):
+    """
+    Consistent hash ring with virtual nodes
+    """
+
+    def __init__(self, nodes=(), replicas=RING_REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        """
+        Place a node's virtual points on the ring
+        """
+
+        for idx in range(self.replicas):
+            point = self._hash("%s#%d" % (node, idx))
+            bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        """
+        Take a node's virtual points off the ring
+        """
+
+        for idx in range(self.replicas):
+            point = self._hash("%s#%d" % (node, idx))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.points.pop(bisect.bisect_left(self.points, point))
+
+    def owner(self, key):
+        """
+        Node owning a key, None on an empty ring
+        """
+
+        if not self.points:
+            return None
+        idx = bisect.bisect(self.points, self._hash(key)) % len(self.points)
+        return self.owners[self.points[idx]]
+
+
+class Coordinator(object):
+    """
+    Work assignment and result merging for one sharded run
+
+    rows are the selected inventory rows; results are merged into
+    store as they arrive. Workers that miss heartbeats for
+    HEARTBEAT_TIMEOUT are dropped and their devices rehashed, and
+    devices leased for LEASE_TIMEOUT without a result are handed
+    out again.
+    """
+
+    def __init__(self, store, rows, secret, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 lease_timeout=LEASE_TIMEOUT):
+        self.store = store
+        self.rows = dict((row[0], row) for row in rows)
+        self.secret = secret
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lease_timeout = lease_timeout
+        self.ring = HashRing()
+        self.workers = {}
+        self.leases = {}
+        self.done = {}
+        self.by_owner = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _rebalance(self):
+        """
+        Rehash the pending devices over the current workers
+        """
+
+        self.by_owner = dict((worker, deque()) for worker in self.workers)
+        for address in self.rows:
+            if address not in self.done:
+                owner = self.ring.owner(address)
+                if owner is not None:
+                    self.by_owner[owner].append(address)
+
+    def _expire(self, now):
+        """
+        Drop workers that stopped sending heartbeats and requeue
+        devices whose lease ran out
+        """
+
+        dead = [worker for worker, seen in self.workers.items()
+                if seen < now - self.heartbeat_timeout]
+        for worker in dead:
+            self._leave(worker)
+        for address, (_, leased) in self.leases.items():
+            if leased < now - self.lease_timeout:
+                del self.leases[address]
+                owner = self.ring.owner(address)
+                if owner is not None:
+                    self.by_owner[owner].append(address)
+
+    def _leave(self, worker):
+        if worker not in self.workers:
+            return
+        del self.workers[worker]
+        self.ring.remove(worker)
+        for address, (holder, _) in self.leases.items():
+            if holder == worker:
+                del self.leases[address]
+        self._rebalance()
+
+    def join(self, worker):
+        """
+        Add a worker to the ring
+        """
+
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if worker not in self.workers:
+                self.workers[worker] = now
+                self.ring.add(worker)
+                self.stats.setdefault(worker, [0, 0])
+                self._rebalance()
+            return True
+
+    def leave(self, worker):
+        """
+        Remove a worker from the ring
+        """
+
+        with self.lock:
+            self._leave(worker)
+            return True
+
+    def heartbeat(self, worker):
+        """
+        Keep a worker alive; False if it was dropped and must rejoin
+        """
+
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if worker not in self.workers:
+                return False
+            self.workers[worker] = now
+            return True
+
+    def assignment(self, worker):
+        """
+        Next rows for a worker: a list (possibly empty while other
+        workers finish), or None once every device has a result
+        """
+
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if self.finished():
+                return None
+            if worker not in self.workers:
+                return []
+            self.workers[worker] = now
+            rows = []
+            queue = self.by_owner.get(worker, deque())
+            while queue and len(rows) < ASSIGN_CHUNK:
+                address = queue.popleft()
+                if address in self.done or address in self.leases:
+                    continue
+                self.leases[address] = (worker, now)
+                rows.append(self.rows[address])
+            return rows
+
+    def site_of(self, address):
+        with self.lock:
+            return self.store.site_of(address)
+
+    def update_identity(self, address, en_udi, sudi_serial, pid):
+        with self.lock:
+            if address in self.rows:
+                self.store.update_identity(address, en_udi, sudi_serial, pid)
+            return True
+
+    def record_result(self, worker, address, auth_rc):
+        """
+        Merge one device result into the inventory
+        """
+
+        with self.lock:
+            if address not in self.rows:
+                return False
+            self.store.record_result(address, auth_rc)
+            self.leases.pop(address, None)
+            if address not in self.done:
+                self.done[address] = (worker, auth_rc)
+                counts = self.stats.setdefault(worker, [0, 0])
+                passed = auth_rc == device_record.pass_rc(self.rows[address][1])
+                counts[0 if passed else 1] += 1
+            return True
+
+    def finished(self):
+        return len(self.done) >= len(self.rows)
+
+    def report_lines(self):
+        """
+        Per-worker pass/fail counts and the overall result
+        """
+
+        with self.lock:
+            lines = ["%-32s passed %6d  failed %6d" % (worker, counts[0], counts[1])
+                     for worker, counts in sorted(self.stats.items())]
+            passed = sum(counts[0] for counts in self.stats.values())
+            lines.append("%-32s passed %6d  failed %6d  of %d devices" % (
+                "total", passed, len(self.done) - passed, len(self.rows)))
+            return lines
+
+    def _authenticated(self, method):
+        """
+        RPC wrapper of a method that checks the shared secret first
+        """
+
+        def call(secret, *args):
+            if not hmac.compare_digest(str(secret), self.secret):
+                raise AuthError("bad shared secret")
+            return method(*args)
+        return call
+
+    def serve(self, host, port, poll=1.0, certfile=None, keyfile=None):
+        """
+        Serve workers over XML-RPC until every device has a result
+        and the workers have left (or timed out)
+
+        TLS with certfile and keyfile is required unless host is a
+        loopback address.
+        """
+
+        if certfile is None and host not in LOOPBACK:
+            raise ValueError("serving on %s requires a TLS certificate and key" % host)
+        server = SimpleXMLRPCServer((host, port), allow_none=True, logRequests=False)
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+            context.load_cert_chain(certfile, keyfile)
+            server.socket = context.wrap_socket(server.socket, server_side=True)
+        server.timeout = poll
+        for name in RPC_METHODS:
+            server.register_function(self._authenticated(getattr(self, name)), name)
+        while True:
+            server.handle_request()
+            with self.lock:
+                self._expire(time.time())
+                if self.finished() and not self.workers:
+                    break
+        server.server_close()
+
+
+class CoordinatorStore(object):
+    """
+    Inventory stand-in used by a worker: identity and results go
+    straight to the coordinator
+    """
+
+    def __init__(self, url, worker, secret, cafile=None):
+        self.url = url
+        self.worker = worker
+        self.secret = secret
+        context = None
+        if url.startswith("https:"):
+            # verify the coordinator against cafile, or the system CAs
+            context = ssl.create_default_context(cafile=cafile)
+        self.proxy = xmlrpclib.ServerProxy(url, allow_none=True, context=context)
+        self.lock = threading.Lock()
+
+    def call(self, name, *args):
+        # one proxy is shared by the worker threads, calls are serialized
+        with self.lock:
+            return getattr(self.proxy, name)(self.secret, *args)
+
+    def join(self):
+        return self.call("join", self.worker)
+
+    def leave(self):
+        return self.call("leave", self.worker)
+
+    def assignment(self):
+        return self.call("assignment", self.worker)
+
+    def site_of(self, address):
+        return self.call("site_of", address)
+
+    def update_identity(self, address, en_udi, sudi_serial, pid):
+        self.call("update_identity", address, en_udi, sudi_serial, pid)
+
+    def record_result(self, address, auth_rc, when=None):
+        self.call("record_result", self.worker, address, auth_rc)
+
+    def start_heartbeat(self, interval=HEARTBEAT_INTERVAL):
+        """
+        Heartbeat from a background thread, rejoining if dropped
+        """
+
+        def beat():
+            while True:
+                time.sleep(interval)
+                try:
+                    if not self.call("heartbeat", self.worker):
+                        self.join()
+                except Exception:
+                    pass
+
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        pass
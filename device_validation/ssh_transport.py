@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+In-process SSH transport for device_validation.
+A ChannelSession is an interactive shell on a paramiko channel
+that offers the part of the pexpect spawn interface the CLI
+collection flow uses (expect, sendline, read_nonblocking, close),
+so the prompt-driven command flow is unchanged. A session costs a
+socket and a transport thread instead of an ssh process and a PTY,
+which lets one collector hold thousands of them. paramiko is
+optional; without it device_validation falls back to pexpect.
+"""
+###############################################
+#
+# File Name: ssh_transport.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import os
+import re
+import time
+import socket
+import threading
+
+##
+# session constants
+##
+DEFAULT_TIMEOUT = 30
+READ_CHUNK = 4096
+TERM_WIDTH = 511
+# keep the window small, the collector holds many channels at once
+WINDOW_SIZE = 64 * 1024
+KNOWN_HOSTS = os.path.expanduser("~/.ssh/known_hosts")
+
+##
+# serializes appends of first seen host keys to known_hosts files
+##
+KNOWN_HOSTS_LOCK = threading.Lock()
+
+
+class SessionTimeout(Exception):
+    """
+    No match or data before the timeout (pexpect.TIMEOUT)
+    """
+
+
+class SessionClosed(Exception):
+    """
+    The session ended or could not be opened (pexpect.EOF)
+    """
+
+
+ERRORS = (SessionTimeout, SessionClosed)
+
+
+def available():
+    """
+    True if paramiko can be imported
+    """
+
+    try:
+        import paramiko
+    except ImportError:
+        return False
+    return True
+
+
+def _host_key_policy(paramiko, known_hosts, accept_new):
+    """
+    Policy for hosts missing from known_hosts: reject them, or with
+    accept_new trust the key on first use and append it to known_hosts
+    (what answering "yes" to ssh's prompt does). A host whose key
+    changed is always rejected by paramiko.
+    """
+
+    if not accept_new:
+        return paramiko.RejectPolicy()
+
+    class TrustOnFirstUse(paramiko.MissingHostKeyPolicy):
+        """
+        Accept and persist the key of a host seen for the first time
+        """
+
+        def missing_host_key(self, client, hostname, key):
+            with KNOWN_HOSTS_LOCK:
+                with open(known_hosts, 'a') as hosts_file:
+                    hosts_file.write("%s %s %s\n" % (hostname, key.get_name(), key.get_base64()))
+            client.get_host_keys().add(hostname, key.get_name(), key)
+
+    return TrustOnFirstUse()
+
+
+class ChannelSession(object):
+    """
+    Interactive shell on an SSH channel, driven like pexpect.spawn
+    """
+
+    def __init__(self, client, channel, timeout=DEFAULT_TIMEOUT):
+        self.client = client
+        self.channel = channel
+        self.timeout = timeout
+        self.buffer = ""
+        self.before = ""
+        self.after = ""
+        self.match = None
+
+    @classmethod
+    def connect(cls, address, port, user, password, timeout=DEFAULT_TIMEOUT,
+                known_hosts=KNOWN_HOSTS, accept_new=False):
+        """
+        Log in with a password and open a shell, raises SessionClosed
+
+        The host key must match known_hosts; unknown hosts are rejected
+        unless accept_new is set, then their key is trusted and saved.
+        """
+
+        import paramiko
+        client = paramiko.SSHClient()
+        try:
+            client.load_host_keys(known_hosts)
+        except IOError:
+            # no known hosts yet, only accept_new lets a session open
+            pass
+        client.set_missing_host_key_policy(_host_key_policy(paramiko, known_hosts, accept_new))
+        try:
+            client.connect(address, port=port, username=user, password=password,
+                           timeout=timeout, banner_timeout=timeout, auth_timeout=timeout,
+                           look_for_keys=False, allow_agent=False)
+            channel = client.get_transport().open_session(window_size=WINDOW_SIZE)
+            channel.get_pty(width=TERM_WIDTH)
+            channel.invoke_shell()
+        except (paramiko.SSHException, socket.error, EOFError) as err:
+            client.close()
+            raise SessionClosed("%s: %s" % (address, err))
+        return cls(client, channel, timeout)
+
+    def read_nonblocking(self, size=READ_CHUNK, timeout=None):
+        """
+        Return up to size bytes, waiting at most timeout for them
+        """
+
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        self.channel.settimeout(self.timeout if timeout is None else max(timeout, 0.001))
+        try:
+            data = self.channel.recv(size)
+        except socket.timeout:
+            raise SessionTimeout("no data within %.1f seconds" % (timeout or self.timeout))
+        if not data:
+            raise SessionClosed("channel closed")
+        return data
+
+    def expect(self, patterns, timeout=None):
+        """
+        Wait for the earliest match of a pattern (or list of them),
+        returns its index and keeps the output after it buffered
+        """
+
+        if not isinstance(patterns, (list, tuple)):
+            patterns = [patterns]
+        compiled = [re.compile(pattern) for pattern in patterns]
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        while True:
+            best = None
+            for idx, regex in enumerate(compiled):
+                match = regex.search(self.buffer)
+                if match and (best is None or match.start() < best[1].start()):
+                    best = (idx, match)
+            if best is not None:
+                idx, match = best
+                self.before = self.buffer[:match.start()]
+                self.after = match.group(0)
+                self.match = match
+                self.buffer = self.buffer[match.end():]
+                return idx
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SessionTimeout("timed out waiting for %r" % (patterns,))
+            self.channel.settimeout(remaining)
+            try:
+                data = self.channel.recv(READ_CHUNK)
+            except socket.timeout:
+                continue
+            if not data:
+                raise SessionClosed("channel closed")
+            self.buffer += data
+
+    def sendline(self, line=""):
+        self.channel.sendall(line + "\n")
+
+    def close(self):
+        self.channel.close()
+        self.client.close()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing instrumentation for device_validation.
+Stage durations are aggregated into fixed bucket histograms so
+percentiles can be reported for a whole fleet run without keeping
+every sample, and exported in Prometheus text format.
+"""
+###############################################
+#
+# File Name: stage_timing.py
+#
+# Copyright 2016, 2018 Cisco Systems, Inc. All Rights Reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###############################################
+
+import time
+import json
+import bisect
+import pstats
+import cProfile
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+##
+# histogram bucket upper bounds (seconds)
+##
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+##
+# percentiles shown in the run summary
+##
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+##
+# adaptive command timeouts: a multiple of the command's p99
+# latency, once enough samples were seen (seconds)
+##
+TIMEOUT_PERCENTILE = 99
+TIMEOUT_FACTOR = 3.0
+TIMEOUT_MIN = 2.0
+TIMEOUT_MIN_SAMPLES = 20
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram with percentile estimation
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Add a single sample
+        """
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile by interpolating inside its bucket
+        """
+
+        if self.count == 0:
+            return 0.0
+
+        rank = pct / 100.0 * self.count
+        cumulative = 0
+        lower = 0.0
+        for idx, bucket_count in enumerate(self.counts):
+            if idx < len(self.bounds):
+                upper = min(self.bounds[idx], self.max)
+            else:
+                upper = self.max
+            if bucket_count and cumulative + bucket_count >= rank:
+                fraction = (rank - cumulative) / float(bucket_count)
+                return lower + (upper - lower) * fraction
+            cumulative += bucket_count
+            lower = upper
+        return self.max
+
+    def state(self):
+        """
+        JSON serializable copy of the histogram
+        """
+
+        return {"bounds": list(self.bounds), "counts": self.counts, "count": self.count,
+                "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_state(cls, state):
+        hist = cls(state["bounds"])
+        hist.counts = list(state["counts"])
+        hist.count = state["count"]
+        hist.total = state["total"]
+        hist.max = state["max"]
+        return hist
+
+
+class StageTimings(object):
+    """
+    Collection of per-stage histograms
+
+    Stages opened while another stage is running on the same thread
+    are recorded under the qualified name "outer.inner".
+    """
+
+    def __init__(self, prefix="device_validation"):
+        self.prefix = prefix
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def observe(self, name, seconds):
+        """
+        Record the duration of one stage execution
+        """
+
+        with self.lock:
+            hist = self.stages.get(name)
+            if hist is None:
+                hist = self.stages[name] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as the named stage
+        """
+
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        if stack:
+            name = stack[-1] + "." + name
+        stack.append(name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+            stack.pop()
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function as the named stage
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary_lines(self):
+        """
+        Human readable percentile table, one line per stage
+        """
+
+        header = "%-64s %7s" % ("Stage", "Count")
+        for pct in SUMMARY_PERCENTILES:
+            header += " %9s" % ("p%d(s)" % pct)
+        header += " %9s" % "max(s)"
+        lines = [header]
+        with self.lock:
+            for name in sorted(self.stages):
+                hist = self.stages[name]
+                line = "%-64s %7d" % (name, hist.count)
+                for pct in SUMMARY_PERCENTILES:
+                    line += " %9.3f" % hist.percentile(pct)
+                line += " %9.3f" % hist.max
+                lines.append(line)
+        return lines
+
+    def prometheus_text(self):
+        """
+        Render all stage histograms in Prometheus text exposition format
+        """
+
+        metric = self.prefix + "_stage_seconds"
+        out = ["# HELP %s Time spent in each validation stage." % metric,
+               "# TYPE %s histogram" % metric]
+        with self.lock:
+            for name in sorted(self.stages):
+                hist = self.stages[name]
+                cumulative = 0
+                for idx, bound in enumerate(hist.bounds):
+                    cumulative += hist.counts[idx]
+                    out.append('%s_bucket{stage="%s",le="%s"} %d' %
+                               (metric, name, repr(bound), cumulative))
+                out.append('%s_bucket{stage="%s",le="+Inf"} %d' % (metric, name, hist.count))
+                out.append('%s_sum{stage="%s"} %.6f' % (metric, name, hist.total))
+                out.append('%s_count{stage="%s"} %d' % (metric, name, hist.count))
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write the Prometheus text export to a file
+        """
+
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(self.prometheus_text())
+
+
+class CommandTimeouts(object):
+    """
+    Per-command timeouts derived from observed command latencies
+
+    Commands are keyed with their numeric arguments (nonces) removed,
+    so every "show platform integrity sign nonce N" shares a history.
+    Until a command has TIMEOUT_MIN_SAMPLES samples the default
+    timeout applies. The history can be kept in a JSON file so later
+    runs start from it.
+    """
+
+    def __init__(self, default, maximum=None, path=None):
+        self.default = default
+        self.maximum = maximum or default
+        self.path = path
+        self.commands = {}
+        self.lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'r') as history:
+                    self.commands = dict((key, Histogram.from_state(state))
+                                         for key, state in json.load(history).items())
+            except IOError:
+                pass
+
+    @staticmethod
+    def key(command):
+        return " ".join(word for word in command.split() if not word.isdigit())
+
+    def timeout(self, command):
+        """
+        Seconds to wait for a command before declaring the device hung
+        """
+
+        with self.lock:
+            hist = self.commands.get(self.key(command))
+            if hist is None or hist.count < TIMEOUT_MIN_SAMPLES:
+                return self.default
+            learned = hist.percentile(TIMEOUT_PERCENTILE) * TIMEOUT_FACTOR
+        return min(self.maximum, max(TIMEOUT_MIN, learned))
+
+    def observe(self, command, seconds):
+        """
+        Record how long a command took to complete
+        """
+
+        key = self.key(command)
+        with self.lock:
+            hist = self.commands.get(key)
+            if hist is None:
+                hist = self.commands[key] = Histogram()
+            hist.observe(seconds)
+
+    def summary_lines(self):
+        """
+        Current timeout and latency percentiles, one line per command
+        """
+
+        lines = ["%-64s %7s %9s %10s" % ("Command", "Count", "p99(s)", "timeout(s)")]
+        with self.lock:
+            items = sorted(self.commands.items())
+        for key, hist in items:
+            lines.append("%-64s %7d %9.3f %10.1f" % (key, hist.count, hist.percentile(99),
+                                                    self.timeout(key)))
+        return lines
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(dict((key, hist.state()) for key, hist in self.commands.items()),
+                              sort_keys=True)
+        with open(self.path, 'w') as history:
+            history.write(data)
+
+
+def profile_call(output_path, func, *args, **kwargs):
+    """
+    Run a single call under cProfile, dump the raw stats to
+    output_path and print the top entries by cumulative time
+    """
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(output_path)
+        stats = pstats.Stats(output_path)
+        stats.sort_stats("cumulative").print_stats(25)
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+'''Put the libraries and the device_validation modules on the path.'''
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "device_validation"))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''Merkle inclusion proofs and the batch root chain of the audit log.'''
+
+import json
+
+import pytest
+
+import audit_log
+
+
+def _leaves(count):
+    return [audit_log.leaf_hash("record %d" % idx) for idx in range(count)]
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 5, 8, 13, 64, 100])
+def test_inclusion_proofs(count):
+    leaves = _leaves(count)
+    root = audit_log.merkle_root(leaves)
+    for index in range(count):
+        path = audit_log.audit_path(index, leaves)
+        assert audit_log.verify_inclusion(leaves[index], index, count, path, root)
+
+
+def test_inclusion_proof_rejects_wrong_leaf_index_and_root():
+    leaves = _leaves(13)
+    root = audit_log.merkle_root(leaves)
+    path = audit_log.audit_path(5, leaves)
+    assert not audit_log.verify_inclusion(leaves[6], 5, 13, path, root)
+    assert not audit_log.verify_inclusion(leaves[5], 4, 13, path, root)
+    assert not audit_log.verify_inclusion(leaves[5], 5, 6, path, root)
+    assert not audit_log.verify_inclusion(leaves[5], 13, 13, path, root)
+    assert not audit_log.verify_inclusion(leaves[5], 5, 13, path[:-1], root)
+    other = audit_log.merkle_root(_leaves(12))
+    assert not audit_log.verify_inclusion(leaves[5], 5, 13, path, other)
+
+
+def test_merkle_root_matches_recursive_split():
+    def recursive(hashes):
+        if len(hashes) == 1:
+            return hashes[0]
+        k = audit_log._split(len(hashes))
+        return audit_log.node_hash(recursive(hashes[:k]), recursive(hashes[k:]))
+
+    for count in range(1, 40):
+        leaves = _leaves(count)
+        assert audit_log.merkle_root(leaves) == recursive(leaves)
+
+
+def _write_log(path, records, batch_size):
+    log = audit_log.AuditLog(str(path), batch_size=batch_size)
+    for idx in range(records):
+        log.append({"address": "10.0.0.%d" % idx, "auth_rc": 31, "nonce": str(idx)})
+    log.close()
+
+
+def test_log_proofs_and_root_chain(tmpdir):
+    path = tmpdir.join("audit.log")
+    _write_log(path, 10, 4)
+    assert audit_log.verify_file(str(path)) == (3, 0, [])
+
+    log = audit_log.AuditLog(str(path), readonly=True)
+    for idx in range(10):
+        proof = log.prove("10.0.0.%d" % idx)
+        assert json.loads(proof["record"])["address"] == "10.0.0.%d" % idx
+        assert audit_log.check_proof(proof)
+    assert log.prove("10.0.0.99") is None
+
+    # each batch chains to the root of the one before it
+    prev = audit_log.EMPTY_ROOT
+    for batch in log.batches:
+        assert batch["prev"] == prev
+        prev = batch["root"]
+
+    # reopening and appending extends the chain
+    _write_log(path, 2, 4)
+    assert audit_log.verify_file(str(path)) == (4, 0, [])
+
+
+def test_tampered_record_breaks_root(tmpdir):
+    path = tmpdir.join("audit.log")
+    _write_log(path, 8, 4)
+    lines = path.read().splitlines(True)
+    lines[1] = lines[1].replace('"auth_rc":31', '"auth_rc":30')
+    path.write("".join(lines))
+    assert audit_log.verify_file(str(path))[2]
+
+
+def test_tampered_root_breaks_chain(tmpdir):
+    path = tmpdir.join("audit.log")
+    _write_log(path, 8, 4)
+    lines = path.read().splitlines(True)
+    entry = json.loads(lines[4])
+    entry["root"] = "00" * 32
+    lines[4] = json.dumps(entry, sort_keys=True, separators=(",", ":")) + "\n"
+    path.write("".join(lines))
+    assert audit_log.verify_file(str(path))[2]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''Reading and pairing captures from tar, zip and gzip archives.'''
+
+import gzip
+import os
+import tarfile
+import zipfile
+from StringIO import StringIO
+
+import CaptureArchive
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _example(name):
+    with open(os.path.join(ROOT, name), 'r') as example:
+        return example.read()
+
+
+SUDI = _example("sudi_example.txt")
+SPI = _example("spi_example.txt")
+OTHER_SUDI = SUDI.replace("nonce 123", "nonce 456", 1)
+
+
+def _tar(path, members):
+    with tarfile.open(path, "w:gz") as archive:
+        for name, text in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(text)
+            archive.addfile(info, StringIO(text))
+
+
+def test_parse_capture():
+    kind, nonce, body = CaptureArchive.parse_capture(SUDI)
+    assert (kind, nonce) == ("sudi", "123")
+    assert body.startswith("-----BEGIN CERTIFICATE-----")
+    assert CaptureArchive.parse_capture(SPI)[:2] == ("integrity", "123")
+    assert CaptureArchive.parse_capture("show version\n")[0] is None
+    assert CaptureArchive.capture_host(SUDI) == "Switch"
+    assert CaptureArchive.capture_host("show platform sudi\n") is None
+
+
+def test_pairs_from_a_tar(tmpdir):
+    path = str(tmpdir.join("captures.tar.gz"))
+    _tar(path, [("a/spi.txt", SPI), ("a/sudi.txt", SUDI), ("b/sudi.txt", SUDI),
+                ("b/other.txt", OTHER_SUDI), ("a/notes.txt", "show version\n")])
+    pairs = list(CaptureArchive.capture_pairs(path))
+    assert [(p[0], p[1], p[3], p[5]) for p in pairs] == [
+        ("a/sudi.txt", "123", "123", None),
+        ("b/sudi.txt", "123", None, None),
+        ("b/other.txt", "456", None, None)]
+    assert pairs[0][4] == CaptureArchive.parse_capture(SPI)[2]
+
+
+def test_reused_nonces_are_rejected(tmpdir):
+    path = str(tmpdir.join("captures.zip"))
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("a/sudi.txt", SUDI)
+        archive.writestr("a/sudi_again.txt", SUDI)
+        archive.writestr("a/spi.txt", SPI)
+        archive.writestr("a/spi_again.txt", SPI)
+    pairs = list(CaptureArchive.capture_pairs(path))
+    assert [(p[0], p[5]) for p in pairs] == [
+        ("a/sudi_again.txt", "nonce 123 used by more than one capture"),
+        ("a/sudi.txt", None),
+        ("a/spi_again.txt", "nonce 123 used by more than one capture")]
+    assert pairs[1][3] == "123"
+
+
+def test_gzip_and_plain_captures(tmpdir):
+    path = str(tmpdir.join("sudi.txt.gz"))
+    with gzip.open(path, "wb") as capture:
+        capture.write(SUDI)
+    assert list(CaptureArchive.iter_members(path)) == [(path[:-3], SUDI)]
+    plain = tmpdir.join("sudi.txt")
+    plain.write(SUDI)
+    assert list(CaptureArchive.iter_members(str(plain))) == [(str(plain), SUDI)]
+
+
+def test_oversized_members_are_skipped(tmpdir, monkeypatch):
+    monkeypatch.setattr(CaptureArchive, "MAX_CAPTURE_BYTES", 100)
+    path = str(tmpdir.join("captures.tar"))
+    _tar(path, [("big.txt", SUDI), ("small.txt", "show version\n")])
+    assert [name for name, _ in CaptureArchive.iter_members(path)] == ["small.txt"]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''Watch mode pairing, nonce reuse and verification errors.'''
+
+import os
+
+import CaptureWatch
+import ResultStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _example(name):
+    with open(os.path.join(ROOT, name), 'r') as example:
+        return example.read()
+
+
+def _watch(tmpdir, monkeypatch, verify=None):
+    monkeypatch.setattr(ResultStore, "verify_capture",
+                        verify or (lambda *args: (True, None)))
+    results = []
+    store = ResultStore.ResultStore(str(tmpdir.join("results.db")))
+    directory = tmpdir.mkdir("captures")
+    watch = CaptureWatch.CaptureWatch(str(directory), store, emit=results.append, workers=1)
+    return watch, directory, results
+
+
+def test_pairs_are_verified_once(tmpdir, monkeypatch):
+    watch, directory, results = _watch(tmpdir, monkeypatch)
+    directory.join("a_sudi.txt").write(_example("sudi_example.txt"))
+    directory.join("a_spi.txt").write(_example("spi_example.txt"))
+    watch.ingest("a_sudi.txt")
+    watch.ingest("a_spi.txt")
+    # reported again by the watcher
+    watch.ingest("a_spi.txt")
+    watch.close()
+    assert [(r["name"], r["kind"], r["passed"]) for r in results] == [
+        ("a_sudi.txt + a_spi.txt", "integrity", True)]
+
+
+def test_nonce_reuse_fails(tmpdir, monkeypatch):
+    watch, directory, results = _watch(tmpdir, monkeypatch)
+    sudi = _example("sudi_example.txt")
+    directory.join("a_sudi.txt").write(sudi)
+    directory.join("b_sudi.txt").write(sudi)
+    watch.ingest("a_sudi.txt")
+    watch.ingest("b_sudi.txt")
+    watch.expire(now=float("inf"))
+    watch.close()
+    results = dict((r["name"], r) for r in results)
+    assert results["a_sudi.txt"]["passed"]
+    assert not results["b_sudi.txt"]["passed"]
+    assert "nonce 123 used by more than one capture" in results["b_sudi.txt"]["detail"]
+
+
+def test_nonce_reuse_is_caught_after_a_restart(tmpdir, monkeypatch):
+    watch, directory, results = _watch(tmpdir, monkeypatch)
+    directory.join("a_sudi.txt").write(_example("sudi_example.txt"))
+    watch.ingest("a_sudi.txt")
+    watch.expire(now=float("inf"))
+    watch.close()
+
+    watch = CaptureWatch.CaptureWatch(str(directory), watch.store, emit=results.append)
+    directory.join("b_sudi.txt").write(_example("sudi_example.txt"))
+    # rescanning the first capture is not a reuse
+    watch.scan()
+    watch.expire(now=float("inf"))
+    watch.close()
+    assert [(r["name"], r["passed"]) for r in sorted(results, key=lambda r: r["name"])] == [
+        ("a_sudi.txt", True), ("a_sudi.txt", True), ("b_sudi.txt", False)]
+
+
+def test_verification_errors_are_reported(tmpdir, monkeypatch):
+    def verify(*args):
+        raise RuntimeError("store unavailable")
+    watch, directory, results = _watch(tmpdir, monkeypatch, verify)
+    directory.join("a_sudi.txt").write(_example("sudi_example.txt"))
+    directory.join("c_sudi.txt").write(_example("sudi_example.txt").replace("nonce 123",
+                                                                            "nonce 124"))
+    watch.ingest("a_sudi.txt")
+    watch.ingest("c_sudi.txt")
+    watch.expire(now=float("inf"))
+    watch.close()
+    assert sorted((r["name"], r["passed"], r["detail"]) for r in results) == [
+        ("a_sudi.txt", False, "error: store unavailable"),
+        ("c_sudi.txt", False, "error: store unavailable")]
+    assert watch.counts["failed"] == 2
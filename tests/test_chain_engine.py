@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+'''Link by link chain validation with memoized issuer edges.'''
+
+import base64
+import os
+
+import pytest
+
+crypto = pytest.importorskip("OpenSSL.crypto")
+
+import chain_engine
+from VerifySignature import _scan_pem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _example_stack():
+    with open(os.path.join(ROOT, "sudi_example.txt"), 'r') as example:
+        return [crypto.load_certificate(crypto.FILETYPE_ASN1, base64.b64decode(body))
+                for body in _scan_pem(example.read())]
+
+
+def test_links_are_memoized():
+    root, ca, sudi = _example_stack()
+    validator = chain_engine.ChainValidator([root])
+    links = validator.verify_path([root, ca, sudi])
+    assert [link.label for link in links] == ["Root", "Manufacturing", "SUDI"]
+    assert [link.passed for link in links[:2]] == [True, True]
+    assert [link.cached for link in links] == [False, False, False]
+    # the example SUDI certificate has expired, the leaf is never memoized
+    assert "expired" in links[2].error
+    again = validator.verify_path([root, ca, sudi])
+    assert [link.cached for link in again] == [True, True, False]
+    assert again[2].error == links[2].error
+
+
+def test_untrusted_root_skips_the_rest():
+    root, ca, sudi = _example_stack()
+    links = chain_engine.ChainValidator([]).verify_path([root, ca, sudi])
+    assert not links[0].passed
+    assert [link.error for link in links[1:]] == [chain_engine.NOT_CHECKED] * 2
+    assert links[2].subject == "WS-C3650-8X24UQ"
+
+
+def test_verify_leaf_uses_validated_issuers():
+    root, ca, sudi = _example_stack()
+    validator = chain_engine.ChainValidator([root])
+    leaf = validator.verify_leaf(ca, label="Manufacturing")
+    assert (leaf.label, leaf.passed, leaf.cached) == ("Manufacturing", True, False)
+    assert not validator.verify_leaf(sudi).passed
+    validator.verify_path([root, ca, sudi])
+    assert "expired" in validator.verify_leaf(sudi).error
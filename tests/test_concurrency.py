@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+'''AIMD per-site limits.'''
+
+import threading
+
+import pytest
+
+import concurrency
+
+
+def test_successes_grow_the_limit_about_one_per_window():
+    limit = concurrency.AimdLimit(initial=2.0)
+    for _ in range(2):
+        limit.acquire()
+        limit.release(0.1, False, now=1.0)
+    assert 2.8 < limit.limit < 3.0
+    assert limit.successes == 2
+
+
+def test_failures_cut_the_limit_once_per_latency():
+    limit = concurrency.AimdLimit(initial=16.0)
+    for _ in range(4):
+        limit.acquire()
+    # a burst of failures within one latency only counts once
+    for _ in range(4):
+        limit.release(2.0, True, now=100.0)
+    assert limit.limit == 8.0 and limit.failures == 4
+    limit.acquire()
+    limit.release(2.0, True, now=103.0)
+    assert limit.limit == 4.0
+
+
+def test_limit_stays_within_bounds():
+    limit = concurrency.AimdLimit(initial=1.0, maximum=3.0)
+    limit.acquire()
+    limit.release(1.0, True, now=10.0)
+    assert limit.limit == concurrency.MIN_LIMIT
+    for _ in range(50):
+        limit.acquire()
+        limit.release(0.1, False)
+    assert limit.limit == 3.0
+
+
+def test_slow_collections_count_as_congestion():
+    limit = concurrency.AimdLimit()
+    assert not limit.congested(5.0, False)
+    limit.best_latency = 1.0
+    assert not limit.congested(2.5, False)
+    assert limit.congested(3.5, False)
+    assert limit.congested(0.1, True)
+    limit.best_latency = 0.01
+    # below the floor latency is never congestion
+    assert not limit.congested(0.5, False)
+
+
+def test_acquire_blocks_at_the_limit():
+    limit = concurrency.AimdLimit(initial=1.0)
+    limit.acquire()
+    entered = threading.Event()
+
+    def second():
+        limit.acquire()
+        entered.set()
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    assert not entered.wait(0.1)
+    limit.release(0.1, False)
+    assert entered.wait(5)
+    thread.join()
+
+
+def test_slot_marks_errors_and_exceptions():
+    sites = concurrency.SiteLimiter(initial=4.0)
+    with sites.slot("a") as outcome:
+        outcome.error = True
+    with pytest.raises(ValueError):
+        with sites.slot("a"):
+            raise ValueError("boom")
+    with sites.slot("b"):
+        pass
+    snapshot = sites.snapshot()
+    assert snapshot["a"][1:] == (0, 0, 2)
+    assert snapshot["b"][1:] == (0, 1, 0)
+    assert sites.limit("a") < 4 and sites.limit("c") == 4
+    assert 'site_concurrency_limit{site="b"}' in sites.prometheus_text()
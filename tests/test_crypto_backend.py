@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''Signature dispatch, ECDSA signature encoding and backend parity.'''
+
+import binascii
+import os
+
+import pytest
+
+import CryptoBackend
+from CryptoBackend import SignatureRegistry, ecdsa_der_signature, is_der_ecdsa_signature
+import VerifySignature
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeBackend(CryptoBackend.Backend):
+    '''Accepts a signature only over the hash it was made with.'''
+
+    name = "fake"
+
+    def __init__(self, key_type, accepted):
+        self.type = key_type
+        self.accepted = accepted
+        self.tried = []
+
+    def key_type(self, key):
+        return self.type
+
+    def verify(self, key, signature, data, digest):
+        self.tried.append(digest)
+        return digest == self.accepted
+
+
+def test_registry_tries_the_hashes_of_the_version_and_key_type():
+    registry = SignatureRegistry()
+    registry.register(1, "RSA", ("sha256", "sha1"))
+    registry.register(1, "EC-P384", ("sha384",))
+
+    backend = FakeBackend("RSA", "sha1")
+    assert registry.verify("1", None, "sig", "data", backend)
+    assert backend.tried == ["sha256", "sha1"]
+
+    backend = FakeBackend("EC-P384", "sha256")
+    assert not registry.verify(1, None, "sig", "data", backend)
+    assert backend.tried == ["sha384"]
+
+    with pytest.raises(ValueError):
+        registry.verify(2, None, "sig", "data", FakeBackend("RSA", "sha256"))
+    with pytest.raises(ValueError):
+        registry.verify(1, None, "sig", "data", FakeBackend("EC-P256", "sha256"))
+
+
+def test_default_registry():
+    assert CryptoBackend.SIGNATURES.hashes(1, "RSA") == ("sha256", "sha1")
+    assert CryptoBackend.SIGNATURES.hashes("1", "EC-P521") == ("sha512",)
+
+
+def test_pnp_digest_checks_the_key_type():
+    registry = CryptoBackend.SIGNATURES
+    assert registry.pnp_digest("RSA", "RSA", "SHA256") == "sha256"
+    assert registry.pnp_digest("EC-P384", " ecdsa ", "sha384 ") == "sha384"
+    with pytest.raises(AssertionError):
+        registry.pnp_digest("EC-P256", "RSA", "SHA256")
+    with pytest.raises(AssertionError):
+        registry.pnp_digest("RSA", "ECDSA", "SHA256")
+    with pytest.raises(AssertionError):
+        registry.pnp_digest("RSA", "RSA", "MD5")
+
+
+def _raw(r, s, coord):
+    return (binascii.a2b_hex("%0*x" % (2 * coord, r)) +
+            binascii.a2b_hex("%0*x" % (2 * coord, s)))
+
+
+@pytest.mark.parametrize("bits", [256, 384, 521])
+def test_raw_ecdsa_signatures_are_converted(bits):
+    coord = (bits + 7) // 8
+    for r, s in [(1, 2), (2 ** (bits - 1), 3), (2 ** bits - 1, 2 ** (bits - 8))]:
+        der = ecdsa_der_signature(_raw(r, s, coord), bits)
+        assert is_der_ecdsa_signature(der)
+        # SEQUENCE { INTEGER r, INTEGER s }, minimal and non-negative
+        start, end = CryptoBackend._der_element(der, 0, "\x30")
+        values = []
+        while start < end:
+            content, start = CryptoBackend._der_element(der, start, "\x02")
+            integer = der[content:start]
+            assert ord(integer[0]) < 0x80
+            assert len(integer) == 1 or integer[0] != "\x00" or ord(integer[1]) >= 0x80
+            values.append(int(binascii.b2a_hex(integer), 16))
+        assert values == [r, s]
+        # already DER: returned unchanged
+        assert ecdsa_der_signature(der, bits) == der
+
+
+def test_der_signatures_of_raw_length_are_kept():
+    # a 64 byte DER signature has the length of a raw P-256 pair
+    body = "\x02\x1d" + "\x11" * 29 + "\x02\x1d" + "\x22" * 29
+    der = "\x30" + chr(len(body)) + body
+    assert len(der) == 64 and is_der_ecdsa_signature(der)
+    assert ecdsa_der_signature(der, 256) == der
+
+
+def test_malformed_der_is_rejected():
+    assert not is_der_ecdsa_signature("")
+    assert not is_der_ecdsa_signature("\x30\x06\x02\x01\x01\x02\x01")
+    assert not is_der_ecdsa_signature("\x30\x06\x02\x01\x01\x02\x01\x01\x00")
+    assert not is_der_ecdsa_signature("\x30\x03\x02\x01\x01")
+    assert not is_der_ecdsa_signature("\x30\x04\x02\x00\x02\x00")
+    assert is_der_ecdsa_signature("\x30\x06\x02\x01\x01\x02\x01\x01")
+
+
+def test_pycrypto_rsa_bits():
+    class Modern(object):
+        def size_in_bits(self):
+            return 2048
+
+    class Legacy(object):
+        def size(self):
+            return 2047
+
+    assert CryptoBackend.PyCryptoBackend._rsa_bits(Modern()) == 2048
+    assert CryptoBackend.PyCryptoBackend._rsa_bits(Legacy()) == 2048
+
+
+def _example_evidence():
+    with open(os.path.join(ROOT, "sudi_example.txt"), 'r') as example:
+        sudi = example.read()
+    with open(os.path.join(ROOT, "spi_example.txt"), 'r') as example:
+        spi = example.read()
+    certs = VerifySignature.der_certificates(sudi)
+    sudi_sig = sudi.split("Signature:")[1].split()[0]
+    fields = dict(line.split(":", 1) for line in spi.splitlines() if ":" in line)
+    spi_sig = spi.split("Signature:")[1].split()[0]
+    return [(certs[-1], binascii.a2b_hex(sudi_sig),
+             VerifySignature.sudi_signed_data("123", "1", certs)),
+            (certs[-1], binascii.a2b_hex(spi_sig),
+             VerifySignature.integrity_signed_data("123", "1", fields["PCR0"].strip(),
+                                                   fields["PCR8"].strip()))]
+
+
+BACKENDS = [pytest.param(backend_class, id=backend_class.__name__)
+            for backend_class in CryptoBackend.BACKENDS]
+
+
+@pytest.mark.parametrize("backend_class", BACKENDS)
+def test_backends_verify_the_example_evidence(backend_class):
+    try:
+        backend = backend_class()
+    except ImportError:
+        pytest.skip("%s is not installed" % backend_class.__name__)
+    for cert_der, signature, data in _example_evidence():
+        key = backend.load_certificate(cert_der)
+        assert backend.key_type(key) == "RSA"
+        assert backend.signature_size(key) == 256
+        assert CryptoBackend.SIGNATURES.verify(1, key, signature, data, backend)
+        assert not CryptoBackend.SIGNATURES.verify(1, key, signature, data + "x", backend)
+        assert not backend.verify(key, "\x11" * 256, data, "sha256")
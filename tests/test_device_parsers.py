@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''Streaming parsers give the same result however the output is chunked.'''
+
+import base64
+import os
+
+import pytest
+
+import device_parsers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1000]
+
+
+def _example(name):
+    with open(os.path.join(ROOT, name), 'r') as example:
+        # the parsers stop at the device prompt
+        return example.read() + "Switch#"
+
+
+def _feed(parser, text, size):
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return events
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_sudi_parser_chunks(size):
+    text = _example("sudi_example.txt")
+    whole = device_parsers.SudiCertParser()
+    expected = _feed(whole, text, len(text))
+    parser = device_parsers.SudiCertParser()
+    assert _feed(parser, text, size) == expected
+    assert parser.complete and parser.error is None
+    assert len(parser.certs) == 3
+    assert parser.fields["sig_ver"] == "1"
+    assert parser.fields["signature"] == text.split("Signature:")[1].split()[0]
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("name", ["spi_example.txt", "spi_example.1.5.txt"])
+def test_integrity_parser_chunks(name, size):
+    text = _example(name)
+    whole = device_parsers.IntegrityParser()
+    expected = _feed(whole, text, len(text))
+    parser = device_parsers.IntegrityParser()
+    assert _feed(parser, text, size) == expected
+    assert parser.complete and parser.error is None
+    for field in ("pcr0", "pcr8", "boot0_hash", "bootldr_hash", "sig_ver", "signature"):
+        assert parser.fields[field]
+
+
+def test_integrity_parser_os_hashes():
+    parser = device_parsers.IntegrityParser()
+    _feed(parser, _example("spi_example.1.5.txt"), 5)
+    assert len(parser.fields["os_hashes"]) > 1
+
+
+def test_parser_ignores_output_before_echo():
+    parser = device_parsers.SudiCertParser()
+    parser.echo = "show platform sudi certificate sign nonce 123"
+    _feed(parser, "Signature version: 9\nSwitch#" + _example("sudi_example.txt"), 3)
+    assert parser.fields["sig_ver"] == "1"
+
+
+PNP_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<pnp xmlns="urn:cisco:pnp" version="1.0" udi="PID:X,VID:V01,SN:ABC">
+<response correlator="CORR" xmlns="urn:cisco:pnp:device-auth" success="1">
+<deviceAuth>
+<challenge-response>{rsp}</challenge-response>
+<sudi-cert>{cert}</sudi-cert>
+<encryption-method>RSA</encryption-method>
+<hashing-method>SHA256</hashing-method>
+<unwanted>{padding}</unwanted>
+</deviceAuth>
+</response>
+</pnp>
+'''.format(rsp=base64.b64encode("r" * 256), cert=base64.b64encode("c" * 900),
+           padding="x" * 500)
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_device_auth_parser_chunks(size):
+    parser = device_parsers.DeviceAuthParser()
+    for start in range(0, len(PNP_RESPONSE), size):
+        parser.feed(PNP_RESPONSE[start:start + size])
+    parser.finish()
+    assert parser.error is None
+    assert parser.fields == {"challenge_rsp": base64.b64encode("r" * 256),
+                             "sudi_cert": base64.b64encode("c" * 900),
+                             "enc_method": "RSA",
+                             "hash_method": "SHA256"}
+
+
+def test_device_auth_parser_ignores_trailing_garbage():
+    parser = device_parsers.DeviceAuthParser()
+    parser.feed(PNP_RESPONSE.replace("</pnp>", "</pnp><<<"))
+    parser.finish()
+    assert parser.complete and parser.error is None
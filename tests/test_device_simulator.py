@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+'''Simulated device evidence matches the example certificates.'''
+
+import device_simulator
+
+
+def test_evidence_identity_matches_the_sudi_certificate():
+    evidence = device_simulator.Evidence()
+    assert evidence.pid == "WS-C3650-8X24UQ"
+    assert evidence.serial == "FDO2009V032"
+
+
+def test_examples_drop_the_echoed_command():
+    output = device_simulator.load_example(device_simulator.SUDI_EXAMPLE)
+    assert not output.startswith("Switch#")
+    assert output.startswith("-----BEGIN CERTIFICATE-----\r\n")
+    assert output.endswith("\r\n") and "\r\n\r\n" not in output
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+'''Fleet aggregates decide pass and failed checks per method.'''
+
+from device_record import DeviceRecord
+import fleet_stats
+
+
+def _device(address, method, site="lab"):
+    return DeviceRecord(address, method, "user", "pass", pid="C9300-24T", site=site)
+
+
+def test_pass_and_failed_checks_follow_the_method():
+    stats = fleet_stats.FleetStats()
+    stats.add(_device("10.0.0.1", "PNP"), 15, 1.0)
+    stats.add(_device("10.0.0.2", "CLI"), 31, 1.0)
+    stats.add(_device("10.0.0.3", "CLI"), 15, 1.0)
+    stats.add(_device("10.0.0.4", "PNP"), 13, 1.0)
+    stats.add(_device("10.0.0.5", "CLI"), -1, 1.0)
+
+    data = stats.snapshot()
+    assert (data["devices"], data["passed"], data["failed"]) == (5, 2, 3)
+    assert data["failed_checks"] == {"chain": 0, "proof_of_possession": 1, "sudi_serial": 0,
+                                     "pid": 0, "integrity": 1}
+    assert data["errors"] == {"login": 1}
+    assert data["groups"]["site"]["lab"] == {"devices": 5, "passed": 2}
+
+
+def test_groups_beyond_the_limit_are_other():
+    stats = fleet_stats.FleetStats(max_groups=2)
+    for idx in range(4):
+        stats.add(_device("10.0.0.%d" % idx, "CLI", site="site%d" % idx), 31, 0.5)
+    sites = stats.snapshot()["groups"]["site"]
+    assert sites[fleet_stats.OTHER] == {"devices": 2, "passed": 2}
+    assert len(sites) == 3
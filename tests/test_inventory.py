@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''Inventory backends: selection, identity updates and pass bookkeeping.'''
+
+import sqlite3
+
+import inventory
+
+CSV = ("10.0.0.1,CLI,admin,secret,enable\n"
+       "10.0.0.2,PNP,admin,secret,PID:X VID:V01 SN:ABC,ABC,C9300-24T\n"
+       "10.0.0.3,CLI,admin,secret,enable,FOC123,C9300-24T\n")
+
+
+def _sqlite(tmpdir):
+    tmpdir.join("devices.csv").write(CSV)
+    store = inventory.open_inventory(str(tmpdir.join("devices.db")))
+    assert store.import_csv(str(tmpdir.join("devices.csv")), site="lab") == 3
+    return store
+
+
+def test_sqlite_select_keeps_the_csv_layout(tmpdir):
+    store = _sqlite(tmpdir)
+    assert store.select(address="10.0.0.1") == [["10.0.0.1", "CLI", "admin", "secret",
+                                                 "enable"]]
+    assert sorted(row[0] for row in store.select(pid="C9300-24T")) == ["10.0.0.2", "10.0.0.3"]
+    assert len(store.select(site="lab")) == 3
+    assert store.select(site="other") == []
+    assert store.site_of("10.0.0.1") == "lab"
+    assert store.site_of("10.9.9.9") == inventory.DEFAULT_SITE
+
+
+def test_sqlite_last_verified_moves_only_on_a_pass(tmpdir):
+    store = _sqlite(tmpdir)
+    store.record_result("10.0.0.2", 15, when=100.0)
+    store.record_result("10.0.0.3", 15, when=100.0)
+    store.record_result("10.0.0.1", 31, when=100.0)
+    store.record_result("10.0.0.1", -1, when=200.0)
+    state = dict((address, last) for address, _, last in store.schedule_state())
+    assert state == {"10.0.0.1": 100.0, "10.0.0.2": 100.0, "10.0.0.3": None}
+    assert sorted(row[0] for row in store.select(verified_before=150.0)) == [
+        "10.0.0.1", "10.0.0.2", "10.0.0.3"]
+    assert [row[0] for row in store.select(verified_before=50.0)] == ["10.0.0.3"]
+    attempts = dict(store.conn.execute("SELECT address, last_attempt FROM devices"))
+    assert attempts["10.0.0.1"] == 200.0
+
+
+def test_sqlite_adds_the_attempt_column_to_old_inventories(tmpdir):
+    path = str(tmpdir.join("old.db"))
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE devices (address TEXT PRIMARY KEY, method TEXT NOT NULL, "
+                 "user TEXT NOT NULL, passwd TEXT NOT NULL, en_udi TEXT, sudi_serial TEXT, "
+                 "pid TEXT, site TEXT NOT NULL DEFAULT 'default', last_verified REAL, "
+                 "last_rc INTEGER)")
+    conn.execute("INSERT INTO devices (address, method, user, passwd) "
+                 "VALUES ('10.0.0.1', 'CLI', 'u', 'p')")
+    conn.commit()
+    conn.close()
+    store = inventory.SqliteInventory(path)
+    store.record_result("10.0.0.1", 31, when=5.0)
+    assert store.schedule_state() == [("10.0.0.1", "default", 5.0)]
+
+
+def test_csv_identity_updates_are_written_back(tmpdir):
+    path = tmpdir.join("devices.csv")
+    path.write(CSV)
+    store = inventory.open_inventory(str(path))
+    store.update_identity("10.0.0.1", "enable", "FOC999", "C9200L")
+    assert store.select(pid="C9200L")[0][:5] == ["10.0.0.1", "CLI", "admin", "secret",
+                                                 "enable"]
+    store.close()
+    assert path.read().splitlines()[0] == "10.0.0.1,CLI,admin,secret,enable,FOC999,C9200L"
+    assert tmpdir.join("devices.old.csv").read() == CSV
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+'''Replay index semantics and its journal.'''
+
+import NonceService
+from NonceService import (NONCE_OK, NONCE_REPLAYED, NONCE_STALE, NONCE_UNKNOWN,
+                          NonceService as Service, ReplayIndex)
+
+
+def test_check_consumes_once_per_kind():
+    index = ReplayIndex(window=60)
+    index.issue("0042", now=100)
+    assert index.check("42", "sudi", now=110) == NONCE_OK
+    assert index.check("42", "sudi", now=110) == NONCE_REPLAYED
+    assert index.check("0042", "integrity", now=110) == NONCE_OK
+    assert index.check("43", "sudi", now=110) == NONCE_UNKNOWN
+    assert index.check("42", "pnp", now=161) == NONCE_STALE
+
+
+def test_check_without_consuming():
+    index = ReplayIndex(window=60)
+    index.issue("7", now=100)
+    assert index.check("7", "sudi", now=101, consume=False) == NONCE_OK
+    assert index.check("7", "sudi", now=101, consume=False) == NONCE_OK
+    assert index.check("7", "sudi", now=101) == NONCE_OK
+    assert index.check("7", "sudi", now=101, consume=False) == NONCE_REPLAYED
+
+
+def test_journal_round_trip(tmpdir, monkeypatch):
+    path = str(tmpdir.join("nonces.journal"))
+    monkeypatch.setattr(NonceService.time, "time", lambda: 1000.0)
+    index = ReplayIndex(window=60, path=path)
+    for nonce in ("1", "2", "3", "CHALLENGE"):
+        index.issue(nonce, now=990)
+    index.check("1", "sudi", now=995)
+    index.check("1", "integrity", now=995)
+    index.check("2", "sudi", now=995)
+    index.check("3", "sudi", now=995, consume=False)
+
+    loaded = ReplayIndex(window=60, path=path)
+    assert loaded.issued == index.issued
+    assert loaded.consumed == {"1": set(["sudi", "integrity"]), "2": set(["sudi"])}
+    assert loaded.check("1", "sudi", now=1000) == NONCE_REPLAYED
+    assert loaded.check("2", "integrity", now=1000) == NONCE_OK
+    assert loaded.check("3", "sudi", now=1000) == NONCE_OK
+    assert loaded.check("CHALLENGE", "pnp", now=1000) == NONCE_OK
+    assert loaded.check("4", "sudi", now=1000) == NONCE_UNKNOWN
+
+
+def test_journal_drops_expired_entries(tmpdir, monkeypatch):
+    path = str(tmpdir.join("nonces.journal"))
+    index = ReplayIndex(window=60, path=path)
+    index.issue("1", now=100)
+    index.issue("2", now=500)
+    monkeypatch.setattr(NonceService.time, "time", lambda: 520.0)
+    loaded = ReplayIndex(window=60, path=path)
+    assert "1" not in loaded.issued
+    assert "2" in loaded.issued
+
+
+def test_service_records_issued_nonces():
+    service = Service()
+    nonce = service.nonce()
+    assert len(nonce) == NonceService.NONCE_DIGITS and nonce.isdigit()
+    assert service.index.check(nonce, "sudi") == NONCE_OK
+    token = service.token(16)
+    assert len(token) == 16
+    assert service.index.check(token, "pnp") == NONCE_OK
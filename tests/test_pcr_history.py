@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''Columnar PCR history: drift queries, distribution and reopening.'''
+
+import pcr_history
+
+A = "AA" * 32
+B = "BB" * 32
+C = "CC" * 32
+
+
+def _history(tmpdir):
+    history = pcr_history.PcrHistory(str(tmpdir.join("pcr")))
+    history.append("10.0.0.1", A, A, "16.9", "17.3", 31, when=100.0)
+    history.append("10.0.0.2", A, A, "16.9", "17.3", 31, when=110.0)
+    history.append("10.0.0.1", A, B, "16.9", "17.6", 31, when=200.0)
+    history.append("10.0.0.2", None, None, None, None, -1, when=210.0)
+    history.append("10.0.0.2", A, C, "16.9", "17.6", 15, when=300.0)
+    history.append("10.0.0.1", A, B, "16.9", "17.6", 31, when=310.0)
+    return history
+
+
+def test_changes_in_a_window(tmpdir):
+    history = _history(tmpdir)
+    assert history.changes("pcr8", 0.0) == [("10.0.0.1", 200.0, A, B),
+                                            ("10.0.0.2", 300.0, A, C)]
+    # the previous value comes from before the window, skipping rows
+    # without PCRs
+    assert history.changes("pcr8", 250.0) == [("10.0.0.2", 300.0, A, C)]
+    assert history.changes("pcr8", 0.0, until=250.0) == [("10.0.0.1", 200.0, A, B)]
+    assert history.changes("pcr0", 0.0) == []
+    history.close()
+
+
+def test_distribution_and_history(tmpdir):
+    history = _history(tmpdir)
+    assert sorted(history.distribution("pcr8")) == [(B, 1), (C, 1)]
+    rows = history.history("10.0.0.2")
+    assert [(row[0], row[2], row[5]) for row in rows] == [
+        (110.0, A, 31), (210.0, "00" * 32, -1), (300.0, C, 15)]
+    assert rows[2][3:5] == ("16.9", "17.6")
+    assert history.history("10.9.9.9") == []
+    history.close()
+
+
+def test_times_never_go_back(tmpdir):
+    history = pcr_history.PcrHistory(str(tmpdir.join("pcr")))
+    history.append("10.0.0.1", A, A, when=100.0)
+    history.append("10.0.0.1", A, B, when=50.0)
+    assert [row[0] for row in history.history("10.0.0.1")] == [100.0, 100.0]
+    history.close()
+
+
+def test_reopen_and_read_only(tmpdir):
+    _history(tmpdir).close()
+    reader = pcr_history.PcrHistory(str(tmpdir.join("pcr")), readonly=True)
+    assert reader.rows == 6
+    assert len(reader.changes("pcr8", 0.0)) == 2
+    reader.close()
+    writer = pcr_history.PcrHistory(str(tmpdir.join("pcr")))
+    writer.append("10.0.0.1", A, C, when=400.0)
+    writer.close()
+    reader = pcr_history.PcrHistory(str(tmpdir.join("pcr")), readonly=True)
+    assert reader.changes("pcr8", 350.0) == [("10.0.0.1", 400.0, B, C)]
+    reader.close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''The single pass PEM scanner against the regex it replaced.'''
+
+import os
+import time
+
+import pytest
+
+import VerifySignature
+from VerifySignature import LEGACY_PEM_PAT, PEM_BEGIN, PEM_END, _clean_eol, _scan_pem
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _legacy(text):
+    return [body for body in LEGACY_PEM_PAT.findall(_clean_eol(text))
+            if body.strip()]
+
+
+def _example_stack():
+    with open(os.path.join(ROOT, "sudi_example.txt"), 'r') as example:
+        return example.read()
+
+
+CASES = [
+    _example_stack(),
+    _example_stack().replace("\n", "\r\n"),
+    "no certificates here",
+    PEM_BEGIN + "\nQUJD\n" + PEM_END + "\n",
+    PEM_BEGIN + "\n  QUJD \n\n" + PEM_END + "\n" + PEM_BEGIN + "\nREVG\n" + PEM_END,
+    "junk " + PEM_BEGIN + "\nQUJD\n" + PEM_END + "\n",
+    PEM_BEGIN + "\nQU!D\n" + PEM_END + "\n" + PEM_BEGIN + "\nREVG\n" + PEM_END,
+    PEM_BEGIN + "\n" + PEM_BEGIN + "\nQUJD\n" + PEM_END + "\n",
+    PEM_BEGIN + "QUJD\n" + PEM_END + "\n",
+    PEM_BEGIN + "\nQUJD" + PEM_END + "\n",
+    PEM_BEGIN + "\n \n" + PEM_END + "\n",
+    PEM_BEGIN + "\nQUJD\n",
+]
+
+
+@pytest.mark.parametrize("text", CASES)
+def test_scan_matches_legacy_regex(text):
+    assert list(_scan_pem(text)) == _legacy(text)
+
+
+@pytest.mark.parametrize("name,text", VerifySignature.adversarial_pem_inputs(200))
+def test_scan_matches_legacy_regex_on_adversarial_input(name, text):
+    assert list(_scan_pem(text)) == _legacy(text)
+
+
+def _worst_case(size):
+    worst = 0.0
+    for _, text in VerifySignature.adversarial_pem_inputs(size):
+        start = time.time()
+        list(_scan_pem(text))
+        worst = max(worst, time.time() - start)
+    return worst
+
+
+def test_scan_is_linear():
+    small = max(_worst_case(64 * 1024), 1e-4)
+    large = _worst_case(64 * 64 * 1024)
+    # 64 times the input; quadratic growth would be about 4096 times
+    assert large < small * 64 * 8
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+'''Result store keys cover the nonce the evidence was signed over.'''
+
+import os
+
+import ResultStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _example(name):
+    with open(os.path.join(ROOT, name), 'r') as example:
+        return example.read()
+
+
+def test_evidence_digest_depends_on_nonce():
+    sudi = _example("sudi_example.txt")
+    spi = _example("spi_example.txt")
+    digest = ResultStore.evidence_digest(("123", sudi), ("123", spi))
+    assert digest == ResultStore.evidence_digest(("123", sudi), ("123", spi))
+    assert digest != ResultStore.evidence_digest(("124", sudi), ("123", spi))
+    assert digest != ResultStore.evidence_digest(("123", sudi), ("124", spi))
+    assert digest != ResultStore.evidence_digest(("123", sudi))
+
+
+def test_evidence_digest_ignores_line_endings():
+    sudi = _example("sudi_example.txt")
+    assert (ResultStore.evidence_digest(("123", sudi)) ==
+            ResultStore.evidence_digest(("123", sudi.replace("\n", "\r\n"))))
+
+
+def test_check_capture_key_depends_on_nonce(tmpdir, monkeypatch):
+    calls = []
+    def verify_capture(*args):
+        calls.append(args[0])
+        return True, None
+    monkeypatch.setattr(ResultStore, "verify_capture", verify_capture)
+    store = ResultStore.ResultStore(str(tmpdir.join("results.db")))
+    sudi = _example("sudi_example.txt")
+
+    assert ResultStore.check_capture(store, "trust", (), "123", sudi) == (False, True, None)
+    assert ResultStore.check_capture(store, "trust", (), "123", sudi) == (True, True, None)
+    # the same body under another nonce is verified again
+    assert ResultStore.check_capture(store, "trust", (), "124", sudi) == (False, True, None)
+    assert calls == ["123", "124"]
+    store.close()
+
+
+def test_find_captures_rejects_duplicate_nonces(tmpdir):
+    sudi = _example("sudi_example.txt")
+    spi = _example("spi_example.txt")
+    device = tmpdir.mkdir("device")
+    device.join("a_sudi.txt").write(sudi)
+    device.join("b_spi.txt").write(spi)
+    replayed = tmpdir.mkdir("replayed")
+    replayed.join("a_sudi.txt").write(sudi)
+    replayed.join("b_sudi.txt").write(sudi)
+    replayed.join("c_spi.txt").write(spi)
+
+    pairs = ResultStore.find_captures(str(tmpdir))
+    assert pairs[0] == (str(device.join("a_sudi.txt")), str(device.join("b_spi.txt")), None)
+    assert [pair[:2] for pair in pairs[1:]] == [(str(replayed.join("a_sudi.txt")), None),
+                                                (str(replayed.join("b_sudi.txt")), None)]
+    assert all("nonce 123" in pair[2] for pair in pairs[1:])
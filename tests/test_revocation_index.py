@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+'''Revocation list compilation and lookups.'''
+
+import hashlib
+import os
+
+import RevocationIndex
+from VerifySignature import der_certificates
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _sudi_der():
+    with open(os.path.join(ROOT, "sudi_example.txt"), 'r') as example:
+        return der_certificates(example.read())[-1]
+
+
+def _serial_attribute(value):
+    return RevocationIndex.SERIAL_NUMBER_OID + "\x13" + chr(len(value)) + value
+
+
+def test_entry_keys():
+    fingerprint = "ab" * 32
+    assert RevocationIndex.entry_key(fingerprint) == "fp:" + fingerprint.upper()
+    assert RevocationIndex.entry_key(":".join(["AB"] * 32)) == "fp:" + fingerprint.upper()
+    assert RevocationIndex.entry_key("fp:" + fingerprint) == "fp:" + fingerprint.upper()
+    assert RevocationIndex.entry_key(" sn:foc123 # stolen") == "sn:FOC123"
+    assert RevocationIndex.entry_key("FOC123") == "sn:FOC123"
+    assert RevocationIndex.entry_key("  # comment") is None
+
+
+def test_sudi_serial():
+    assert RevocationIndex.sudi_serial(_sudi_der()) == "FDO2009V032"
+    assert RevocationIndex.sudi_serial(_serial_attribute("PID:X SN:ABC")) == "ABC"
+    # the subject's serialNumber follows the issuer's
+    assert RevocationIndex.sudi_serial(_serial_attribute("PID:A SN:ONE") +
+                                       _serial_attribute("PID:B SN:TWO")) == "TWO"
+
+
+def test_sudi_serial_without_a_value():
+    assert RevocationIndex.sudi_serial(_serial_attribute("PID:X SN:")) is None
+    assert RevocationIndex.sudi_serial(_serial_attribute("PID:X SN:  ")) is None
+    assert RevocationIndex.sudi_serial(_serial_attribute("PID:X SN:ABC") +
+                                       _serial_attribute("PID:X SN:")) == "ABC"
+    assert RevocationIndex.sudi_serial("no serial here") is None
+
+
+def test_build_and_lookup(tmpdir):
+    der = _sudi_der()
+    listed = tmpdir.join("revoked.txt")
+    listed.write("# revoked devices\nFOC0000001\nsn:foc0000002\n\n" +
+                 "fp:" + "00" * 32 + "\n" + "".join("SN%07d\n" % idx for idx in range(5000)))
+    path = str(tmpdir.join("revoked.idx"))
+    assert RevocationIndex.build(str(listed), path) == 5003
+
+    index = RevocationIndex.RevocationIndex(path)
+    assert index.contains("sn:FOC0000002")
+    assert index.contains("sn:SN0004999")
+    assert not index.contains("sn:SN0005000")
+    assert index.revoked(der) is None
+    misses = sum(index.contains("sn:OTHER%d" % idx) for idx in range(5000))
+    assert misses == 0
+    index.close()
+
+    listed.write("FDO2009V032\n", mode="a")
+    RevocationIndex.build(str(listed), path)
+    index = RevocationIndex.RevocationIndex(path)
+    assert index.revoked(der) == "sn:FDO2009V032"
+    index.close()
+
+    listed.write("fp:%s\n" % hashlib.sha256(der).hexdigest())
+    RevocationIndex.build(str(listed), path)
+    index = RevocationIndex.RevocationIndex(path)
+    assert index.revoked(der) == "fp:" + hashlib.sha256(der).hexdigest().upper()
+    index.close()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''Rolling scheduler due times, site caps, retries and coverage.'''
+
+import scheduler
+
+
+def _scheduler(count=10, period=1000.0, cap=None, sites=1):
+    schedule = scheduler.RollingScheduler(period, cap, retry_base=10)
+    schedule.load([("10.0.0.%d" % idx, "site%d" % (idx % sites), None)
+                   for idx in range(count)], now=0.0)
+    return schedule
+
+
+def test_new_devices_are_spread_over_the_period():
+    schedule = _scheduler()
+    dues = sorted(device.due for device in schedule.devices.values())
+    assert dues == [100.0 * idx for idx in range(10)]
+    taken = schedule.take(10, now=250.0)
+    assert [device.due for device in taken] == [0.0, 100.0, 200.0]
+    assert schedule.next_due(now=250.0) == 50.0
+
+
+def test_load_keeps_earlier_deadlines():
+    schedule = scheduler.RollingScheduler(900.0)
+    schedule.load([("overdue", "s", 0.0), ("new", "s", None), ("passed", "s", 500.0)],
+                  now=1000.0)
+    # slots are 300 seconds apart in deadline order; a pass is due the
+    # lead time before one period after it
+    assert schedule.devices["overdue"].due == 1000.0
+    assert schedule.devices["new"].due == 1300.0
+    assert schedule.devices["passed"].due == 500.0 + 900.0 - schedule.lead
+
+
+def test_pass_reschedules_ahead_of_the_deadline():
+    schedule = _scheduler(count=1)
+    device = schedule.take(1, now=0.0)[0]
+    schedule.done(device, True, now=5.0)
+    assert device.last_verified == 5.0
+    assert device.due == 5.0 + 1000.0 - schedule.lead
+    assert schedule.coverage(now=500.0) == 1.0
+    assert schedule.coverage(now=1006.0) == 0.0
+
+
+def test_failures_back_off_but_stay_within_the_period():
+    schedule = _scheduler(count=1)
+    dues = []
+    now = 0.0
+    for _ in range(10):
+        device = schedule.take(1, now=now)[0]
+        schedule.done(device, False, now=now)
+        dues.append(device.due - now)
+        now = device.due
+    assert dues[:4] == [10.0, 20.0, 40.0, 80.0]
+    assert max(dues) == 1000.0 - schedule.lead
+    # failures never count as coverage
+    assert device.last_verified is None
+    assert schedule.coverage(now=now) == 0.0
+
+
+def test_site_cap_holds_devices_back():
+    caps = {"site0": 1, "site1": 2}
+    schedule = _scheduler(count=10, cap=lambda site: caps[site], sites=2)
+    taken = schedule.take(10, now=1000.0)
+    assert sorted(device.site for device in taken) == ["site0", "site1", "site1"]
+    schedule.done(taken[0], True, now=1000.0)
+    again = schedule.take(10, now=1000.0)
+    assert [device.site for device in again] == [taken[0].site]
+
+
+def test_postpone_and_reboot_hints():
+    schedule = _scheduler(count=2)
+    device = schedule.take(1, now=0.0)[0]
+    schedule.postpone(device, 60.0, now=0.0)
+    assert device.due == 60.0 and schedule.inflight[device.site] == 0
+    other = [d for d in schedule.devices.values() if d is not device][0]
+    assert other.due == 500.0
+    schedule.hint_reboot(other.address, now=30.0)
+    assert schedule.take(5, now=30.0) == [other]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''Consistent hash assignment and result merging of sharded runs.'''
+
+import pytest
+
+import sharding
+
+
+class Store(object):
+    '''Inventory stand-in recording merged results.'''
+
+    def __init__(self):
+        self.results = {}
+
+    def record_result(self, address, auth_rc):
+        self.results[address] = auth_rc
+
+    def update_identity(self, address, en_udi, sudi_serial, pid):
+        pass
+
+    def site_of(self, address):
+        return None
+
+
+ROWS = [("10.0.%d.%d" % (idx // 250, idx % 250), "PNP" if idx % 2 else "CLI", "u", "p")
+        for idx in range(200)]
+
+
+def test_ring_moves_only_the_removed_nodes_keys():
+    ring = sharding.HashRing(["a", "b", "c"])
+    keys = ["device%d" % idx for idx in range(2000)]
+    before = dict((key, ring.owner(key)) for key in keys)
+    assert set(before.values()) == set(["a", "b", "c"])
+    ring.remove("b")
+    for key in keys:
+        if before[key] != "b":
+            assert ring.owner(key) == before[key]
+        else:
+            assert ring.owner(key) in ("a", "c")
+    assert sharding.HashRing().owner("device") is None
+
+
+def _drain(coordinator, worker, results):
+    while True:
+        rows = coordinator.assignment(worker)
+        if not rows:
+            return rows
+        for row in rows:
+            coordinator.record_result(worker, row[0], results(row))
+
+
+def test_every_device_is_assigned_once_and_counted_per_method():
+    store = Store()
+    coordinator = sharding.Coordinator(store, ROWS, "s" * 16)
+    coordinator.join("w1")
+    coordinator.join("w2")
+    passing = lambda row: 15 if row[1] == "PNP" else 31
+    assert _drain(coordinator, "w1", passing) == []
+    assert _drain(coordinator, "w2", passing) is None
+    assert coordinator.finished()
+    assert len(store.results) == len(ROWS)
+    assert coordinator.report_lines()[-1].split()[:5] == ["total", "passed", "200", "failed",
+                                                          "0"]
+    # addresses outside the run are ignored
+    assert coordinator.record_result("w1", "10.9.9.9", 31) is False
+
+
+def test_cli_rc_15_fails():
+    # ROWS[0] is a CLI device, ROWS[1] a PnP device
+    coordinator = sharding.Coordinator(Store(), ROWS[:2], "s" * 16)
+    coordinator.join("w1")
+    coordinator.assignment("w1")
+    coordinator.record_result("w1", ROWS[0][0], 15)
+    coordinator.record_result("w1", ROWS[1][0], 13)
+    assert coordinator.stats["w1"] == [0, 2]
+
+
+def test_dead_worker_and_expired_leases_are_reassigned(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sharding.time, "time", lambda: now[0])
+    coordinator = sharding.Coordinator(Store(), ROWS, "s" * 16, heartbeat_timeout=30,
+                                       lease_timeout=100)
+    coordinator.join("w1")
+    coordinator.join("w2")
+    leased = coordinator.assignment("w1")
+    assert leased
+    now[0] += 20
+    assert coordinator.heartbeat("w2")
+    now[0] += 20
+    # w1 missed its heartbeats, its devices now belong to w2
+    assert coordinator.heartbeat("w1") is False
+    taken = set()
+    while True:
+        rows = coordinator.assignment("w2")
+        if not rows:
+            break
+        taken.update(row[0] for row in rows)
+    assert taken == set(row[0] for row in ROWS)
+
+    # leases without a result are handed out again
+    now[0] += 25
+    assert coordinator.heartbeat("w2")
+    now[0] += 25
+    assert coordinator.assignment("w2") == []
+    now[0] += 25
+    assert coordinator.heartbeat("w2")
+    now[0] += 26
+    assert coordinator.assignment("w2")
+
+
+def test_calls_need_the_secret():
+    coordinator = sharding.Coordinator(Store(), ROWS, "s" * 16)
+    join = coordinator._authenticated(coordinator.join)
+    with pytest.raises(sharding.AuthError):
+        join("wrong secret", "w1")
+    assert join("s" * 16, "w1") is True
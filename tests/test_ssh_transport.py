@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''Expect handling of the paramiko channel session and host key policies.'''
+
+import socket
+
+import pytest
+
+import ssh_transport
+
+
+class FakeChannel(object):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = []
+        self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def recv(self, size):
+        if not self.chunks:
+            return ""
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise socket.timeout()
+        return chunk
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.keys = []
+        self.closed = False
+
+    def get_host_keys(self):
+        return self
+
+    def add(self, hostname, name, key):
+        self.keys.append((hostname, name, key))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeKey(object):
+    def get_name(self):
+        return "ssh-rsa"
+
+    def get_base64(self):
+        return "AAAAB3Nza"
+
+
+class FakeParamiko(object):
+    class MissingHostKeyPolicy(object):
+        pass
+
+    class RejectPolicy(MissingHostKeyPolicy):
+        pass
+
+
+def _session(chunks):
+    return ssh_transport.ChannelSession(FakeClient(), FakeChannel(chunks), timeout=5)
+
+
+def test_expect_returns_the_earliest_match():
+    session = _session(["show ver", "sion\r\nIOS 16.9\r\nSwitch# rest"])
+    assert session.expect([r"Switch#", r"IOS"]) == 1
+    assert session.before == "show version\r\n"
+    assert session.after == "IOS"
+    assert session.expect(r"Switch#") == 0
+    assert session.before == " 16.9\r\n"
+    assert session.match.group(0) == "Switch#"
+    assert session.read_nonblocking(3) == " re"
+    assert session.read_nonblocking() == "st"
+
+
+def test_expect_timeout_and_close(monkeypatch):
+    clock = iter([0.0, 1.0, 10.0])
+    monkeypatch.setattr(ssh_transport.time, "time", lambda: next(clock, 20.0))
+    with pytest.raises(ssh_transport.SessionTimeout):
+        _session([None]).expect("Switch#")
+    with pytest.raises(ssh_transport.SessionClosed):
+        _session([]).expect("Switch#", timeout=1)
+    with pytest.raises(ssh_transport.SessionTimeout):
+        _session([None]).read_nonblocking()
+    with pytest.raises(ssh_transport.SessionClosed):
+        _session([]).read_nonblocking()
+
+
+def test_sendline_and_close():
+    session = _session([])
+    session.sendline("terminal length 0")
+    assert session.channel.sent == ["terminal length 0\n"]
+    session.close()
+    assert session.channel.closed and session.client.closed
+
+
+def test_unknown_hosts_rejected_by_default(tmpdir):
+    policy = ssh_transport._host_key_policy(FakeParamiko, str(tmpdir.join("hosts")), False)
+    assert isinstance(policy, FakeParamiko.RejectPolicy)
+
+
+def test_trust_on_first_use_saves_the_key(tmpdir):
+    known_hosts = tmpdir.join("known_hosts")
+    policy = ssh_transport._host_key_policy(FakeParamiko, str(known_hosts), True)
+    assert isinstance(policy, FakeParamiko.MissingHostKeyPolicy)
+    client = FakeClient()
+    key = FakeKey()
+    policy.missing_host_key(client, "10.0.0.1", key)
+    assert known_hosts.read() == "10.0.0.1 ssh-rsa AAAAB3Nza\n"
+    assert client.keys == [("10.0.0.1", "ssh-rsa", key)]
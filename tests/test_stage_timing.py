@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+'''Stage timing histograms, percentiles and the Prometheus export.'''
+
+import pytest
+
+import stage_timing
+
+
+def test_histogram_percentiles():
+    hist = stage_timing.Histogram((1.0, 2.0, 4.0))
+    assert hist.percentile(50) == 0.0
+    for value in (0.5, 0.5, 1.5, 3.0):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1, 0]
+    assert (hist.count, hist.total, hist.max) == (4, 5.5, 3.0)
+    assert hist.percentile(50) == 1.0
+    assert hist.percentile(75) == 2.0
+    assert hist.percentile(100) == 3.0
+    hist.observe(10.0)
+    assert hist.counts[-1] == 1
+    assert hist.percentile(100) == 10.0
+
+
+def test_histogram_state_round_trip():
+    hist = stage_timing.Histogram((1.0, 2.0))
+    hist.observe(1.5)
+    copy = stage_timing.Histogram.from_state(hist.state())
+    assert copy.state() == hist.state()
+    assert copy.percentile(50) == hist.percentile(50)
+
+
+def test_nested_stages_and_decorator(monkeypatch):
+    clock = iter([0.0, 1.0, 3.0, 6.0, 10.0, 10.5])
+    monkeypatch.setattr(stage_timing.time, "time", lambda: next(clock))
+    timings = stage_timing.StageTimings()
+
+    @timings.timed("device")
+    def collect():
+        with timings.stage("chain"):
+            pass
+        with timings.stage("pop"):
+            pass
+
+    collect()
+    assert sorted(timings.stages) == ["device", "device.chain", "device.pop"]
+    assert timings.stages["device.chain"].total == 2.0
+    assert timings.stages["device.pop"].total == 4.0
+    assert timings.stages["device"].total == 10.5
+    assert collect.__name__ == "collect"
+    assert len(timings.summary_lines()) == 4
+
+
+def test_prometheus_text(tmpdir):
+    timings = stage_timing.StageTimings(prefix="dv")
+    timings.observe("chain", 0.02)
+    timings.observe("chain", 7.0)
+    path = str(tmpdir.join("metrics.prom"))
+    timings.write_prometheus(path)
+    lines = open(path).read().splitlines()
+    assert lines[1] == "# TYPE dv_stage_seconds histogram"
+    assert 'dv_stage_seconds_bucket{stage="chain",le="0.025"} 1' in lines
+    assert 'dv_stage_seconds_bucket{stage="chain",le="5.0"} 1' in lines
+    assert 'dv_stage_seconds_bucket{stage="chain",le="10.0"} 2' in lines
+    assert 'dv_stage_seconds_bucket{stage="chain",le="+Inf"} 2' in lines
+    assert 'dv_stage_seconds_count{stage="chain"} 2' in lines
+    assert 'dv_stage_seconds_sum{stage="chain"} 7.020000' in lines
+
+
+def test_command_timeouts_learn_from_history(tmpdir, monkeypatch):
+    monkeypatch.setattr(stage_timing, "TIMEOUT_MIN_SAMPLES", 3)
+    path = str(tmpdir.join("timeouts.json"))
+    timeouts = stage_timing.CommandTimeouts(30, maximum=60, path=path)
+    command = "show platform integrity sign nonce 123"
+    assert timeouts.key(command) == "show platform integrity sign nonce"
+    for seconds in (2.0, 2.0, 2.0):
+        assert timeouts.timeout(command) == 30
+        timeouts.observe(command, seconds)
+    assert timeouts.timeout("show platform integrity sign nonce 456") == pytest.approx(5.97)
+    timeouts.observe(command, 100.0)
+    assert timeouts.timeout(command) == 60
+    timeouts.save()
+    restored = stage_timing.CommandTimeouts(30, maximum=60, path=path)
+    assert restored.timeout(command) == 60
+    assert len(restored.summary_lines()) == 2
+
+
+def test_command_timeouts_floor():
+    timeouts = stage_timing.CommandTimeouts(30)
+    for _ in range(stage_timing.TIMEOUT_MIN_SAMPLES):
+        timeouts.observe("show version", 0.01)
+    assert timeouts.timeout("show version") == stage_timing.TIMEOUT_MIN
+    assert stage_timing.CommandTimeouts(30, path="/nonexistent/file").commands == {}